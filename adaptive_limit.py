@@ -0,0 +1,159 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+import asyncio
+import httpx
+from collections import deque
+from typing import Deque, Dict, Optional
+
+DEFAULT_BACKOFF = 0.5
+DEFAULT_LATENCY_TOLERANCE = 2.0
+
+# How fast the latency baseline follows latencies above it; lower ones replace it straight away
+BASELINE_DRIFT = 0.01
+
+def is_overload(status: Optional[int] = None, error: Optional[BaseException] = None) -> bool:
+    """Whether a response or error means the server (or the link) is getting more than it can take"""
+    if error is not None:
+        return isinstance(error, httpx.TimeoutException) or (
+            isinstance(error, httpx.HTTPStatusError) and is_overload(error.response.status_code)
+        )
+    return status is not None and (status == 429 or status >= 500)
+
+class AdaptiveLimit:
+    """
+    Concurrency limit that adapts to how the server responds (AIMD)
+
+    Used like an asyncio.Semaphore whose size changes: every healthy response
+    with a latency close to the best seen adds 1/limit to the limit (about one
+    extra slot per round of requests), and a 429, 5xx or timeout halves it.
+    Requests already in flight when the limit was cut don't cut it again.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 16,
+        backoff: float = DEFAULT_BACKOFF,
+        latency_tolerance: float = DEFAULT_LATENCY_TOLERANCE
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.baseline: Optional[float] = None
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def current(self) -> int:
+        """Number of requests currently allowed in flight"""
+        return int(self.limit)
+
+    async def acquire(self) -> None:
+        while self.in_flight >= self.current:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                # Pass on a wake-up this waiter may already have been given
+                self.wake()
+                raise
+        self.in_flight += 1
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self.wake()
+
+    def wake(self) -> None:
+        free = self.current - self.in_flight
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def __aenter__(self) -> 'AdaptiveLimit':
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.release()
+
+    def observe(self, started: float, status: Optional[int] = None, error: Optional[BaseException] = None) -> None:
+        """
+        Feed back the outcome of one request
+
+        :param started: time.monotonic() when the request was sent
+        :param status: Response status code, if a response arrived
+        :param error: Exception the request raised instead
+        """
+        if is_overload(status, error):
+            # One cut per congestion event: requests sent before the last cut saw the old limit
+            if started >= self.last_decrease:
+                previous = self.current
+                self.limit = max(float(self.min_limit), self.limit * self.backoff)
+                self.last_decrease = time.monotonic()
+                if self.current < previous:
+                    print(f"Lowering {self.name} concurrency to {self.current} ({error or status})")
+            return
+        if error is not None:
+            return
+
+        latency = time.monotonic() - started
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            self.baseline += (latency - self.baseline) * BASELINE_DRIFT
+
+        if latency <= self.baseline * self.latency_tolerance:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self.wake()
+
+class HostLimits:
+    """
+    One AdaptiveLimit per host, each created with the same settings on first use
+
+    Every image mirror is a separate server with its own capacity, so a
+    mirror answering 503 only holds back the requests sent to it.
+    """
+
+    def __init__(self, name: str, initial: int = 4, max_limit: int = 16, **kwargs):
+        self.name = name
+        self.initial = initial
+        self.max_limit = max_limit
+        self.kwargs = kwargs
+        self.limits: Dict[str, AdaptiveLimit] = {}
+
+    def get(self, host: str) -> AdaptiveLimit:
+        if host not in self.limits:
+            self.limits[host] = AdaptiveLimit(f"{host} {self.name}", self.initial, max_limit=self.max_limit,
+                                              **self.kwargs)
+        return self.limits[host]
+
+    def summary(self) -> str:
+        """Current limit of every host used so far, e.g. 'i1: 16, i3: 9'"""
+        return ', '.join(f"{host}: {limit.current}" for host, limit in sorted(self.limits.items())) or 'unused'
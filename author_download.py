@@ -18,159 +18,139 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import re
 import os
 import asyncio
-import httpx
 import shutil
+import argparse
+from functools import partial
 from bs4 import BeautifulSoup
-from typing import List, Optional
-from project_asynchronous_verification_download import download_manga
+from typing import AsyncIterator, List, Optional, Set, Tuple
+from project_asynchronous_verification_download import (
+    download_manga, convert_to_pdf, extract_manga_id, format_size, TranscodeOptions, add_transcode_args,
+    transcode_from_args
+)
+from http_session import HttpSession, use_session, PAGE_HEADERS
+from url_cache import ResolvedUrlCache
+from probe_order import ProbeOrderModel
+from batch_scheduler import BatchResult, run_batch, DEFAULT_MAX_GALLERIES, DEFAULT_PAGE_BUDGET
+from pdf_stage import PdfStage, default_pdf_workers, threads_per_worker
+from image_store import ImageStore
+from rate_limiter import add_rate_limit_args, rate_limiter_from_args
+from page_parser import GALLERY_LINKS, LISTING_TAGS, parse_html
 
-async def get_total_pages(client: httpx.AsyncClient, base_url: str, headers: dict) -> int:
+DEFAULT_SEARCH_CONCURRENCY = 4
+
+def parse_last_page(soup: BeautifulSoup) -> int:
+    """Read the last page number from a listing's pagination, 1 if there is none"""
+    pagination = soup.find('div', class_='pagination')
+    if not pagination:
+        return 1
+    
+    numbers = [int(link.text) for link in pagination.find_all('a') if link.text.strip().isdigit()]
+    # The "last" arrow usually has no number in its text, only in its href
+    for link in pagination.find_all('a', href=True):
+        match = re.search(r'[?&]page=(\d+)', link['href'])
+        if match:
+            numbers.append(int(match.group(1)))
+    return max(numbers, default=1)
+
+async def get_total_pages(client: HttpSession, base_url: str, headers: dict) -> int:
     """Get the total number of pages for a search result or listing."""
     response = await client.get(base_url, headers=headers)
     response.raise_for_status()
-    soup = BeautifulSoup(response.text, 'html.parser')
-    
-    # Find the last page number from pagination
-    last_page = 1
-    pagination = soup.find('div', class_='pagination')
-    if pagination:
-        page_links = pagination.find_all('a', class_='page')
-        if page_links:
-            try:
-                last_page = max(int(link.text) for link in page_links if link.text.isdigit())
-            except ValueError:
-                pass
-    return last_page
+    return parse_last_page(parse_html(response.text, LISTING_TAGS))
+
+def search_page_url(author_name: str, page: int) -> str:
+    if page == 1:
+        return f'https://nhentai.xxx/search/?key={author_name}'
+    return f'https://nhentai.xxx/search/?key={author_name}&page={page}'
 
-async def search_author(author_name: str) -> List[tuple[str, int]]:
+def parse_search_results(soup: BeautifulSoup) -> List[str]:
+    """Get the gallery URLs listed on a search result page"""
+    manga_urls = []
+    for gallery in soup.find_all('div', class_='gallery_item'):
+        link = gallery.find('a')
+        if link and 'href' in link.attrs:
+            manga_urls.append(f'https://nhentai.xxx{link["href"]}')
+    return manga_urls
+
+async def search_author(
+    author_name: str,
+    session: Optional[HttpSession] = None,
+    concurrency: int = DEFAULT_SEARCH_CONCURRENCY
+) -> AsyncIterator[Tuple[str, int]]:
     """
-    Search for manga URLs by author name on nhentai.xxx
+    Search for manga URLs by author name on nhentai.xxx, yielding them as they are found
+    
+    Page 1 is fetched first to read the last page number from its pagination;
+    its results are yielded while every remaining result page is fetched
+    concurrently, and each page's results are yielded as soon as it arrives.
+    Galleries listed more than once are only yielded the first time.
     
     :param author_name: Name of the author to search for
-    :return: List of tuples containing (manga_url, page_number)
+    :param session: Shared HTTP session, a temporary one is opened if not given
+    :param concurrency: Maximum number of result pages fetched at once
+    :return: Async iterator of (manga_url, page_number) tuples
     """
-    headers = {
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.5',
-        'Connection': 'keep-alive',
-        'DNT': '1',
-        'Host': 'nhentai.xxx',
-        'Sec-Fetch-Dest': 'document',
-        'Sec-Fetch-Mode': 'navigate',
-        'Sec-Fetch-Site': 'none',
-        'Sec-Fetch-User': '?1',
-        'Sec-GPC': '1',
-        'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:133.0) Gecko/20100101 Firefox/133',
-        'Upgrade-Insecure-Requests': '1'
-    }
+    semaphore = asyncio.Semaphore(concurrency)
+    seen: Set[str] = set()
     
-    async with httpx.AsyncClient(verify=False, follow_redirects=True) as client:
-        manga_links = []
-        current_page = 1
-        continue_search = True
-        
-        while continue_search:
-            # Format URL based on page number
-            if current_page == 1:
-                page_url = f'https://nhentai.xxx/search/?key={author_name}'
-            else:
-                page_url = f'https://nhentai.xxx/search/?key={author_name}&page={current_page}'
-            
-            print(f"\nScanning page {current_page}...")
-            print(f"URL: {page_url}")
-            
+    async def fetch_page(client: HttpSession, page: int) -> Tuple[int, Optional[BeautifulSoup]]:
+        page_url = search_page_url(author_name, page)
+        async with semaphore:
+            print(f"Scanning page {page}: {page_url}")
             try:
-                response = await client.get(page_url, headers=headers)
+                response = await client.get(page_url, headers=PAGE_HEADERS)
                 response.raise_for_status()
-                
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                # Find all manga links on current page
-                galleries = soup.find_all('div', class_='gallery_item')
-                found_manga_on_page = False
-                
-                for gallery in galleries:
-                    link = gallery.find('a')
-                    if link and 'href' in link.attrs:
-                        manga_url = f'https://nhentai.xxx{link["href"]}'
-                        if not any(url for url, _ in manga_links if url == manga_url):
-                            manga_links.append((manga_url, current_page))
-                            print(f"Added manga: {manga_url}")
-                            found_manga_on_page = True
-                
-                # First check if we found any manga
-                if not found_manga_on_page:
-                    print("\nNo manga found on current page, stopping search")
-                    continue_search = False
-                    continue
-
-                # Try different ways to find pagination
-                pagination = None
-                # Method 1: Look for pagination div
-                pagination_div = soup.find('div', class_='pagination')
-                if pagination_div:
-                    pagination = pagination_div
-                
-                # Method 2: Look for any numbered links that could be pages
-                if not pagination:
-                    all_links = soup.find_all('a')
-                    page_links = [a for a in all_links if a.text.isdigit()]
-                    if page_links:
-                        pagination = page_links
-
-                # Method 3: Look for next/previous links
-                if not pagination:
-                    next_links = [a for a in soup.find_all('a') if '>' in a.text or 'next' in a.text.lower()]
-                    if next_links:
-                        pagination = next_links
-
-                # Debug pagination detection
-                print(f"\nPagination detection result: {'Found' if pagination else 'Not found'}")
-                
-                # Process pagination if found
-                if pagination:
-                    # Get all page numbers from the page
-                    all_numbers = []
-                    if isinstance(pagination, list):
-                        all_numbers = [int(a.text) for a in pagination if a.text.isdigit()]
-                    else:
-                        all_numbers = [int(a.text) for a in pagination.find_all('a') if a.text.isdigit()]
-                    
-                    # Try to get the next page number
-                    next_page = current_page + 1
-                    
-                    # Test if next page exists by making a HEAD request
-                    next_url = f'https://nhentai.xxx/search/?key={author_name}&page={next_page}'
-                    try:
-                        test_response = await client.head(next_url, headers=headers)
-                        if test_response.status_code == 200:
-                            current_page = next_page
-                            print(f"Moving to page {current_page}...")
-                            await asyncio.sleep(1)  # Small delay between requests
-                            continue
-                    except Exception as e:
-                        print(f"Error testing next page: {str(e)}")
-                
-                # If we reach here, we couldn't find more pages
-                print("\nNo more pages found")
-                continue_search = False
-                
             except Exception as e:
-                print(f"Error fetching page {current_page}: {str(e)}")
-                continue_search = False
+                print(f"Error fetching page {page}: {str(e)}")
+                return page, None
+        return page, parse_html(response.text, LISTING_TAGS)
+    
+    def new_results(page: int, soup: Optional[BeautifulSoup]) -> List[Tuple[str, int]]:
+        results = []
+        for manga_url in parse_search_results(soup) if soup else []:
+            try:
+                manga_id = extract_manga_id(manga_url)
+            except ValueError as e:
+                # One odd listing link shouldn't end a search that is already feeding downloads
+                print(f"Skipping result on page {page}: {e}")
+                continue
+            if manga_id not in seen:
+                seen.add(manga_id)
+                results.append((manga_url, page))
+        return results
+    
+    async with use_session(session) as client:
+        _, first_page = await fetch_page(client, 1)
+        if first_page is None:
+            return
         
-        if not manga_links:
-            print("No manga found across all pages")
-        else:
-            print(f"\nTotal manga found: {len(manga_links)} across {current_page} pages")
+        last_page = parse_last_page(first_page)
+        print(f"\nFound {last_page} result pages")
         
-        return manga_links
+        # Later pages are already on their way while page 1's results are consumed
+        tasks = [asyncio.create_task(fetch_page(client, page)) for page in range(2, last_page + 1)]
+        try:
+            for result in new_results(1, first_page):
+                yield result
+            for next_page in asyncio.as_completed(tasks):
+                for result in new_results(*await next_page):
+                    yield result
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    if not seen:
+        print("No manga found across all pages")
+    else:
+        print(f"\nTotal manga found: {len(seen)} across {last_page} pages")
 
-async def get_page_manga_urls(page_url: str) -> List[str]:
+async def get_page_manga_urls(page_url: str, session: Optional[HttpSession] = None) -> List[str]:
     """
     Get all manga URLs from a specific page on nhentai.xxx
     
     :param page_url: URL of the page to scrape
+    :param session: Shared HTTP session, a temporary one is opened if not given
     :return: List of manga URLs
     """
     headers = {
@@ -188,11 +168,11 @@ async def get_page_manga_urls(page_url: str) -> List[str]:
         'Upgrade-Insecure-Requests': '1'
     }
     
-    async with httpx.AsyncClient(verify=False, follow_redirects=True) as client:
+    async with use_session(session) as client:
         response = await client.get(page_url, headers=headers)
         response.raise_for_status()
         
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = parse_html(response.text, GALLERY_LINKS)
         manga_links = []
         
         # Find all manga links on the page
@@ -203,7 +183,19 @@ async def get_page_manga_urls(page_url: str) -> List[str]:
         
         return manga_links
 
-async def main():
+def ask_download_choice() -> str:
+    print("\nDo you want to:")
+    print("1. Download all manga")
+    print("2. Select specific manga to download")
+    return input("Enter your choice (1 or 2): ").strip()
+
+async def run_interactive(session: HttpSession, dedupe: bool = False, transcode: Optional[TranscodeOptions] = None):
+    """
+    Interactive author/page download flow sharing one HTTP session
+    
+    :param dedupe: Keep page images in a content-addressed store in the download directory
+    :param transcode: Downscale/re-encode settings for the PDFs' pages
+    """
     print("Welcome to nhentai.xxx Manga Downloader!")
     print("1. Download manga by author name")
     print("2. Download manga from specific page")
@@ -222,33 +214,44 @@ async def main():
     
     choice = input("Enter your choice (1 or 2): ").strip()
     
+    # Author searches can stream straight into the downloader, so ask up front
+    download_choice = None
+    manga_stream = None
+    indexed_manga = []
+    
     if choice == '1':
         author_name = input("Enter author name: ").strip()
-        print(f"\nSearching for manga by {author_name}...")
-        manga_data = await search_author(author_name)
+        download_choice = ask_download_choice()
         
-        if not manga_data:
-            print(f"No manga found for author: {author_name}")
-            return
+        if download_choice == '1':
+            # Downloads start with page 1's results while later result pages are still being fetched
+            print(f"\nSearching for manga by {author_name} and downloading as they are found...")
+            manga_stream = (url async for url, _ in search_author(author_name, session))
+        else:
+            print(f"\nSearching for manga by {author_name}...")
+            manga_data = [result async for result in search_author(author_name, session)]
             
-        print(f"\nFound {len(manga_data)} manga by {author_name} across multiple pages")
-        
-        # Group manga by page number
-        manga_by_page = {}
-        for url, page in manga_data:
-            if page not in manga_by_page:
-                manga_by_page[page] = []
-            manga_by_page[page].append(url)
+            if not manga_data:
+                print(f"No manga found for author: {author_name}")
+                return
+                
+            print(f"\nFound {len(manga_data)} manga by {author_name} across multiple pages")
         
-        print("\nManga found by page:")
-        manga_index = 1
-        indexed_manga = []
-        for page in sorted(manga_by_page.keys()):
-            print(f"\nPage {page}:")
-            for url in manga_by_page[page]:
-                print(f"{manga_index}. {url}")
-                indexed_manga.append(url)
-                manga_index += 1
+            # Group manga by page number
+            manga_by_page = {}
+            for url, page in manga_data:
+                if page not in manga_by_page:
+                    manga_by_page[page] = []
+                manga_by_page[page].append(url)
+            
+            print("\nManga found by page:")
+            manga_index = 1
+            for page in sorted(manga_by_page.keys()):
+                print(f"\nPage {page}:")
+                for url in manga_by_page[page]:
+                    print(f"{manga_index}. {url}")
+                    indexed_manga.append(url)
+                    manga_index += 1
         
     elif choice == '2':
         page_url = input("Enter the nhentai.xxx page URL: ").strip()
@@ -257,7 +260,7 @@ async def main():
             return
             
         print("\nFetching manga from the page...")
-        manga_urls = await get_page_manga_urls(page_url)
+        manga_urls = await get_page_manga_urls(page_url, session)
         indexed_manga = manga_urls
         
         if not manga_urls:
@@ -273,14 +276,12 @@ async def main():
         print("Invalid choice. Please enter 1 or 2.")
         return
     
-    print("\nDo you want to:")
-    print("1. Download all manga")
-    print("2. Select specific manga to download")
-    download_choice = input("Enter your choice (1 or 2): ").strip()
+    if download_choice is None:
+        download_choice = ask_download_choice()
     
     manga_to_download = []
     if download_choice == '1':
-        manga_to_download = indexed_manga
+        manga_to_download = manga_stream or indexed_manga
     elif download_choice == '2':
         print("\nEnter the numbers of the manga you want to download (comma-separated)")
         print("Example: 1,3,5 to download the 1st, 3rd, and 5th manga")
@@ -301,15 +302,51 @@ async def main():
         print("No manga selected for download.")
         return
     
-    print(f"\nStarting downloads... ({len(manga_to_download)} manga total)")
+    if manga_stream:
+        print("\nStarting downloads as search results arrive...")
+    else:
+        print(f"\nStarting downloads... ({len(manga_to_download)} manga total)")
+    cache = ResolvedUrlCache()
+    probe_order = ProbeOrderModel()
+    page_budget = asyncio.Semaphore(DEFAULT_PAGE_BUDGET)
+    store = ImageStore.in_download_dir(download_dir) if dedupe else None
     try:
-        for i, url in enumerate(manga_to_download, 1):
-            try:
-                print(f"\nDownloading manga {i}/{len(manga_to_download)}...")
-                await download_manga(url, download_dir)
-                print(f"Successfully downloaded: {url}")
-            except Exception as e:
-                print(f"Failed to download {url}: {str(e)}")
+        # PDFs are built in worker processes while later manga download
+        workers = default_pdf_workers()
+        convert = partial(convert_to_pdf, threads=threads_per_worker(workers), raise_errors=True)
+        pdf_stage = None
+        results: List[BatchResult] = []
+        try:
+            async with PdfStage(convert, workers) as pdf_stage:
+                results = await run_batch(
+                    manga_to_download,
+                    lambda url: download_manga(
+                        url,
+                        cache,
+                        probe_order,
+                        session=session,
+                        download_dir=download_dir,
+                        page_budget=page_budget,
+                        pdf_stage=pdf_stage,
+                        store=store,
+                        transcode=transcode
+                    ),
+                    DEFAULT_MAX_GALLERIES
+                )
+        finally:
+            probe_order.close()
+            if pdf_stage:
+                pdf_stage.report(results)
+        if store:
+            print(f"Image store: {store.deduplicated} duplicate pages linked, saving {format_size(store.saved_bytes)}")
+        if not results:
+            print("No manga found to download.")
+            return
+        failed = [result.url for result in results if result.error]
+        if failed:
+            print(f"\nFailed to download {len(failed)} manga:")
+            for url in failed:
+                print(url)
     except KeyboardInterrupt:
         print("\n\nDownload interrupted by user. Already downloaded manga are saved.")
         return
@@ -344,5 +381,22 @@ async def main():
     
     print(f'\nPDF Collection completed! {pdf_count} PDF files were copied to {pdf_dir}')
 
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="Download every manga by an author, or on a listing page, "
+                                                 "from nhentai.xxx")
+    parser.add_argument('--dedupe', action='store_true',
+                        help="keep each distinct page image once in <download dir>/.store and hardlink it into "
+                             "every gallery that uses it")
+    add_transcode_args(parser)
+    add_rate_limit_args(parser)
+    return parser.parse_args(argv)
+
+async def main(args: Optional[argparse.Namespace] = None):
+    if args is None:
+        args = parse_args([])
+    async with HttpSession(rate_limiter=rate_limiter_from_args(args)) as session:
+        await run_interactive(session, args.dedupe, transcode_from_args(args))
+
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main(parse_args()))
\ No newline at end of file
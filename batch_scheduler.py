@@ -0,0 +1,143 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import re
+import math
+import time
+import asyncio
+import traceback
+from dataclasses import dataclass
+from typing import Any, AsyncIterable, Awaitable, Callable, Dict, List, Optional, Union
+
+from gallery import GalleryMetadata, parse_gallery
+from http_session import HttpSession, use_session, PAGE_HEADERS
+from url_cache import ResolvedUrlCache
+
+DEFAULT_MAX_GALLERIES = 3
+DEFAULT_PAGE_BUDGET = 24
+
+@dataclass
+class BatchResult:
+    """Data class to store the outcome of one gallery in a batch"""
+    url: str
+    result: Any = None
+    error: Optional[BaseException] = None
+    elapsed: float = 0.0
+    started: float = 0.0
+
+async def estimate_page_counts(
+    urls: List[str],
+    session: Optional[HttpSession] = None,
+    cache: Optional[ResolvedUrlCache] = None,
+    concurrency: int = 8,
+    galleries: Optional[Dict[str, GalleryMetadata]] = None
+) -> Dict[str, float]:
+    """
+    Estimate the page count of every gallery for shortest-job-first ordering
+
+    Cached page counts are used when available, otherwise the gallery page is
+    fetched and its page count (or thumbnail count) read. Galleries whose size
+    can't be determined sort last.
+
+    :param galleries: Filled with the parsed gallery page of every URL fetched here, so the
+                      download can start from it instead of fetching it again
+    :return: Dict of URL -> estimated page count (math.inf if unknown)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def estimate(client: HttpSession, url: str) -> float:
+        match = re.search(r'/g/(\d+)', url)
+        if cache and match:
+            page_count, _ = cache.get_gallery(match.group(1))
+            if page_count:
+                return page_count
+
+        async with semaphore:
+            try:
+                response = await client.get(url, headers=PAGE_HEADERS)
+                response.raise_for_status()
+            except Exception as e:
+                print(f"Could not estimate size of {url}: {e}")
+                return math.inf
+        metadata = parse_gallery(url, response.text, verbose=False)
+        if galleries is not None:
+            galleries[url] = metadata
+        return metadata.images.last_page or math.inf
+
+    async with use_session(session) as client:
+        sizes = await asyncio.gather(*[estimate(client, url) for url in urls])
+    return dict(zip(urls, sizes))
+
+async def run_batch(
+    urls: Union[List[str], AsyncIterable[str]],
+    download: Callable[[str], Awaitable[Any]],
+    max_galleries: int = DEFAULT_MAX_GALLERIES,
+    sizes: Optional[Dict[str, float]] = None
+) -> List[BatchResult]:
+    """
+    Download several galleries concurrently
+
+    :param urls: Gallery URLs, started in this order unless sizes is given. An async
+                 iterable (e.g. search results) is consumed while galleries download.
+    :param download: Coroutine function downloading a single gallery URL
+    :param max_galleries: Maximum number of galleries in flight at once
+    :param sizes: Optional size estimates for a URL list; smallest galleries are started first
+    :return: One BatchResult per URL, in the order the galleries finished
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    results: List[BatchResult] = []
+
+    if isinstance(urls, AsyncIterable):
+        workers = max(1, max_galleries)
+    else:
+        if sizes:
+            urls = sorted(urls, key=lambda url: sizes.get(url, math.inf))
+        workers = max(1, min(max_galleries, len(urls)))
+
+    async def produce() -> None:
+        try:
+            if isinstance(urls, AsyncIterable):
+                async for url in urls:
+                    queue.put_nowait(url)
+            else:
+                for url in urls:
+                    queue.put_nowait(url)
+        finally:
+            # One stop marker per worker, also when the URL source fails
+            for _ in range(workers):
+                queue.put_nowait(None)
+
+    async def worker() -> None:
+        while True:
+            url = await queue.get()
+            if url is None:
+                return
+
+            started = time.monotonic()
+            try:
+                outcome = await download(url)
+                results.append(BatchResult(url, outcome, elapsed=time.monotonic() - started, started=started))
+                print(f"Successfully downloaded manga from: {url}")
+            except Exception as e:
+                results.append(BatchResult(url, error=e, elapsed=time.monotonic() - started, started=started))
+                print(f"Error downloading manga from {url}: {str(e)}")
+                traceback.print_exc()
+
+    producer = asyncio.create_task(produce())
+    await asyncio.gather(*[worker() for _ in range(workers)])
+    await producer
+    return results
@@ -0,0 +1,288 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import shlex
+import asyncio
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_site import FakeSite, SiteConfig, gallery_ids
+
+ENTRIES = ['sync', 'async', 'fused', 'search']
+
+# Metrics checked by --compare, and whether a higher value is better
+COMPARED_METRICS = {'pages_per_sec': True, 'requests_per_page': False, 'p99_ms': False, 'peak_rss_mb': False}
+
+@dataclass
+class EntryResult:
+    """Data class to store what one run of an entry point did and cost"""
+    entry: str
+    seconds: float = 0.0
+    pages: int = 0
+    expected_pages: int = 0
+    requests: int = 0
+    statuses: Dict[str, int] = field(default_factory=dict)
+    p50_ms: float = 0.0
+    p99_ms: float = 0.0
+    peak_rss_mb: float = 0.0
+    worker_rss_mb: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def pages_per_sec(self) -> float:
+        return self.pages / self.seconds if self.seconds else 0.0
+
+    @property
+    def requests_per_page(self) -> float:
+        return self.requests / self.pages if self.pages else 0.0
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def route_to(port: int, latencies: List[float], statuses: Counter) -> None:
+    """
+    Send every request the downloader makes to the stand-in site on port
+
+    Requests keep their Host header, which the site serves by, and go out over
+    the downloader's own transports, so connection pooling, rate limits and
+    timeouts all take part. Plain HTTP is used, so there is no TLS or HTTP/2.
+    """
+    import httpx
+    send = httpx.AsyncHTTPTransport.handle_async_request
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if 'Host' not in request.headers:
+            request.headers['Host'] = request.url.netloc.decode('ascii')
+        request.url = request.url.copy_with(scheme='http', host='127.0.0.1', port=port)
+        started = time.perf_counter()
+        try:
+            response = await send(self, request)
+        except Exception as e:
+            statuses[type(e).__name__] += 1
+            raise
+        # Latency to the response headers, like AdaptiveLimit measures it
+        latencies.append((time.perf_counter() - started) * 1000)
+        statuses[str(response.status_code)] += 1
+        return response
+
+    httpx.AsyncHTTPTransport.handle_async_request = handle_async_request
+
+async def run_entry(entry: str, config: SiteConfig, entry_args: List[str]) -> int:
+    """
+    Run one entry point the way a user would
+
+    :return: Number of pages it produced: page images on disk, or search results for the search
+    """
+    urls = [f"https://nhentai.xxx/g/{gallery_id}/" for gallery_id in gallery_ids(config)]
+    with open('constants.txt', 'w') as f:
+        f.write('\n'.join(urls) + '\n')
+
+    if entry == 'sync':
+        import project
+        await project.main(project.parse_args(entry_args))
+    elif entry in ('async', 'fused'):
+        import project_asynchronous_verification_download as downloader
+        args = (['--fused'] if entry == 'fused' else []) + entry_args
+        await downloader.main(downloader.parse_args(args))
+    elif entry == 'search':
+        from author_download import search_author
+        from http_session import HttpSession
+        async with HttpSession() as session:
+            return len([url async for url, _ in search_author('bench', session)])
+    else:
+        raise ValueError(f"Unknown entry point: {entry}")
+    return len(glob.glob(os.path.join('downloads', '*', '[0-9][0-9][0-9].*')))
+
+def run_in_child(entry: str, config: SiteConfig, port: int, entry_args: List[str], verbose: bool,
+                 results: 'multiprocessing.Queue') -> None:
+    """Run an entry point in a fresh process and a fresh directory, so peak RSS and caches are its own"""
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    route_to(port, latencies, statuses)
+    expected = config.search_results if entry == 'search' else config.galleries * config.pages
+    result = EntryResult(entry, expected_pages=expected)
+    # Imported up front so import time isn't counted
+    import project, project_asynchronous_verification_download, author_download  # noqa: F401
+
+    if not verbose:
+        # At the descriptor level, so the PDF worker processes are quiet too
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        started = time.perf_counter()
+        try:
+            result.pages = asyncio.run(run_entry(entry, config, entry_args))
+        except Exception as e:
+            result.error = f"{type(e).__name__}: {e}"
+        result.seconds = time.perf_counter() - started
+
+    result.requests = len(latencies) + sum(n for status, n in statuses.items() if not status.isdigit())
+    result.statuses = dict(statuses)
+    result.p50_ms = percentile(latencies, 50)
+    result.p99_ms = percentile(latencies, 99)
+    # ru_maxrss is in KB on Linux; the PDF workers are child processes
+    result.peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result.worker_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    results.put(asdict(result))
+
+def run_benchmark(entry: str, site: FakeSite, entry_args: List[str], verbose: bool) -> EntryResult:
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_in_child, args=(entry, site.config, site.port, entry_args, verbose, results))
+    process.start()
+    result = EntryResult(**results.get())
+    process.join()
+    return result
+
+def print_table(results: List[EntryResult]) -> None:
+    print(f"\n{'entry':<8} {'pages':>9} {'seconds':>8} {'pages/s':>8} {'req/page':>9} "
+          f"{'p50 ms':>7} {'p99 ms':>7} {'RSS MB':>7} {'workers':>7}  statuses")
+    for r in results:
+        statuses = ' '.join(f"{status}:{n}" for status, n in sorted(r.statuses.items()))
+        print(f"{r.entry:<8} {f'{r.pages}/{r.expected_pages}':>9} {r.seconds:8.2f} {r.pages_per_sec:8.1f} "
+              f"{r.requests_per_page:9.2f} {r.p50_ms:7.1f} {r.p99_ms:7.1f} {r.peak_rss_mb:7.1f} "
+              f"{r.worker_rss_mb:7.1f}  {statuses}")
+        if r.error:
+            print(f"  failed: {r.error}")
+
+def summary(result: EntryResult) -> Dict[str, float]:
+    return {metric: round(getattr(result, metric), 3) for metric in COMPARED_METRICS}
+
+def compare(results: List[EntryResult], baseline_path: str, tolerance: float) -> List[str]:
+    """
+    Compare against a --json file from an earlier run
+
+    :return: One line per metric that got worse by more than tolerance (a fraction)
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for result in results:
+        before = baseline.get(result.entry)
+        if not before:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = before[metric], getattr(result, metric)
+            if not old:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{result.entry} {metric}: {old:.2f} -> {new:.2f} ({change:+.0%})")
+        if result.pages < result.expected_pages:
+            regressions.append(f"{result.entry}: only {result.pages} of {result.expected_pages} pages")
+    return regressions
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Run the download entry points against a local stand-in for nhentai.xxx and its image "
+                    "servers, and report throughput, request counts, latency and memory"
+    )
+    parser.add_argument('entries', nargs='*', metavar='entry',
+                        help=f"entry points to run: {', '.join(ENTRIES)} (default: all)")
+    parser.add_argument('--galleries', type=int, default=4)
+    parser.add_argument('--pages', type=int, default=30, help="pages per gallery (default: %(default)s)")
+    parser.add_argument('--latency-ms', type=float, default=20.0,
+                        help="server latency per request (default: %(default)s)")
+    parser.add_argument('--jitter-ms', type=float, default=10.0,
+                        help="random extra latency up to this (default: %(default)s)")
+    parser.add_argument('--image-height', type=int, default=1200,
+                        help="height of the page images in pixels (default: %(default)s)")
+    parser.add_argument('--failing-mirrors', default='',
+                        help="comma-separated image servers answering 503, e.g. i2,i5")
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help="requests per second per host before the site answers 429 (default: no throttling)")
+    parser.add_argument('--search-results', type=int, default=100,
+                        help="galleries the search entry point finds, 25 per result page (default: %(default)s)")
+    parser.add_argument('--no-thumbnails', action='store_true',
+                        help="leave the thumbnails off gallery pages, so pages have to be probed")
+    parser.add_argument('--no-page-count', action='store_true',
+                        help="leave the page count off gallery pages, so the last page has to be searched for")
+    parser.add_argument('--entry-args', default='',
+                        help="extra command line options for the download scripts, e.g. \"--page-rate 0\"")
+    parser.add_argument('--json', metavar='PATH', help="write the results to this file")
+    parser.add_argument('--compare', metavar='PATH',
+                        help="compare with a --json file from an earlier run and exit with 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help="fraction a metric may get worse by before --compare fails (default: %(default)s)")
+    parser.add_argument('--verbose', action='store_true', help="show the entry points' own output")
+    args = parser.parse_args(argv)
+    unknown = [entry for entry in args.entries if entry not in ENTRIES]
+    if unknown:
+        parser.error(f"unknown entry points: {', '.join(unknown)} (choose from {', '.join(ENTRIES)})")
+    args.entries = args.entries or ENTRIES
+    return args
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    config = SiteConfig(
+        galleries=args.galleries,
+        pages=args.pages,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        image_height=args.image_height,
+        failing_mirrors=[m.strip() for m in args.failing_mirrors.split(',') if m.strip()],
+        throttle=args.throttle,
+        thumbnails=not args.no_thumbnails,
+        page_count=not args.no_page_count,
+        search_results=args.search_results
+    )
+    print(f"Stand-in site: {config}")
+
+    results = []
+    with FakeSite(config) as site:
+        for entry in args.entries:
+            print(f"Running {entry}...")
+            results.append(run_benchmark(entry, site, shlex.split(args.entry_args), args.verbose))
+    print_table(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'config': asdict(config),
+                'results': {r.entry: dict(asdict(r), **summary(r)) for r in results}
+            }, f, indent=1)
+        print(f"\nResults written to {args.json}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        if regressions:
+            print(f"\nRegressions against {args.compare}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nNo regressions against {args.compare} (tolerance {args.tolerance:.0%})")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
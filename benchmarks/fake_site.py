@@ -0,0 +1,241 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import io
+import re
+import time
+import random
+import threading
+import multiprocessing
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+MIRRORS = ['i1', 'i2', 'i3', 'i4', 'i5', 'i6']
+FIRST_GALLERY_ID = 500000
+RESULTS_PER_SEARCH_PAGE = 25
+
+# Example: /016/bench500000/12.jpg or /016/bench500000/12t.jpg
+IMAGE_PATH_RE = re.compile(r'^/016/bench(\d+)/(\d+)(t?)\.(\w+)$')
+
+@dataclass
+class SiteConfig:
+    """Data class to store what the stand-in site serves and how badly it behaves"""
+    galleries: int = 4
+    pages: int = 30
+    latency_ms: float = 20.0
+    jitter_ms: float = 10.0
+    image_height: int = 1200
+    # Mirrors answering everything with a 503
+    failing_mirrors: List[str] = field(default_factory=list)
+    # Requests per second per host before it answers 429, 0 for no throttling
+    throttle: float = 0.0
+    thumbnails: bool = True
+    page_count: bool = True
+    # Galleries listed by the search for 'bench', of which only the first `galleries` exist
+    search_results: int = 100
+
+def gallery_ids(config: SiteConfig) -> List[int]:
+    return [FIRST_GALLERY_ID + i for i in range(config.galleries)]
+
+def gallery_server(gallery_id: int) -> str:
+    """Mirror the gallery page's thumbnails point at"""
+    return MIRRORS[gallery_id % len(MIRRORS)]
+
+def page_extension(page: int) -> str:
+    """Mixed extensions, like real galleries: mostly JPEG, some PNG and WebP"""
+    if page % 5 == 0:
+        return 'png'
+    if page % 7 == 0:
+        return 'webp'
+    return 'jpg'
+
+def make_images(height: int) -> Dict[str, bytes]:
+    """One page image per extension, noisy enough that it doesn't compress to nothing"""
+    width = int(height * 0.7)
+    base = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    img = Image.blend(base, Image.effect_noise((width, height), 24).convert('RGB'), 0.35)
+    images = {}
+    for ext, fmt, options in (('jpg', 'JPEG', {'quality': 85}), ('png', 'PNG', {'compress_level': 1}),
+                              ('webp', 'WEBP', {'quality': 80})):
+        buffer = io.BytesIO()
+        img.save(buffer, fmt, **options)
+        images[ext] = buffer.getvalue()
+    return images
+
+def gallery_html(config: SiteConfig, gallery_id: int) -> str:
+    server = gallery_server(gallery_id)
+    base = f"https://{server}.nhentaimg.com/016/bench{gallery_id}"
+    thumbs = ''.join(
+        f'<a class="gallerythumb" href="/g/{gallery_id}/{page}/"><img class="lazyload" '
+        f'data-src="{base}/{page}t.{page_extension(page)}" src="/img/blank.gif" alt="Page {page}"></a>\n'
+        for page in range(1, config.pages + 1)
+    ) if config.thumbnails else ''
+    pages = (f'<li class="tags">Pages: <a class="tag"><span class="tag_name pages">{config.pages}</span></a></li>'
+             if config.page_count else '')
+    return f"""<!DOCTYPE html>
+<html><head><title>Benchmark gallery {gallery_id} - nhentai.xxx</title></head>
+<body>
+<div id="cover"><img class="lazyload" data-src="{base}/cover.jpg" src="/img/blank.gif"></div>
+<div id="info"><h1>Benchmark Gallery {gallery_id}</h1><ul>{pages}</ul></div>
+<div id="thumbnail-container">
+{thumbs}</div>
+</body></html>"""
+
+def search_html(config: SiteConfig, page: int) -> str:
+    ids = [FIRST_GALLERY_ID + i for i in range(config.search_results)]
+    last_page = max(1, -(-len(ids) // RESULTS_PER_SEARCH_PAGE))
+    listed = ids[(page - 1) * RESULTS_PER_SEARCH_PAGE:page * RESULTS_PER_SEARCH_PAGE]
+    items = ''.join(
+        f'<div class="gallery_item"><a href="/g/{gallery_id}/"><img class="lazyload" '
+        f'data-src="https://{gallery_server(gallery_id)}.nhentaimg.com/016/bench{gallery_id}/thumb.jpg">'
+        f'<div class="caption">Benchmark gallery {gallery_id}</div></a></div>\n'
+        for gallery_id in listed
+    )
+    links = ''.join(f'<a class="page" href="/search/?key=bench&page={n}">{n}</a>' for n in range(1, last_page + 1))
+    return f"""<!DOCTYPE html>
+<html><head><title>Search: bench - nhentai.xxx</title></head>
+<body>
+<div class="container index-container">
+{items}</div>
+<div class="pagination">{links}<a class="last" href="/search/?key=bench&page={last_page}">&raquo;</a></div>
+</body></html>"""
+
+class Throttle:
+    """Per-host token bucket deciding when the site answers 429"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.buckets: Dict[str, Tuple[float, float]] = {}
+        self.lock = threading.Lock()
+
+    def allow(self, host: str) -> bool:
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated = self.buckets.get(host, (self.rate, now))
+            tokens = min(self.rate, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            self.buckets[host] = (tokens - 1 if allowed else tokens, now)
+            return allowed
+
+class FakeSiteHandler(BaseHTTPRequestHandler):
+    """Serves nhentai.xxx and every iN.nhentaimg.com, told apart by the Host header"""
+    protocol_version = 'HTTP/1.1'
+    config: SiteConfig
+    images: Dict[str, bytes]
+    throttle: Throttle
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def send(self, status: int, body: bytes = b'', content_type: str = 'text/html; charset=utf-8',
+             headers: Optional[Dict[str, str]] = None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self) -> None:
+        self.do_GET()
+
+    def do_GET(self) -> None:
+        host = self.headers.get('Host', '').split(':')[0]
+        delay = self.config.latency_ms + random.uniform(0, self.config.jitter_ms)
+        time.sleep(delay / 1000)
+        if not self.throttle.allow(host):
+            self.send(429, headers={'Retry-After': '1'})
+        elif host == 'nhentai.xxx':
+            self.serve_site()
+        elif host.endswith('.nhentaimg.com'):
+            self.serve_image(host.split('.')[0])
+        else:
+            self.send(404)
+
+    def serve_site(self) -> None:
+        url = urlsplit(self.path)
+        match = re.match(r'^/g/(\d+)/?$', url.path)
+        if match and int(match.group(1)) in gallery_ids(self.config):
+            self.send(200, gallery_html(self.config, int(match.group(1))).encode())
+        elif url.path.rstrip('/') == '/search':
+            page = int(parse_qs(url.query).get('page', ['1'])[0])
+            self.send(200, search_html(self.config, page).encode())
+        else:
+            self.send(404)
+
+    def serve_image(self, server: str) -> None:
+        if server in self.config.failing_mirrors:
+            self.send(503)
+            return
+        match = IMAGE_PATH_RE.match(urlsplit(self.path).path)
+        if not match or int(match.group(1)) not in gallery_ids(self.config):
+            self.send(404)
+            return
+        page, ext = int(match.group(2)), match.group(4)
+        if not 1 <= page <= self.config.pages or ext != page_extension(page):
+            self.send(404)
+            return
+
+        body = self.images[ext]
+        content_type = 'image/jpeg' if ext == 'jpg' else f'image/{ext}'
+        requested = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if requested and int(requested.group(1)) < len(body):
+            start = int(requested.group(1))
+            self.send(206, body[start:], content_type,
+                      {'Content-Range': f'bytes {start}-{len(body) - 1}/{len(body)}'})
+        else:
+            self.send(200, body, content_type)
+
+def serve(config: SiteConfig, ready: 'multiprocessing.Queue') -> None:
+    """Run the site until the process is terminated, putting the port it listens on into ready"""
+    handler = type('Handler', (FakeSiteHandler,), {
+        'config': config,
+        'images': make_images(config.image_height),
+        'throttle': Throttle(config.throttle)
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+class FakeSite:
+    """The stand-in site in its own process, so its work and memory don't count against the downloader"""
+
+    def __init__(self, config: SiteConfig):
+        self.config = config
+        self.process: Optional[multiprocessing.Process] = None
+        self.port: Optional[int] = None
+
+    def __enter__(self) -> 'FakeSite':
+        context = multiprocessing.get_context('spawn')
+        ready = context.Queue()
+        self.process = context.Process(target=serve, args=(self.config, ready), daemon=True)
+        self.process.start()
+        self.port = ready.get(timeout=30)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.process.terminate()
+        self.process.join()
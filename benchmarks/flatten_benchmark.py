@@ -0,0 +1,93 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+from typing import List
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pdf_writer import write_pdf
+from project_asynchronous_verification_download import convert_to_pdf, needs_flattening
+
+def make_gallery(manga_dir: str, pages: int, width: int, height: int) -> List[str]:
+    """Write a gallery where every page is a transparent PNG"""
+    files = []
+    for page in range(1, pages + 1):
+        img = Image.radial_gradient('L').resize((width, height))
+        rgba = Image.merge('RGBA', (img, img.rotate(90), img.rotate(180), img.point(lambda v: 255 - v)))
+        path = os.path.join(manga_dir, f"{page:03d}.png")
+        rgba.save(path, compress_level=1)
+        files.append(path)
+    return files
+
+def convert_with_temp_files(manga_dir: str, image_files: List[str]) -> None:
+    """The previous convert_to_pdf: flatten one page at a time through _temp.jpg files"""
+    pdf_path = os.path.join(manga_dir, os.path.basename(manga_dir) + '.pdf')
+    rgb_images = []
+    temp_files = []
+    for img_path in image_files:
+        with Image.open(img_path) as img:
+            if needs_flattening(img):
+                img = img.convert('RGB')
+                temp_path = img_path + '_temp.jpg'
+                img.save(temp_path, 'JPEG', quality=95)
+                temp_files.append(temp_path)
+                rgb_images.append(temp_path)
+            else:
+                rgb_images.append(img_path)
+    write_pdf(pdf_path, rgb_images)
+    for temp_file in temp_files:
+        os.remove(temp_file)
+
+def best_of(repeat: int, fn, *args) -> float:
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare in-memory parallel flattening with the temp-file path")
+    parser.add_argument('--pages', type=int, default=40)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=1810)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        manga_dir = os.path.join(tmpdir, 'benchmark')
+        os.makedirs(manga_dir)
+        print(f"Generating {args.pages} transparent {args.width}x{args.height} PNG pages...")
+        files = make_gallery(manga_dir, args.pages, args.width, args.height)
+
+        temp_file_time = best_of(args.repeat, convert_with_temp_files, manga_dir, files)
+        in_memory_time = best_of(args.repeat, convert_to_pdf, manga_dir, files)
+
+    print(f"\nCPUs: {os.cpu_count()}")
+    print(f"Temp-file path:  {temp_file_time:.2f}s ({args.pages / temp_file_time:.1f} pages/s)")
+    print(f"In-memory pool:  {in_memory_time:.2f}s ({args.pages / in_memory_time:.1f} pages/s)")
+    print(f"Speedup:         {temp_file_time / in_memory_time:.2f}x")
+
+if __name__ == '__main__':
+    main()
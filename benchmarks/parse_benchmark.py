@@ -0,0 +1,91 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import time
+import argparse
+from typing import Callable, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gallery import find_gallery_images, find_title
+from author_download import parse_last_page, parse_search_results
+from page_parser import DEFAULT_BACKEND, GALLERY_TAGS, LISTING_TAGS, TagFilter, parse_html
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def read_gallery(html: str, backend: str, only: Optional[TagFilter]):
+    soup = parse_html(html, only, backend)
+    images = find_gallery_images(soup, verbose=False)
+    return find_title(soup, verbose=False), images.pattern, sorted(images.pages), images.page_count
+
+def read_search(html: str, backend: str, only: Optional[TagFilter]):
+    soup = parse_html(html, only, backend)
+    return parse_search_results(soup), parse_last_page(soup)
+
+def best_of(repeat: int, number: int, fn: Callable, *args) -> float:
+    """Best time per call in milliseconds"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn(*args)
+        times.append((time.perf_counter() - started) / number)
+    return min(times) * 1000
+
+def variants(only: TagFilter) -> List[Tuple[str, str, Optional[TagFilter]]]:
+    backends = ['html.parser'] + (['lxml'] if DEFAULT_BACKEND == 'lxml' else [])
+    result = []
+    for backend in backends:
+        result.append((f"{backend}, whole page", backend, None))
+        result.append((f"{backend}, filtered", backend, only))
+    return result
+
+def run(name: str, path: str, reader: Callable, only: TagFilter, repeat: int, number: int) -> None:
+    with open(path, encoding='utf-8') as f:
+        html = f.read()
+    print(f"\n{name}: {path} ({len(html) / 1024:.1f} KB)")
+
+    # The old code path is html.parser over the whole page; every variant must read the same values
+    expected = reader(html, 'html.parser', None)
+    baseline = None
+    for label, backend, strainer in variants(only):
+        if reader(html, backend, strainer) != expected:
+            print(f"  {label:<28} MISMATCH, skipped")
+            continue
+        ms = best_of(repeat, number, reader, html, backend, strainer)
+        baseline = baseline or ms
+        print(f"  {label:<28} {ms:7.2f} ms  {baseline / ms:5.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare HTML parser backends and filtered parsing on saved pages")
+    parser.add_argument('--gallery', default=os.path.join(FIXTURES_DIR, 'gallery.html'),
+                        help='Saved gallery page')
+    parser.add_argument('--search', default=os.path.join(FIXTURES_DIR, 'search.html'),
+                        help='Saved search result page')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=20)
+    args = parser.parse_args()
+
+    if DEFAULT_BACKEND != 'lxml':
+        print("lxml is not installed, only html.parser is compared")
+    run('Gallery page', args.gallery, read_gallery, GALLERY_TAGS, args.repeat, args.number)
+    run('Search page', args.search, read_search, LISTING_TAGS, args.repeat, args.number)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+from bs4 import BeautifulSoup
+
+from http_session import PAGE_HEADERS
+from page_parser import GALLERY_TAGS, parse_html
+
+# Example: http://i4.nhentaimg.com/016/y3v5c6xhgf/cover.jpg
+PATTERN_RE = re.compile(r'i\d\.nhentaimg\.com/(\d+/[a-zA-Z0-9]+)/')
+
+# Example: https://i4.nhentaimg.com/016/y3v5c6xhgf/12t.png
+THUMBNAIL_RE = re.compile(
+    r'(https?)://(i\d)\.nhentaimg\.com/(\d+/[a-zA-Z0-9]+)/(\d+)t\.(jpg|jpeg|png|webp|gif)',
+    re.IGNORECASE
+)
+
+PAGE_COUNT_RE = re.compile(r'Pages:?\s*(\d+)', re.IGNORECASE)
+
+TITLE_SELECTORS = [
+    'div#info > h1',
+    'div#info h1',
+    'h1',
+    'div.title',
+    'h2.title'
+]
+
+@dataclass
+class ImagePattern:
+    """Data class to store image pattern information"""
+    pattern: str
+    base_dir: str
+
+@dataclass
+class ThumbnailPage:
+    """Data class to store a full-size page URL derived from its thumbnail"""
+    page_num: int
+    url: str
+    server: str
+    extension: str
+
+@dataclass
+class GalleryImages:
+    """Data class to store everything the gallery HTML tells us about its images"""
+    pattern: Optional[ImagePattern] = None
+    pages: Dict[int, ThumbnailPage] = field(default_factory=dict)
+    page_count: Optional[int] = None
+
+    @property
+    def last_page(self) -> int:
+        """Last page number known from metadata or thumbnails, 0 if unknown"""
+        return self.page_count or max(self.pages, default=0)
+
+    @property
+    def missing_pages(self):
+        """Pages within last_page that have no thumbnail"""
+        return [page for page in range(1, self.last_page + 1) if page not in self.pages]
+
+@dataclass
+class GalleryMetadata:
+    """Data class to store everything read from a gallery page, fetched and parsed once per download"""
+    url: str
+    title: str
+    images: GalleryImages
+
+def find_page_count(soup: BeautifulSoup) -> Optional[int]:
+    """Read the page count from the gallery info block, if present"""
+    element = soup.select_one('span.pages, .tag_name.pages')
+    if element and element.get_text(strip=True).isdigit():
+        return int(element.get_text(strip=True))
+
+    info = soup.select_one('#info')
+    if info:
+        match = PAGE_COUNT_RE.search(info.get_text(' ', strip=True))
+        if match:
+            return int(match.group(1))
+    return None
+
+def find_title(soup: BeautifulSoup, verbose: bool = True) -> str:
+    """Find the gallery title, falling back to the first text of the #info block"""
+    for selector in TITLE_SELECTORS:
+        element = soup.select_one(selector)
+        if element:
+            if verbose:
+                print(f"Found element with selector '{selector}': {element.text.strip()}")
+            return element.text.strip()
+
+    info = soup.select_one('#info')
+    if info:
+        title = info.get_text(strip=True).split('\n')[0]
+        if verbose:
+            print(f"Using fallback title from #info: {title}")
+        return title
+    return ''
+
+def parse_gallery_images(html: str, verbose: bool = True) -> GalleryImages:
+    """
+    Parse the image pattern, per-page URLs and page count from a gallery page
+
+    Page thumbnails (``{page}t.{ext}``) share the directory and extension of the
+    full-size image, so every page with a thumbnail is resolved without probing.
+    """
+    return find_gallery_images(parse_html(html, GALLERY_TAGS), verbose)
+
+def find_gallery_images(soup: BeautifulSoup, verbose: bool = True) -> GalleryImages:
+    """Like parse_gallery_images, for an already parsed gallery page"""
+    if verbose:
+        print("\nLooking for thumbnails...")
+    thumbs = soup.find_all('img', class_='lazyload')
+
+    patterns = []
+    base_dirs = set()
+    thumbnail_pages = []
+
+    for thumb in thumbs:
+        if 'data-src' in thumb.attrs:
+            src = thumb['data-src']
+            if verbose:
+                print(f"Found thumbnail: {src}")
+
+            match = PATTERN_RE.search(src)
+            if match:
+                pattern = match.group(1)
+                base_dir = pattern.split('/')[0]
+                base_dirs.add(base_dir)
+                patterns.append(pattern)
+                if verbose:
+                    print(f"Found pattern: {pattern}")
+
+            match = THUMBNAIL_RE.search(src)
+            if match:
+                scheme, server, path, page, ext = match.groups()
+                ext = '.' + ext.lower()
+                thumbnail_pages.append(ThumbnailPage(
+                    int(page),
+                    f"{scheme}://{server}.nhentaimg.com/{path}/{page}{ext}",
+                    server,
+                    ext
+                ))
+
+    if not patterns:
+        return GalleryImages()
+
+    # Only trust thumbnails that belong to the gallery's own image directory
+    pattern = ImagePattern(patterns[0], list(base_dirs)[0])
+    pages = {}
+    for page in thumbnail_pages:
+        if f"/{pattern.pattern}/" in page.url:
+            pages.setdefault(page.page_num, page)
+
+    return GalleryImages(pattern, pages, find_page_count(soup))
+
+def parse_gallery(url: str, html: str, verbose: bool = True) -> GalleryMetadata:
+    """Parse the title and images of a gallery page in a single pass"""
+    soup = parse_html(html, GALLERY_TAGS)
+    return GalleryMetadata(url, find_title(soup, verbose), find_gallery_images(soup, verbose))
+
+async def fetch_gallery(client, url: str, verbose: bool = True) -> GalleryMetadata:
+    """
+    Fetch and parse a gallery page
+
+    :param client: HttpSession or httpx.AsyncClient
+    """
+    print(f"Fetching gallery page: {url}")
+    response = await client.get(url, headers=PAGE_HEADERS)
+    response.raise_for_status()
+    return parse_gallery(url, response.text, verbose)
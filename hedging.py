@@ -0,0 +1,122 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Deque, Optional, TypeVar
+
+T = TypeVar('T')
+
+DEFAULT_HEDGE_PERCENTILE = 95
+DEFAULT_HEDGE_BUDGET = 0.05
+DEFAULT_LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+
+class HedgePolicy:
+    """
+    When to send a duplicate request, and how many of them we can afford
+
+    A request still running after the given percentile of recent request times
+    gets a hedge. Every request adds `budget` to the allowance and every hedge
+    spends 1 from it, so hedges stay under that share of all requests.
+    """
+
+    def __init__(
+        self,
+        percentile: float = DEFAULT_HEDGE_PERCENTILE,
+        budget: float = DEFAULT_HEDGE_BUDGET,
+        window: int = DEFAULT_LATENCY_WINDOW,
+        min_samples: int = MIN_LATENCY_SAMPLES
+    ):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.allowance = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def delay(self) -> Optional[float]:
+        """Seconds to wait before hedging, None until enough requests have been timed"""
+        if len(self.latencies) < self.min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return ordered[index]
+
+    def record(self, seconds: float) -> None:
+        self.latencies.append(seconds)
+
+    def start_request(self) -> None:
+        self.requests += 1
+        self.allowance = min(self.allowance + self.budget, 1.0 + self.budget)
+
+    def try_hedge(self) -> bool:
+        """Spend the allowance on one hedge, if there is enough of it"""
+        if self.allowance < 1.0:
+            return False
+        self.allowance -= 1.0
+        self.hedges += 1
+        return True
+
+    def summary(self) -> str:
+        share = self.hedges / self.requests * 100 if self.requests else 0.0
+        return (f"Hedged {self.hedges} of {self.requests} page requests ({share:.1f}%), "
+                f"the hedge finished first {self.hedge_wins} times")
+
+async def hedged(
+    policy: HedgePolicy,
+    primary: Callable[[], Awaitable[T]],
+    hedge: Optional[Callable[[], Awaitable[T]]] = None
+) -> T:
+    """
+    Run primary; if it outlasts the policy's delay, race a hedge against it
+
+    The first of the two to succeed wins and the other is cancelled. If one
+    fails, the other is still awaited; if both fail, the primary's error is raised.
+
+    :param primary: Coroutine function making the request
+    :param hedge: Coroutine function making the same request another way (another mirror or scheme)
+    """
+    policy.start_request()
+    started = time.monotonic()
+    first = asyncio.ensure_future(primary())
+    tasks = {first}
+    try:
+        delay = policy.delay() if hedge else None
+        if delay is not None:
+            await asyncio.wait(tasks, timeout=delay)
+            if not first.done() and policy.try_hedge():
+                tasks.add(asyncio.ensure_future(hedge()))
+
+        while True:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    policy.record(time.monotonic() - started)
+                    if task is not first:
+                        policy.hedge_wins += 1
+                    return task.result()
+            tasks -= done
+            if not tasks:
+                return first.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,157 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import httpx
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+from adaptive_limit import HostLimits
+from mirror_pool import MirrorPool
+from rate_limiter import RateLimiter, RateLimitedTransport
+
+# Browser headers for image and HTML page requests ('Host' is updated per request)
+IMAGE_HEADERS = {
+    'Accept': 'image/avif,image/webp,image/png,image/svg+xml,image/*;q=0.8,*/*;q=0.5',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Connection': 'keep-alive',
+    'DNT': '1',
+    'Host': 'i4.nhentaimg.com',
+    'Sec-Fetch-Dest': 'image',
+    'Sec-Fetch-Mode': 'no-cors',
+    'Sec-Fetch-Site': 'cross-site',
+    'Sec-GPC': '1',
+    'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:133.0) Gecko/20100101 Firefox/133',
+    'X-Firefox-Spdy': 'h2'
+}
+
+PAGE_HEADERS = {
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Connection': 'keep-alive',
+    'DNT': '1',
+    'Host': 'nhentai.xxx',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+    'Sec-Fetch-User': '?1',
+    'Sec-GPC': '1',
+    'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:133.0) Gecko/20100101 Firefox/133',
+    'Upgrade-Insecure-Requests': '1'
+}
+
+DEFAULT_MAX_CONNECTIONS = 64
+DEFAULT_MAX_PER_HOST = 16
+DEFAULT_KEEPALIVE_EXPIRY = 60.0
+DEFAULT_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+
+# Starting points for the adaptive limits; they grow from here while the server keeps up
+INITIAL_VERIFY_CONCURRENCY = 8
+INITIAL_DOWNLOAD_CONCURRENCY = 4
+
+class HttpSession:
+    """
+    One tuned httpx.AsyncClient shared by every request in the process
+
+    Connections (and their TLS/HTTP/2 handshakes) are reused across galleries,
+    search pages and image servers. Requests are also capped per host so one
+    busy mirror can't take every connection in the pool.
+
+    Image verification and downloads each get an AdaptiveLimit per image
+    server, shared by every gallery using the session, so what one gallery
+    learns about a server carries over to the next. They never go above the
+    per-host cap. The MirrorPool likewise keeps each image mirror's health for
+    the whole session.
+    
+    Every request, redirects included, first waits on the RateLimiter's bucket
+    for its host. Closing the session closes the limiter too.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        max_per_host: int = DEFAULT_MAX_PER_HOST,
+        keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY,
+        timeout: httpx.Timeout = DEFAULT_TIMEOUT,
+        retries: int = 3,
+        http2: bool = True,
+        rate_limiter: Optional[RateLimiter] = None
+    ):
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        # Pool settings have to go on the transport; httpx ignores them on the client when one is given
+        transport = httpx.AsyncHTTPTransport(
+            verify=False,
+            http2=http2,
+            limits=limits,
+            retries=retries
+        )
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.client = httpx.AsyncClient(
+            transport=RateLimitedTransport(transport, self.rate_limiter),
+            timeout=timeout,
+            follow_redirects=True
+        )
+        self.max_per_host = max_per_host
+        self.host_slots: Dict[str, asyncio.Semaphore] = {}
+        self.verify_limits = HostLimits('verification', INITIAL_VERIFY_CONCURRENCY, max_limit=max_per_host)
+        self.download_limits = HostLimits('download', INITIAL_DOWNLOAD_CONCURRENCY, max_limit=max_per_host)
+        self.mirrors = MirrorPool()
+
+    def host_slot(self, url: str) -> asyncio.Semaphore:
+        """Get the semaphore limiting concurrent requests to the URL's host"""
+        host = httpx.URL(url).host
+        if host not in self.host_slots:
+            self.host_slots[host] = asyncio.Semaphore(self.max_per_host)
+        return self.host_slots[host]
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        async with self.host_slot(url):
+            return await self.client.get(url, **kwargs)
+
+    async def head(self, url: str, **kwargs) -> httpx.Response:
+        async with self.host_slot(url):
+            return await self.client.head(url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        async with self.host_slot(url):
+            async with self.client.stream(method, url, **kwargs) as response:
+                yield response
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+        # Waits for a reservation still running on the limiter's thread
+        await asyncio.to_thread(self.rate_limiter.close)
+
+    async def __aenter__(self) -> 'HttpSession':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+@asynccontextmanager
+async def use_session(session: Optional[HttpSession] = None) -> AsyncIterator[HttpSession]:
+    """Use the given session, or a temporary one that is closed afterwards"""
+    if session is not None:
+        yield session
+    else:
+        async with HttpSession() as temporary:
+            yield temporary
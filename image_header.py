@@ -0,0 +1,152 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import struct
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import BinaryIO, Optional, Tuple, Union
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# SOF markers carry the frame size; C4 (DHT), C8 (JPG) and CC (DAC) share the range but don't
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+JPEG_STANDALONE_MARKERS = set(range(0xD0, 0xD8)) | {0x01}
+
+@dataclass
+class ImageHeader:
+    """Data class to store what an image's header says without decoding its pixels"""
+    format: str
+    width: int
+    height: int
+    has_alpha: bool
+    components: Optional[int] = None
+    dpi: Optional[Tuple[float, float]] = None
+    adobe: bool = False
+
+def open_source(source: Union[str, BinaryIO]):
+    """Open a path for reading, or rewind an already open file without closing it afterwards"""
+    if isinstance(source, str):
+        return open(source, 'rb')
+    source.seek(0)
+    return nullcontext(source)
+
+def read_exact(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) < size:
+        raise EOFError
+    return data
+
+def sniff_jpeg(f: BinaryIO) -> Optional[ImageHeader]:
+    """Walk the JPEG markers up to the frame header (SOF)"""
+    dpi = None
+    adobe = False
+    while True:
+        if read_exact(f, 1) != b'\xff':
+            return None
+        marker = read_exact(f, 1)[0]
+        while marker == 0xFF:  # Fill bytes
+            marker = read_exact(f, 1)[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (0xD9, 0xDA):  # EOI or SOS before any frame header
+            return None
+
+        length = struct.unpack('>H', read_exact(f, 2))[0]
+        segment = read_exact(f, length - 2)
+        if marker in JPEG_SOF_MARKERS:
+            _, height, width, components = struct.unpack('>BHHB', segment[:6])
+            if not height or not width:
+                return None
+            return ImageHeader('JPEG', width, height, False, components, dpi, adobe)
+        if marker == 0xE0 and segment.startswith(b'JFIF\x00') and len(segment) >= 12:
+            units, x, y = struct.unpack('>BHH', segment[7:12])
+            if units == 1:
+                dpi = (float(x), float(y))
+            elif units == 2:
+                dpi = (x * 2.54, y * 2.54)
+        elif marker == 0xEE and segment.startswith(b'Adobe'):
+            adobe = True
+
+def sniff_png(f: BinaryIO) -> Optional[ImageHeader]:
+    """Read IHDR, then the chunks before the image data for tRNS and pHYs"""
+    length, chunk_type = struct.unpack('>I4s', read_exact(f, 8))
+    if chunk_type != b'IHDR':
+        return None
+    width, height, _, color_type = struct.unpack('>IIBB', read_exact(f, length)[:10])
+    f.seek(4, 1)
+
+    has_trns = False
+    dpi = None
+    while True:
+        length, chunk_type = struct.unpack('>I4s', read_exact(f, 8))
+        if chunk_type in (b'IDAT', b'IEND'):
+            break
+        if chunk_type == b'tRNS':
+            has_trns = True
+        if chunk_type == b'pHYs':
+            x, y, unit = struct.unpack('>IIB', read_exact(f, 9))
+            if unit == 1:
+                dpi = (x * 0.0254, y * 0.0254)
+            f.seek(length - 9 + 4, 1)
+        else:
+            f.seek(length + 4, 1)
+
+    # Greyscale/truecolour with alpha, or a palette with transparent entries
+    has_alpha = color_type in (4, 6) or (color_type == 3 and has_trns)
+    return ImageHeader('PNG', width, height, has_alpha, dpi=dpi)
+
+def sniff_webp(f: BinaryIO) -> Optional[ImageHeader]:
+    """Read the first chunk of a WebP: VP8X flags, VP8L alpha hint or a plain VP8 frame"""
+    chunk_type, _ = struct.unpack('<4sI', read_exact(f, 8))
+    data = read_exact(f, 10) if chunk_type in (b'VP8X', b'VP8 ') else read_exact(f, 5)
+    if chunk_type == b'VP8X':
+        has_alpha = bool(data[0] & 0x10)
+        width = int.from_bytes(data[4:7], 'little') + 1
+        height = int.from_bytes(data[7:10], 'little') + 1
+        return ImageHeader('WEBP', width, height, has_alpha)
+    if chunk_type == b'VP8L':
+        if data[0] != 0x2F:
+            return None
+        bits = int.from_bytes(data[1:5], 'little')
+        return ImageHeader('WEBP', (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, bool(bits >> 28 & 1))
+    if chunk_type == b'VP8 ':
+        if data[3:6] != b'\x9d\x01\x2a':
+            return None
+        width, height = struct.unpack('<HH', data[6:10])
+        return ImageHeader('WEBP', width & 0x3FFF, height & 0x3FFF, False)
+    return None
+
+def sniff_image(source: Union[str, BinaryIO]) -> Optional[ImageHeader]:
+    """
+    Read an image's format, size and whether it has alpha from its header alone
+
+    :return: ImageHeader, or None if the format isn't recognised and PIL has to look
+    """
+    try:
+        with open_source(source) as f:
+            magic = f.read(12)
+            if magic.startswith(b'\xff\xd8'):
+                f.seek(2)
+                return sniff_jpeg(f)
+            if magic.startswith(PNG_SIGNATURE):
+                f.seek(8)
+                return sniff_png(f)
+            if magic[:4] == b'RIFF' and magic[8:12] == b'WEBP':
+                return sniff_webp(f)
+    except (EOFError, struct.error):
+        pass
+    return None
@@ -0,0 +1,97 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import threading
+
+STORE_DIR = '.store'
+LINK_SUFFIX = '.link'
+
+class ImageStore:
+    """
+    Content-addressed store of page images, hardlinked into every gallery that uses them
+
+    Each distinct image is kept once, as root/ab/abcdef... named after its
+    SHA-256, and every page with that content is a hardlink to it. Re-uploads
+    and translations sharing page images then take the disk space of one copy.
+    The root has to be on the same filesystem as the galleries; where
+    hardlinks can't be made, pages are kept as plain files.
+
+    Linked pages share one inode, so they must never be modified in place.
+    Nothing here does: pages are only ever replaced by renaming a new file over them.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.stored = 0
+        self.deduplicated = 0
+        self.saved_bytes = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def in_download_dir(cls, download_dir: str) -> 'ImageStore':
+        return cls(os.path.join(download_dir, STORE_DIR))
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def commit(self, tmp_path: str, filepath: str, digest: str, size: int) -> None:
+        """
+        Move a finished temp file to filepath, as a hardlink to the store's copy of its content
+
+        The first file with a digest becomes the stored copy; later ones are
+        dropped in favour of a link to it. Blocking; meant for a worker thread.
+        """
+        blob = self.blob_path(digest)
+        link_path = filepath + LINK_SUFFIX
+        try:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                # Linking rather than renaming makes creating the blob atomic, even with the same page in flight twice
+                os.link(tmp_path, blob)
+                new = True
+            except FileExistsError:
+                new = False
+            if os.path.lexists(link_path):
+                os.remove(link_path)
+            os.link(blob, link_path)
+            os.replace(link_path, filepath)
+        except OSError as e:
+            print(f"Could not link {os.path.basename(filepath)} into the image store, keeping a copy: {e}")
+            os.replace(tmp_path, filepath)
+            return
+        os.remove(tmp_path)
+
+        with self.lock:
+            if new:
+                self.stored += 1
+            else:
+                self.deduplicated += 1
+                self.saved_bytes += size
+
+    def library_savings(self) -> int:
+        """Bytes saved across every gallery linked to the store: each blob's size for every extra page using it"""
+        saved = 0
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                # One link is the store's own, one is the first page using it
+                saved += st.st_size * max(0, st.st_nlink - 2)
+        return saved
@@ -0,0 +1,192 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import json
+import asyncio
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional
+
+MANIFEST_NAME = 'manifest.json'
+
+PENDING = 'pending'
+PARTIAL = 'partial'
+COMPLETE = 'complete'
+
+# Seconds changes may wait before they are saved; a crash in between only costs re-downloading those pages
+SAVE_DELAY = 1.0
+
+@dataclass
+class ManifestEntry:
+    """Data class to store the download state of one page"""
+    page_num: int
+    url: str
+    filename: str
+    size: Optional[int] = None
+    status: str = PENDING
+
+class GalleryManifest:
+    """
+    Per-gallery record of resolved URLs and download progress, kept in manga_dir
+
+    A re-run of an interrupted download reads it to skip pages that are already
+    complete on disk, resume partial ones with a Range request, and skip URL
+    resolution entirely once every page's URL is known.
+
+    Inside an event loop, changes are batched and saved by a background task
+    at most every save_delay seconds, off the loop; flush() saves what is
+    left. Outside one, every change is saved right away.
+    """
+
+    def __init__(self, manga_dir: str, manga_id: Optional[str] = None, save_delay: float = SAVE_DELAY):
+        self.manga_dir = manga_dir
+        self.manga_id = manga_id
+        self.page_count: Optional[int] = None
+        self.pages: Dict[int, ManifestEntry] = {}
+        self.save_delay = save_delay
+        self.dirty = False
+        self.save_task: Optional[asyncio.Task] = None
+        self.flush_requested: Optional[asyncio.Event] = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.manga_dir, MANIFEST_NAME)
+
+    @classmethod
+    def load(cls, manga_dir: str, manga_id: Optional[str] = None) -> 'GalleryManifest':
+        """Load the manifest from manga_dir, or start an empty one if missing or unreadable"""
+        manifest = cls(manga_dir, manga_id)
+        try:
+            with open(manifest.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return manifest
+
+        if manga_id and data.get('manga_id') not in (None, manga_id):
+            print(f"Ignoring manifest for another gallery in {manga_dir}")
+            return manifest
+
+        manifest.page_count = data.get('page_count')
+        for page, entry in data.get('pages', {}).items():
+            manifest.pages[int(page)] = ManifestEntry(**entry)
+        return manifest
+
+    def snapshot(self) -> str:
+        return json.dumps({
+            'manga_id': self.manga_id,
+            'page_count': self.page_count,
+            'pages': {str(page): asdict(entry) for page, entry in sorted(self.pages.items())}
+        }, indent=1)
+
+    def write(self, text: str) -> None:
+        """Write a snapshot atomically so an interrupted save can't corrupt the manifest"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, self.path)
+
+    def save(self) -> None:
+        """Write the manifest now"""
+        self.dirty = False
+        self.write(self.snapshot())
+
+    def changed(self) -> None:
+        """Save a change, batched with the ones after it when running in an event loop"""
+        self.dirty = True
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        if self.save_task is None or self.save_task.done():
+            self.flush_requested = asyncio.Event()
+            self.save_task = asyncio.create_task(self.save_later())
+
+    async def save_later(self) -> None:
+        # The only writer while it runs, so saves never overlap or land out of order
+        try:
+            await asyncio.wait_for(self.flush_requested.wait(), self.save_delay)
+        except asyncio.TimeoutError:
+            pass
+        while self.dirty:
+            self.dirty = False
+            # Serialized on the loop, where the pages are changed, and written from a thread
+            await asyncio.to_thread(self.write, self.snapshot())
+
+    async def flush(self) -> None:
+        """Save any batched changes now and wait until they are on disk"""
+        if self.save_task is not None and not self.save_task.done():
+            self.flush_requested.set()
+            await self.save_task
+        elif self.dirty:
+            self.dirty = False
+            await asyncio.to_thread(self.write, self.snapshot())
+
+    def filepath(self, page_num: int) -> str:
+        return os.path.join(self.manga_dir, self.pages[page_num].filename)
+
+    def set_urls(self, image_urls: Dict[int, str], page_count: Optional[int] = None) -> None:
+        """Record resolved URLs, resetting pages whose URL changed"""
+        for page_num, url in image_urls.items():
+            entry = self.pages.get(page_num)
+            if entry is None or entry.url != url:
+                ext = os.path.splitext(url)[1] or '.webp'
+                self.pages[page_num] = ManifestEntry(page_num, url, f"{page_num:03d}{ext}")
+        if page_count:
+            self.page_count = page_count
+        self.changed()
+
+    def forget(self, page_num: int) -> None:
+        """Drop a page's URL (e.g. after a 404) so the next run resolves it again"""
+        if self.pages.pop(page_num, None) is not None:
+            self.changed()
+
+    def mark_partial(self, page_num: int, url: str, filename: str, size: Optional[int]) -> None:
+        """Record that a page download has started, with its expected size if known"""
+        self.pages[page_num] = ManifestEntry(page_num, url, filename, size, PARTIAL)
+        self.changed()
+
+    def mark_complete(self, page_num: int, size: int) -> None:
+        entry = self.pages[page_num]
+        entry.size = size
+        entry.status = COMPLETE
+        self.changed()
+
+    def can_resume(self, page_num: int, url: str) -> bool:
+        """Whether a partial file on disk was started from this same URL"""
+        entry = self.pages.get(page_num)
+        return entry is not None and entry.url == url and entry.status == PARTIAL
+
+    def is_complete(self, page_num: int) -> bool:
+        """Whether a page is marked complete and its file is on disk with the expected size"""
+        entry = self.pages.get(page_num)
+        if entry is None or entry.status != COMPLETE:
+            return False
+        try:
+            size = os.path.getsize(self.filepath(page_num))
+        except OSError:
+            return False
+        return entry.size is None or size == entry.size
+
+    def completed_files(self) -> List[str]:
+        return [self.filepath(page) for page in sorted(self.pages) if self.is_complete(page)]
+
+    def resolved_urls(self) -> Optional[Dict[int, str]]:
+        """Every page's URL if the whole gallery has been resolved before, otherwise None"""
+        if not self.page_count or any(page not in self.pages for page in range(1, self.page_count + 1)):
+            return None
+        return {page: self.pages[page].url for page in range(1, self.page_count + 1)}
@@ -0,0 +1,200 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import re
+import time
+import asyncio
+import httpx
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional
+
+from adaptive_limit import is_overload
+
+DEFAULT_FAILURE_LIMIT = 3
+DEFAULT_BENCH_TIME = 30.0
+DEFAULT_SLOW_FACTOR = 3.0
+
+# Weight of the newest sample in a mirror's latency average
+LATENCY_WEIGHT = 0.3
+
+# Example: https://i4.nhentaimg.com/016/y3v5c6xhgf/12.jpg
+MIRROR_HOST_RE = re.compile(r'^(\w+://)(i\d+)(\.nhentaimg\.com/)')
+
+def mirror_server(url: str) -> str:
+    """Image server name ('i4') of an image URL"""
+    return httpx.URL(url).host.split('.')[0]
+
+def mirror_url(url: str, server: str) -> str:
+    """The same image on another mirror"""
+    return MIRROR_HOST_RE.sub(lambda m: f"{m.group(1)}{server}{m.group(3)}", url, count=1)
+
+def gallery_key(url: str) -> str:
+    """Image directory of a gallery ('/016/y3v5c6xhgf'), the same on every mirror"""
+    return httpx.URL(url).path.rsplit('/', 1)[0]
+
+@dataclass
+class MirrorStats:
+    """Data class to store what one image mirror has shown so far"""
+    latency: Optional[float] = None
+    failures: int = 0
+    benched_until: float = 0.0
+    in_flight: int = 0
+
+class MirrorPool:
+    """
+    Health and latency of every image mirror, shared by all galleries in a session
+
+    Requests go to the mirror with the shortest expected wait (latency times
+    requests already in flight). A mirror that fails failure_limit times in a
+    row (429, 5xx, timeouts, connection errors) or answers slow_factor times
+    slower than the fastest one is taken out of rotation for bench_time
+    seconds, then measured afresh.
+    """
+
+    def __init__(
+        self,
+        failure_limit: int = DEFAULT_FAILURE_LIMIT,
+        bench_time: float = DEFAULT_BENCH_TIME,
+        slow_factor: float = DEFAULT_SLOW_FACTOR
+    ):
+        self.failure_limit = failure_limit
+        self.bench_time = bench_time
+        self.slow_factor = slow_factor
+        self.stats: Dict[str, MirrorStats] = {}
+        self.galleries: Dict[str, List[str]] = {}
+
+    def get(self, server: str) -> MirrorStats:
+        if server not in self.stats:
+            self.stats[server] = MirrorStats()
+        return self.stats[server]
+
+    def is_benched(self, server: str, now: Optional[float] = None) -> bool:
+        return self.get(server).benched_until > (now if now is not None else time.monotonic())
+
+    def fastest_latency(self, exclude: Optional[str] = None) -> Optional[float]:
+        now = time.monotonic()
+        latencies = [
+            stats.latency for server, stats in self.stats.items()
+            if server != exclude and stats.latency is not None and not self.is_benched(server, now)
+        ]
+        return min(latencies, default=None)
+
+    def rotation(self, servers: List[str]) -> List[str]:
+        """
+        Order a gallery's mirrors for the next request
+
+        :return: Mirrors in rotation, shortest expected wait first, then benched ones as a last resort
+        """
+        now = time.monotonic()
+        # Mirrors not measured yet are assumed to be as fast as the best one, so they get tried
+        fallback = self.fastest_latency() or 0.0
+
+        def expected_wait(server: str) -> float:
+            stats = self.get(server)
+            latency = stats.latency if stats.latency is not None else fallback
+            return latency * (stats.in_flight + 1)
+
+        active = sorted((s for s in servers if not self.is_benched(s, now)), key=expected_wait)
+        benched = sorted((s for s in servers if self.is_benched(s, now)), key=lambda s: self.get(s).benched_until)
+        return active + benched
+
+    def bench(self, server: str, reason: str) -> None:
+        stats = self.get(server)
+        stats.benched_until = time.monotonic() + self.bench_time
+        stats.failures = 0
+        stats.latency = None
+        print(f"Taking mirror {server} out of rotation for {self.bench_time:.0f}s ({reason})")
+
+    @contextmanager
+    def busy(self, server: str) -> Iterator[None]:
+        """Count a request to server as in flight while the block runs"""
+        stats = self.get(server)
+        stats.in_flight += 1
+        try:
+            yield
+        finally:
+            stats.in_flight -= 1
+
+    def observe(self, server: str, started: float, status: Optional[int] = None,
+                error: Optional[BaseException] = None) -> None:
+        """
+        Feed back one request to a mirror; a 404 only means the file isn't there and says nothing about health
+
+        :param started: time.monotonic() when the request was sent
+        """
+        stats = self.get(server)
+        if is_overload(status, error) or isinstance(error, httpx.TransportError):
+            stats.failures += 1
+            if stats.failures >= self.failure_limit:
+                self.bench(server, f"{stats.failures} failures in a row")
+            return
+        if status is None or status >= 400:
+            return
+
+        latency = time.monotonic() - started
+        stats.failures = 0
+        if stats.latency is None:
+            stats.latency = latency
+        else:
+            stats.latency += (latency - stats.latency) * LATENCY_WEIGHT
+
+        fastest = self.fastest_latency(exclude=server)
+        if fastest and stats.latency > fastest * self.slow_factor:
+            self.bench(server, f"{stats.latency * 1000:.0f}ms vs {fastest * 1000:.0f}ms on the fastest mirror")
+
+    async def gallery_servers(
+        self,
+        client,
+        sample_url: str,
+        servers: List[str],
+        headers: Dict[str, str],
+        timeout: Optional[httpx.Timeout] = None
+    ) -> List[str]:
+        """
+        Find the mirrors that have a gallery by asking each for one page known to exist (once per gallery)
+
+        :param client: HttpSession or httpx.AsyncClient
+        :param sample_url: Image URL of the gallery that is known to work
+        :param servers: Every image server
+        :param timeout: Timeout for the checks, the client's own if not given
+        :return: Mirrors serving the gallery, always including the sample URL's own
+        """
+        key = gallery_key(sample_url)
+        if key in self.galleries:
+            return self.galleries[key]
+
+        own = mirror_server(sample_url)
+        kwargs = {'timeout': timeout} if timeout is not None else {}
+
+        async def check(server: str) -> bool:
+            url = mirror_url(sample_url, server)
+            started = time.monotonic()
+            try:
+                response = await client.head(url, headers=dict(headers, Host=httpx.URL(url).host), **kwargs)
+            except Exception as e:
+                self.observe(server, started, error=e)
+                return False
+            self.observe(server, started, response.status_code)
+            return response.status_code == 200
+
+        others = [s for s in servers if s != own]
+        found = await asyncio.gather(*[check(s) for s in others])
+        self.galleries[key] = [own] + [s for s, ok in zip(others, found) if ok]
+        if len(self.galleries[key]) > 1:
+            print(f"Spreading pages over mirrors: {', '.join(self.galleries[key])}")
+        return self.galleries[key]
@@ -0,0 +1,86 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import re
+from typing import Callable, Dict, Optional
+from bs4 import BeautifulSoup, SoupStrainer
+
+# lxml builds the same BeautifulSoup tree several times faster; html.parser needs nothing installed
+try:
+    import lxml  # noqa: F401
+    DEFAULT_BACKEND = 'lxml'
+except ImportError:
+    DEFAULT_BACKEND = 'html.parser'
+
+GALLERY_LINK_RE = re.compile(r'/g/\d+')
+
+def has_class(attrs: Dict[str, str], name: str) -> bool:
+    """Check a class while parsing, before BeautifulSoup has split the attribute into a list"""
+    value = attrs.get('class') or ''
+    if isinstance(value, str):
+        value = value.split()
+    return name in value
+
+def is_gallery_tag(name: str, attrs: Dict[str, str]) -> bool:
+    """The #info block, the title fallbacks and the lazy-loaded thumbnails"""
+    if name == 'img':
+        return has_class(attrs, 'lazyload')
+    if name == 'div':
+        return attrs.get('id') == 'info' or has_class(attrs, 'title')
+    if name == 'span':
+        return has_class(attrs, 'pages')
+    return name in ('h1', 'h2')
+
+def is_listing_tag(name: str, attrs: Dict[str, str]) -> bool:
+    """Search result items and the pagination links"""
+    return name == 'div' and (has_class(attrs, 'gallery_item') or has_class(attrs, 'pagination'))
+
+def is_gallery_link(name: str, attrs: Dict[str, str]) -> bool:
+    return name == 'a' and bool(GALLERY_LINK_RE.search(attrs.get('href') or ''))
+
+class TagFilter(SoupStrainer):
+    """
+    SoupStrainer deciding on a tag's name and raw attributes together
+
+    Only matching tags, with everything inside them, are built into the tree.
+    beautifulsoup4 4.13 changed what a plain SoupStrainer passes to a match
+    function, so both versions' hooks are overridden instead.
+    """
+
+    def __init__(self, match: Callable[[str, Dict[str, str]], bool]):
+        super().__init__()
+        self.match_tag = match
+
+    def search_tag(self, markup_name=None, markup_attrs=None):  # beautifulsoup4 < 4.13
+        return self.match_tag(markup_name, markup_attrs or {})
+
+    def allow_tag_creation(self, nsprefix, name, attrs) -> bool:  # beautifulsoup4 >= 4.13
+        return self.match_tag(name, attrs or {})
+
+GALLERY_TAGS = TagFilter(is_gallery_tag)
+LISTING_TAGS = TagFilter(is_listing_tag)
+GALLERY_LINKS = TagFilter(is_gallery_link)
+
+def parse_html(html: str, only: Optional[TagFilter] = None, backend: Optional[str] = None) -> BeautifulSoup:
+    """
+    Parse a page, optionally keeping only the tags the caller reads
+
+    :param html: Page source
+    :param only: TagFilter for the tags to keep, the whole document if not given
+    :param backend: BeautifulSoup tree builder, lxml when installed and html.parser otherwise
+    """
+    return BeautifulSoup(html, backend or DEFAULT_BACKEND, parse_only=only)
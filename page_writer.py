@@ -0,0 +1,151 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import asyncio
+import hashlib
+import httpx
+from typing import Optional
+
+from image_store import ImageStore
+
+WRITE_BUFFER_SIZE = 256 * 1024
+PART_SUFFIX = '.part'
+
+def part_path(filepath: str) -> str:
+    """Path of the temp file a page is written to before it is complete"""
+    return filepath + PART_SUFFIX
+
+def remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def partial_size(filepath: str) -> int:
+    """Size of the page's temp file left by an interrupted download, 0 if there is none"""
+    try:
+        return os.path.getsize(part_path(filepath))
+    except OSError:
+        return 0
+
+def hash_file(path: str, digest) -> None:
+    """Feed a file's current content to a hashlib digest"""
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(WRITE_BUFFER_SIZE), b''):
+            digest.update(block)
+
+def resumed_from(response: httpx.Response, offset: int) -> bool:
+    """Whether the server honoured a ``Range: bytes={offset}-`` request"""
+    content_range = response.headers.get('Content-Range', '')
+    return response.status_code == 206 and content_range.startswith(f'bytes {offset}-')
+
+def expected_size(response: httpx.Response) -> Optional[int]:
+    """Full size of the image from Content-Range or Content-Length, if the server sent it"""
+    if response.status_code == 206:
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    # Content-Length counts encoded bytes, which won't match the decoded file
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    length = response.headers.get('Content-Length', '')
+    return int(length) if length.isdigit() else None
+
+async def stream_to_file(
+    response: httpx.Response,
+    filepath: str,
+    append: bool = False,
+    keep_partial: bool = False,
+    size: Optional[int] = None,
+    store: Optional[ImageStore] = None
+) -> int:
+    """
+    Stream a response body to disk without blocking the event loop
+
+    Chunks are buffered up to WRITE_BUFFER_SIZE and written from a worker thread
+    to ``filepath.part``, which is renamed over filepath only once the whole body
+    has arrived. A crash or failed request never leaves a truncated page under
+    its final name.
+
+    :param append: Continue an existing temp file (the response answers a Range request)
+    :param keep_partial: Keep the temp file on failure so the download can be resumed
+    :param size: Expected final file size; a short or long file is discarded
+    :param store: Content-addressed store; the page is hashed as it is written and linked in from there
+    :return: Final file size in bytes
+    """
+    tmp_path = part_path(filepath)
+    digest = hashlib.sha256() if store else None
+    if digest and append:
+        await asyncio.to_thread(hash_file, tmp_path, digest)
+    f = await asyncio.to_thread(open, tmp_path, 'ab' if append else 'wb')
+    written = f.tell() if append else 0
+    buffer = []
+    buffered = 0
+    # The call on f a worker thread is running, if any
+    busy: Optional[asyncio.Future] = None
+
+    def write(data: bytes) -> None:
+        # Hashing here keeps it off the event loop; hashlib releases the GIL for large buffers
+        f.write(data)
+        if digest:
+            digest.update(data)
+
+    def finish(leftover: bytes) -> None:
+        if leftover:
+            f.write(leftover)
+        f.close()
+
+    async def in_thread(func, *args) -> None:
+        # Shielded: a cancelled download can't stop the thread, so it must not touch f before the thread is done
+        nonlocal busy
+        busy = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        await asyncio.shield(busy)
+        busy = None
+
+    try:
+        async for chunk in response.aiter_bytes():
+            buffer.append(chunk)
+            buffered += len(chunk)
+            if buffered >= WRITE_BUFFER_SIZE:
+                data = b''.join(buffer)
+                # Handed over to the thread, so a failure from here on never writes it again
+                buffer, buffered = [], 0
+                await in_thread(write, data)
+                written += len(data)
+        if buffer:
+            data = b''.join(buffer)
+            buffer, buffered = [], 0
+            await in_thread(write, data)
+            written += len(data)
+        await in_thread(f.close)
+    except BaseException:
+        # Also covers cancellation, so interrupted downloads don't leak temp files
+        if busy is not None:
+            await asyncio.wait([busy])
+        await asyncio.to_thread(finish, b''.join(buffer) if keep_partial else b'')
+        if not keep_partial:
+            remove_quietly(tmp_path)
+        raise
+
+    if size is not None and written != size:
+        remove_quietly(tmp_path)
+        raise IOError(f"Expected {size} bytes for {os.path.basename(filepath)}, got {written}")
+    if store:
+        await asyncio.to_thread(store.commit, tmp_path, filepath, digest.hexdigest(), written)
+    else:
+        await asyncio.to_thread(os.replace, tmp_path, filepath)
+    return written
@@ -0,0 +1,177 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import asyncio
+import traceback
+from dataclasses import dataclass
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from batch_scheduler import BatchResult
+
+Interval = Tuple[float, float]
+
+def default_pdf_workers() -> int:
+    """Leave one core for the event loop that keeps downloading"""
+    return max(1, (os.cpu_count() or 2) - 1)
+
+def threads_per_worker(workers: int) -> int:
+    """Threads each of `workers` PDF processes may prepare pages on, so together they use about one per core"""
+    return max(1, (os.cpu_count() or 2) // max(1, workers))
+
+@dataclass
+class PdfJob:
+    """Data class to store one PDF build and when it ran"""
+    manga_dir: str
+    pages: int
+    started: float = 0.0
+    submitted: float = 0.0
+    elapsed: float = 0.0
+    error: Optional[BaseException] = None
+
+def merge_intervals(intervals: Iterable[Interval]) -> List[Interval]:
+    """Merge overlapping (start, end) intervals"""
+    merged: List[Interval] = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def busy_time(intervals: Iterable[Interval]) -> float:
+    """Total time covered by at least one interval"""
+    return sum(end - start for start, end in merge_intervals(intervals))
+
+def overlap_time(a: Iterable[Interval], b: Iterable[Interval]) -> float:
+    """Total time covered by both interval sets at once"""
+    a, b = merge_intervals(a), merge_intervals(b)
+    total = 0.0
+    i = j = 0
+    while i < len(a) and j < len(b):
+        total += max(0.0, min(a[i][1], b[j][1]) - max(a[i][0], b[j][0]))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return total
+
+class PdfStage:
+    """
+    Builds gallery PDFs in worker processes while the batch keeps downloading
+
+    Finished galleries are submitted to a bounded queue; when it is full,
+    submit() waits, so PDF work can't pile up faster than the pool drains it.
+    Use as an async context manager: leaving the block waits for every
+    queued PDF before the pool shuts down.
+    """
+
+    def __init__(
+        self,
+        convert: Callable[[str, List[str]], None],
+        workers: Optional[int] = None,
+        max_pending: Optional[int] = None
+    ):
+        """
+        :param convert: Picklable function building the PDF from (manga_dir, image files); it must raise
+                        on failure for the build to be reported as failed
+        :param workers: Worker processes, defaults to one less than the CPU count
+        :param max_pending: Galleries that may wait for a worker before submit() blocks
+        """
+        self.convert = convert
+        self.workers = workers or default_pdf_workers()
+        self.queue: asyncio.Queue = asyncio.Queue(max_pending or self.workers * 2)
+        self.jobs: List[PdfJob] = []
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.consumers: List[asyncio.Task] = []
+
+    async def submit(self, manga_dir: str, downloaded_files: List[str], **options) -> None:
+        """
+        Queue a gallery for PDF conversion, waiting if the queue is full
+
+        :param options: Picklable keyword arguments for this gallery's convert call
+        """
+        # Taken before a full queue blocks, so the wait isn't counted as downloading
+        submitted = time.monotonic()
+        await self.queue.put((manga_dir, list(downloaded_files), options, submitted))
+
+    async def consume(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            manga_dir, files, options, submitted = await self.queue.get()
+            job = PdfJob(manga_dir, len(files), time.monotonic(), submitted)
+            try:
+                await loop.run_in_executor(self.pool, partial(self.convert, **options), manga_dir, files)
+            except Exception as e:
+                job.error = e
+                print(f"Error creating PDF for {manga_dir}: {str(e)}")
+                traceback.print_exc()
+            finally:
+                job.elapsed = time.monotonic() - job.started
+                self.jobs.append(job)
+                self.queue.task_done()
+
+    async def __aenter__(self) -> 'PdfStage':
+        self.pool = ProcessPoolExecutor(self.workers)
+        self.consumers = [asyncio.create_task(self.consume()) for _ in range(self.workers)]
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        try:
+            if exc_info[0] is None:
+                await self.queue.join()
+        finally:
+            for consumer in self.consumers:
+                consumer.cancel()
+            await asyncio.gather(*self.consumers, return_exceptions=True)
+            self.pool.shutdown(wait=True, cancel_futures=True)
+
+    def download_span(self, download: BatchResult) -> Interval:
+        """
+        When a gallery was downloading
+
+        Downloads returning (manga_dir, failed_pages) end when that gallery was submitted
+        here, not after the time spent waiting for room in the queue.
+        """
+        end = download.started + download.elapsed
+        if isinstance(download.result, tuple) and download.result:
+            submitted = [job.submitted for job in self.jobs if job.manga_dir == download.result[0]]
+            if submitted:
+                end = min(end, max(download.started, max(submitted)))
+        return download.started, end
+
+    def report(self, downloads: List[BatchResult]) -> None:
+        """Print how long downloads and PDF builds ran, and how much of that was overlapped"""
+        download_spans = [self.download_span(r) for r in downloads]
+        pdf_spans = [(job.started, job.started + job.elapsed) for job in self.jobs]
+        if not pdf_spans:
+            return
+
+        downloading = busy_time(download_spans)
+        building = busy_time(pdf_spans)
+        overlapped = overlap_time(download_spans, pdf_spans)
+        wall = max(end for _, end in download_spans + pdf_spans) - min(start for start, _ in download_spans + pdf_spans)
+        failed = sum(1 for job in self.jobs if job.error)
+
+        print(f"\nPDF stage: {len(self.jobs) - failed}/{len(self.jobs)} PDFs built with {self.workers} workers")
+        print(f"Downloads active {downloading:.1f}s, PDF builds active {building:.1f}s, "
+              f"overlapped {overlapped:.1f}s ({overlapped / building:.0%} of PDF time hidden behind downloads)"
+              if building else f"Downloads active {downloading:.1f}s")
+        print(f"Wall time {wall:.1f}s vs {downloading + building:.1f}s if run back to back")
@@ -0,0 +1,283 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import zlib
+import struct
+from dataclasses import dataclass, field
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple, Union
+from PIL import Image
+
+from image_header import PNG_SIGNATURE, open_source, sniff_image
+
+DEFAULT_DPI = 96.0
+COPY_CHUNK_SIZE = 256 * 1024
+
+# Source byte ranges of a stream, copied straight from the image file
+Segments = List[Tuple[int, int]]
+
+# A page image: a file path or an in-memory file such as io.BytesIO
+ImageSource = Union[str, BinaryIO]
+
+@dataclass
+class PdfImage:
+    """Data class to store an image XObject ready to be written"""
+    width: int
+    height: int
+    colorspace: str
+    bits: int
+    filter: str
+    dpi: Tuple[float, float] = (DEFAULT_DPI, DEFAULT_DPI)
+    decode_parms: Optional[str] = None
+    decode: Optional[str] = None
+    data: bytes = b''
+    segments: Segments = field(default_factory=list)
+    smask: Optional['PdfImage'] = None
+
+def header_dpi(dpi: Optional[Tuple[float, float]]) -> Tuple[float, float]:
+    if not dpi:
+        return (DEFAULT_DPI, DEFAULT_DPI)
+    return (dpi[0] if dpi[0] > 1 else DEFAULT_DPI, dpi[1] if dpi[1] > 1 else DEFAULT_DPI)
+
+def image_dpi(img: Image.Image) -> Tuple[float, float]:
+    dpi = img.info.get('dpi')
+    try:
+        return header_dpi((float(dpi[0]), float(dpi[1])))
+    except (TypeError, ValueError, IndexError):
+        return header_dpi(None)
+
+def read_png_layout(f: BinaryIO) -> Optional[Tuple[bytes, Optional[bytes], bool, Segments]]:
+    """
+    Read the IHDR, palette and IDAT positions of a PNG without decoding it
+
+    :return: Tuple of (IHDR data, PLTE data, has tRNS, IDAT segments), None if not a PNG
+    """
+    if f.read(8) != PNG_SIGNATURE:
+        return None
+    ihdr, palette, has_trns, segments = None, None, False, []
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'IHDR':
+            ihdr = f.read(length)
+            f.seek(4, 1)
+        elif chunk_type == b'PLTE':
+            palette = f.read(length)
+            f.seek(4, 1)
+        elif chunk_type == b'IDAT':
+            segments.append((f.tell(), length))
+            f.seek(length + 4, 1)
+        elif chunk_type == b'IEND':
+            break
+        else:
+            has_trns = has_trns or chunk_type == b'tRNS'
+            f.seek(length + 4, 1)
+    if ihdr is None or not segments:
+        return None
+    return ihdr, palette, has_trns, segments
+
+def png_passthrough(source: ImageSource, dpi: Tuple[float, float]) -> Optional[PdfImage]:
+    """Embed a PNG's compressed IDAT data as-is; PDF's Flate predictors decode it the same way"""
+    with open_source(source) as f:
+        layout = read_png_layout(f)
+    if layout is None:
+        return None
+    ihdr, palette, has_trns, segments = layout
+    width, height, bits, color_type, _, _, interlace = struct.unpack('>IIBBBBB', ihdr)
+    if interlace or has_trns or color_type not in (0, 2, 3):
+        return None
+
+    if color_type == 3:
+        if not palette:
+            return None
+        colorspace = f"[/Indexed /DeviceRGB {len(palette) // 3 - 1} <{palette.hex()}>]"
+        colors = 1
+    elif color_type == 2:
+        colorspace, colors = '/DeviceRGB', 3
+    else:
+        colorspace, colors = '/DeviceGray', 1
+
+    return PdfImage(
+        width, height, colorspace, bits, '/FlateDecode', dpi,
+        decode_parms=f"<< /Predictor 15 /Colors {colors} /BitsPerComponent {bits} /Columns {width} >>",
+        segments=segments
+    )
+
+def flate_image(img: Image.Image, dpi: Tuple[float, float]) -> PdfImage:
+    """Decode an image and store its pixels Flate-compressed, with alpha as a soft mask"""
+    smask = None
+    if img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        alpha = img.getchannel('A')
+        smask = PdfImage(img.width, img.height, '/DeviceGray', 8, '/FlateDecode', dpi,
+                         data=zlib.compress(alpha.tobytes()))
+    if img.mode in ('1', 'L', 'LA'):
+        img = img.convert('L')
+        colorspace = '/DeviceGray'
+    else:
+        img = img.convert('RGB')
+        colorspace = '/DeviceRGB'
+    return PdfImage(img.width, img.height, colorspace, 8, '/FlateDecode', dpi,
+                    data=zlib.compress(img.tobytes()), smask=smask)
+
+def load_image(source: ImageSource) -> PdfImage:
+    """
+    Describe an image file as a PDF image
+
+    JPEGs and opaque non-interlaced PNGs are embedded without being decoded,
+    with their size read from the file header; anything else is decoded once
+    with PIL and Flate-compressed.
+    """
+    header = sniff_image(source)
+    if header and header.format == 'JPEG' and header.components in (1, 3, 4):
+        colorspace = {1: '/DeviceGray', 3: '/DeviceRGB', 4: '/DeviceCMYK'}[header.components]
+        # Adobe CMYK JPEGs store inverted values
+        decode = '[1 0 1 0 1 0 1 0]' if header.components == 4 and header.adobe else None
+        with open_source(source) as f:
+            size = f.seek(0, 2)
+        return PdfImage(header.width, header.height, colorspace, 8, '/DCTDecode', header_dpi(header.dpi),
+                        decode=decode, segments=[(0, size)])
+    if header and header.format == 'PNG' and not header.has_alpha:
+        image = png_passthrough(source, header_dpi(header.dpi))
+        if image:
+            return image
+
+    with open_source(source) as f, Image.open(f) as img:
+        return flate_image(img, image_dpi(img))
+
+class StreamingPdfWriter:
+    """
+    Write a PDF one page at a time
+
+    Each page's image is copied to the output file as soon as it is added, so
+    only one page is held in memory; the page tree and xref table are written
+    when the writer is closed.
+    """
+
+    CATALOG = 1
+    PAGES = 2
+
+    def __init__(self, path: str):
+        self.path = path
+        self.f = open(path, 'wb')
+        self.offsets: Dict[int, int] = {}
+        self.page_ids: List[int] = []
+        self.next_id = 3
+        self.f.write(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+
+    def allocate(self) -> int:
+        obj_id = self.next_id
+        self.next_id += 1
+        return obj_id
+
+    def write_object(self, obj_id: int, body: str) -> None:
+        self.offsets[obj_id] = self.f.tell()
+        self.f.write(f"{obj_id} 0 obj\n{body}\nendobj\n".encode('latin-1'))
+
+    def write_stream(self, obj_id: int, dictionary: str, data: bytes = b'',
+                     source: Optional[ImageSource] = None, segments: Optional[Segments] = None) -> None:
+        """Write a stream object whose body is data, or the given byte ranges of the source file"""
+        length = sum(n for _, n in segments) if segments else len(data)
+        self.offsets[obj_id] = self.f.tell()
+        self.f.write(f"{obj_id} 0 obj\n<< {dictionary} /Length {length} >>\nstream\n".encode('latin-1'))
+        if segments:
+            with open_source(source) as src:
+                for offset, remaining in segments:
+                    src.seek(offset)
+                    while remaining:
+                        chunk = src.read(min(COPY_CHUNK_SIZE, remaining))
+                        if not chunk:
+                            raise IOError(f"{source} changed while being written to the PDF")
+                        self.f.write(chunk)
+                        remaining -= len(chunk)
+        else:
+            self.f.write(data)
+        self.f.write(b"\nendstream\nendobj\n")
+
+    def write_image(self, image: PdfImage, source: Optional[ImageSource]) -> int:
+        smask_id = self.write_image(image.smask, None) if image.smask else None
+        obj_id = self.allocate()
+        dictionary = (f"/Type /XObject /Subtype /Image /Width {image.width} /Height {image.height} "
+                      f"/ColorSpace {image.colorspace} /BitsPerComponent {image.bits} /Filter {image.filter}")
+        if image.decode_parms:
+            dictionary += f" /DecodeParms {image.decode_parms}"
+        if image.decode:
+            dictionary += f" /Decode {image.decode}"
+        if smask_id:
+            dictionary += f" /SMask {smask_id} 0 R"
+        self.write_stream(obj_id, dictionary, image.data, source, image.segments)
+        return obj_id
+
+    def add_page(self, source: ImageSource) -> None:
+        """Append one image (a path or an in-memory file) as a full page"""
+        image = load_image(source)
+        image_id = self.write_image(image, source)
+
+        width = image.width * 72.0 / image.dpi[0]
+        height = image.height * 72.0 / image.dpi[1]
+        content_id = self.allocate()
+        self.write_stream(content_id, '', f"q {width:.4f} 0 0 {height:.4f} 0 0 cm /Im0 Do Q".encode('latin-1'))
+
+        page_id = self.allocate()
+        self.write_object(
+            page_id,
+            f"<< /Type /Page /Parent {self.PAGES} 0 R /MediaBox [0 0 {width:.4f} {height:.4f}] "
+            f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>"
+        )
+        self.page_ids.append(page_id)
+
+    def close(self) -> None:
+        """Write the page tree, catalog and xref table, then close the file"""
+        if self.f.closed:
+            return
+        try:
+            kids = ' '.join(f"{page_id} 0 R" for page_id in self.page_ids)
+            self.write_object(self.PAGES, f"<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>")
+            self.write_object(self.CATALOG, f"<< /Type /Catalog /Pages {self.PAGES} 0 R >>")
+
+            xref_offset = self.f.tell()
+            lines = [f"xref\n0 {self.next_id}\n", "0000000000 65535 f \n"]
+            lines += [f"{self.offsets[obj_id]:010d} 00000 n \n" for obj_id in range(1, self.next_id)]
+            lines.append(f"trailer\n<< /Size {self.next_id} /Root {self.CATALOG} 0 R >>\n"
+                         f"startxref\n{xref_offset}\n%%EOF\n")
+            self.f.write(''.join(lines).encode('latin-1'))
+        finally:
+            self.f.close()
+
+    def __enter__(self) -> 'StreamingPdfWriter':
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't leave a PDF behind that looks complete but is missing pages
+            self.f.close()
+            os.remove(self.path)
+
+def write_pdf(pdf_path: str, image_files: Iterable[ImageSource]) -> int:
+    """
+    Write images to a PDF, one page per image, with flat memory use
+
+    :return: Number of pages written
+    """
+    with StreamingPdfWriter(pdf_path) as writer:
+        for source in image_files:
+            writer.add_page(source)
+        return len(writer.page_ids)
@@ -0,0 +1,130 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import sqlite3
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from url_cache import DEFAULT_CACHE_DIR
+
+GLOBAL_SCOPE = ''
+
+@dataclass(frozen=True)
+class ProbeCandidate:
+    """Data class to store one candidate image URL and how it was built"""
+    url: str
+    server: str
+    scheme: str
+    layout: str
+    extension: str
+
+    @property
+    def key(self) -> Tuple[str, str, str, str]:
+        return (self.server, self.scheme, self.layout, self.extension)
+
+class ProbeOrderModel:
+    """
+    Success statistics for (server, scheme, layout, extension) combinations
+
+    Counts are kept per gallery and globally and persisted in SQLite, so the
+    combination most likely to succeed is probed first on later pages and runs.
+    Only the global counts are read up front; a gallery's are read the first
+    time it is probed. Successes are written in batches by flush().
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        :param path: SQLite database file, defaults to .cache/probe_stats.sqlite3
+        """
+        if path is None:
+            path = os.path.join(os.getcwd(), DEFAULT_CACHE_DIR, 'probe_stats.sqlite3')
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS probe_stats (
+                scope TEXT NOT NULL,
+                server TEXT NOT NULL,
+                scheme TEXT NOT NULL,
+                layout TEXT NOT NULL,
+                extension TEXT NOT NULL,
+                successes INTEGER NOT NULL,
+                PRIMARY KEY (scope, server, scheme, layout, extension)
+            )
+        """)
+        self.conn.commit()
+
+        self.counts: Dict[str, Counter] = {}
+        # Successes recorded since the last flush, keyed by (scope, *candidate key)
+        self.pending: Counter = Counter()
+        self.scope_counts(GLOBAL_SCOPE)
+
+    def scope_counts(self, scope: str) -> Counter:
+        """Counts for a gallery (or GLOBAL_SCOPE), read from the database the first time they are needed"""
+        if scope not in self.counts:
+            self.counts[scope] = Counter({
+                (server, scheme, layout, extension): successes
+                for server, scheme, layout, extension, successes in self.conn.execute(
+                    "SELECT server, scheme, layout, extension, successes FROM probe_stats WHERE scope = ?",
+                    (scope,)
+                )
+            })
+        return self.counts[scope]
+
+    def record_success(self, manga_id: str, candidate: ProbeCandidate) -> None:
+        """Count a successful probe for the gallery and globally; it is written at the next flush()"""
+        for scope in (manga_id, GLOBAL_SCOPE):
+            self.scope_counts(scope)[candidate.key] += 1
+            self.pending[(scope, *candidate.key)] += 1
+
+    def flush(self) -> None:
+        """Write the successes recorded since the last flush in one transaction"""
+        if not self.pending:
+            return
+        self.conn.executemany(
+            "INSERT INTO probe_stats (scope, server, scheme, layout, extension, successes) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (scope, server, scheme, layout, extension) "
+            "DO UPDATE SET successes = successes + excluded.successes",
+            [(*key, n) for key, n in self.pending.items()]
+        )
+        self.conn.commit()
+        self.pending.clear()
+
+    def order_candidates(self, manga_id: str, candidates: List[ProbeCandidate]) -> List[ProbeCandidate]:
+        """
+        Sort candidates so the most likely URL is probed first
+
+        Gallery statistics win over global ones; ties keep the original order.
+        """
+        gallery = self.scope_counts(manga_id)
+        overall = self.scope_counts(GLOBAL_SCOPE)
+        return sorted(candidates, key=lambda c: (-gallery[c.key], -overall[c.key]))
+
+    def order_servers(self, manga_id: str, servers: List[str]) -> List[str]:
+        """Sort image servers by how often they served this gallery, then overall"""
+        def server_successes(scope: str, server: str) -> int:
+            return sum(n for key, n in self.scope_counts(scope).items() if key[0] == server)
+
+        return sorted(servers, key=lambda s: (-server_successes(manga_id, s), -server_successes(GLOBAL_SCOPE, s)))
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
@@ -17,11 +17,19 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import re
 import os
+import argparse
 import asyncio
 import traceback
 import httpx
-import img2pdf
-from bs4 import BeautifulSoup
+from functools import partial
+from url_cache import ResolvedUrlCache, CachedPage
+from gallery import fetch_gallery
+from batch_scheduler import run_batch, estimate_page_counts
+from http_session import HttpSession
+from rate_limiter import RateLimiter, rate_limited_transport, add_rate_limit_args, rate_limiter_from_args
+from page_writer import stream_to_file
+from pdf_writer import write_pdf
+from pdf_stage import PdfStage, default_pdf_workers
 
 def extract_manga_id(url):
     """
@@ -54,10 +62,36 @@ def safe_format_filename(name):
     sanitized_name = re.sub(r'[<>:"/\\|?*]', '', name).strip()
     return sanitized_name[:255]  # Limit filename length
 
-async def fetch_manga_images(manga_id):
+async def download_if_found(client, url, headers, filepath):
+    """
+    GET an image URL and save the body only if the server returns 200
+    
+    :return: True if the image was saved to filepath
+    """
+    async with client.stream('GET', url, headers=headers) as response:
+        if response.status_code != 200:
+            return False
+        await stream_to_file(response, filepath)
+    return True
+
+async def fetch_manga_images(manga_id, cache=None, manga_dir=None, fused_stats=None, metadata=None, rate_limiter=None):
     """
     Fetch manga image URLs using exact browser headers
+    
+    :param manga_id: Manga ID
+    :param cache: Optional ResolvedUrlCache; cached pages are not probed again
+    :param manga_dir: If given, probe with GET instead of HEAD and save each found page here (fused mode)
+    :param fused_stats: Dict updated in fused mode with 'requests' (count) and 'files' (page number -> path)
+    :param metadata: Already fetched GalleryMetadata; the gallery page is fetched here if not given
+    :param rate_limiter: Optional RateLimiter shared between downloads
+    :return: Tuple of (dict of page number -> image URL, list of failed pages)
     """
+    complete = cache.get_complete_gallery(manga_id) if cache else None
+    if complete:
+        print(f"Using {len(complete)} cached image URLs for manga {manga_id}")
+        return {page: cached.url for page, cached in complete.items()}, []
+    cached_count, cached_pages = cache.get_gallery(manga_id) if cache else (None, {})
+    
     # Base headers for image requests
     headers = {
         'Accept': 'image/avif,image/webp,image/png,image/svg+xml,image/*;q=0.8,*/*;q=0.5',
@@ -73,26 +107,10 @@ async def fetch_manga_images(manga_id):
         'X-Firefox-Spdy': 'h2'
     }
     
-    # Headers for HTML page requests
-    page_headers = {
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.5',
-        'Connection': 'keep-alive',
-        'DNT': '1',
-        'Host': 'nhentai.xxx',
-        'Sec-Fetch-Dest': 'document',
-        'Sec-Fetch-Mode': 'navigate',
-        'Sec-Fetch-Site': 'none',
-        'Sec-Fetch-User': '?1',
-        'Sec-GPC': '1',
-        'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:133.0) Gecko/20100101 Firefox/133',
-        'Upgrade-Insecure-Requests': '1'
-    }
-    
     limits = httpx.Limits(max_keepalive_connections=5, max_connections=10)
     timeout = httpx.Timeout(10.0, connect=5.0)
     
-    transport = httpx.AsyncHTTPTransport(retries=3)
+    transport = rate_limited_transport(rate_limiter or RateLimiter(), retries=3)
     
     async with httpx.AsyncClient(
         limits=limits,
@@ -103,52 +121,51 @@ async def fetch_manga_images(manga_id):
         http2=True
     ) as client:
         try:
-            # First get the main gallery page
-            gallery_url = f"https://nhentai.xxx/g/{manga_id}/"
-            print(f"Fetching gallery page: {gallery_url}")
-            
-            response = await client.get(gallery_url, headers=page_headers)
-            response.raise_for_status()
-            
-            # Parse the HTML
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Look for thumbnails
-            print("\nLooking for thumbnails...")
-            thumbs = soup.find_all('img', class_='lazyload')
-            
-            # Store all patterns we find
-            patterns = []
-            base_dirs = set()
+            # First get the main gallery page, unless the caller already has it
+            if metadata is None:
+                metadata = await fetch_gallery(client, f"https://nhentai.xxx/g/{manga_id}/")
             
-            for thumb in thumbs:
-                if 'data-src' in thumb.attrs:
-                    src = thumb['data-src']
-                    print(f"Found thumbnail: {src}")
-                    
-                    # Extract the pattern from thumbnail URL
-                    # Example: http://i4.nhentaimg.com/016/y3v5c6xhgf/cover.jpg
-                    match = re.search(r'i\d\.nhentaimg\.com/(\d+/[a-zA-Z0-9]+)/', src)
-                    if match:
-                        pattern = match.group(1)
-                        base_dir = pattern.split('/')[0]  # Get the base directory (e.g., '016')
-                        base_dirs.add(base_dir)
-                        patterns.append(pattern)
-                        print(f"Found pattern: {pattern}")
+            # The thumbnails give the pattern, per-page URLs and page count
+            gallery = metadata.images
             
-            if patterns:
+            if gallery.pattern:
                 # Use the first pattern we found
-                image_pattern = patterns[0]
-                base_dir = list(base_dirs)[0]
+                image_pattern = gallery.pattern.pattern
+                base_dir = gallery.pattern.base_dir
                 print(f"\nUsing pattern: {image_pattern}")
                 print(f"Base directory: {base_dir}")
+                if gallery.pages:
+                    print(f"Resolved {len(gallery.pages)} pages from thumbnails")
                 
                 # Now we can construct URLs for all pages
                 image_urls = {}  # Changed to dict to maintain page numbers
+                resolved = []
                 page = 1
                 consecutive_failures = 0
                 
                 while consecutive_failures < 5:
+                    if gallery.page_count and page > gallery.page_count:
+                        break
+                    if cached_count and page > cached_count:
+                        break
+                    # Thumbnails cover the whole gallery, so one miss past them ends it
+                    if gallery.pages and page > gallery.last_page and consecutive_failures:
+                        break
+                    
+                    if page in gallery.pages:
+                        thumb = gallery.pages[page]
+                        image_urls[page] = thumb.url
+                        resolved.append(CachedPage(page, thumb.url, thumb.server, thumb.extension))
+                        consecutive_failures = 0
+                        page += 1
+                        continue
+                    
+                    if page in cached_pages:
+                        image_urls[page] = cached_pages[page].url
+                        consecutive_failures = 0
+                        page += 1
+                        continue
+                    
                     url_found = False
                     for server in ['i1', 'i2', 'i3', 'i4', 'i5', 'i6']:
                         if url_found:
@@ -162,17 +179,28 @@ async def fetch_manga_images(manga_id):
                         test_urls = []
                         for ext in ['.jpg', '.png', '.webp']:
                             test_urls.extend([
-                                f"http://{server}.nhentaimg.com/{image_pattern}/{page}{ext}",
-                                f"https://{server}.nhentaimg.com/{image_pattern}/{page}{ext}",
-                                f"http://{server}.nhentaimg.com/{base_dir}/{image_pattern.split('/')[-1]}/{page}{ext}",
-                                f"https://{server}.nhentaimg.com/{base_dir}/{image_pattern.split('/')[-1]}/{page}{ext}"
+                                (f"http://{server}.nhentaimg.com/{image_pattern}/{page}{ext}", ext),
+                                (f"https://{server}.nhentaimg.com/{image_pattern}/{page}{ext}", ext),
+                                (f"http://{server}.nhentaimg.com/{base_dir}/{image_pattern.split('/')[-1]}/{page}{ext}", ext),
+                                (f"https://{server}.nhentaimg.com/{base_dir}/{image_pattern.split('/')[-1]}/{page}{ext}", ext)
                             ])
                         
-                        for test_url in test_urls:
+                        for test_url, ext in test_urls:
                             try:
-                                response = await client.head(test_url, headers=img_headers)
-                                if response.status_code == 200:
+                                if manga_dir:
+                                    # Fused mode: the probe itself downloads the page
+                                    filepath = os.path.join(manga_dir, f"{page:03d}{ext}")
+                                    fused_stats['requests'] += 1
+                                    found = await download_if_found(client, test_url, img_headers, filepath)
+                                    if found:
+                                        fused_stats['files'][page] = filepath
+                                else:
+                                    response = await client.head(test_url, headers=img_headers)
+                                    found = response.status_code == 200
+                                
+                                if found:
                                     image_urls[page] = test_url  # Store URL with page number as key
+                                    resolved.append(CachedPage(page, test_url, server, ext))
                                     print(f"Found page {page}")
                                     url_found = True
                                     consecutive_failures = 0
@@ -193,23 +221,25 @@ async def fetch_manga_images(manga_id):
                 
                 if image_urls:
                     print(f"\nFound {len(image_urls)} images")
+                    if cache:
+                        cache.put_pages(manga_id, resolved)
+                        cache.mark_complete(manga_id, max(image_urls))
                     return image_urls, []  # Return dict instead of list
             
-            print("\nDebug: Page source")
-            print(response.text[:2000])
-            raise ValueError("Could not find image pattern")
+            raise ValueError(f"Could not find image pattern on {metadata.url}")
             
         except Exception as e:
             print(f"Error: {e}")
             traceback.print_exc()
             return {}, []  # Return empty dict instead of list
 
-def convert_to_pdf(manga_dir, downloaded_files):
+def convert_to_pdf(manga_dir, downloaded_files, raise_errors=False):
     """
     Convert downloaded manga images to PDF
     
     :param manga_dir: Directory containing the manga images
     :param downloaded_files: List of downloaded image file paths
+    :param raise_errors: Raise a failed build instead of printing it, so a PdfStage records the failure
     """
     try:
         # Sort files by name to maintain page order
@@ -223,61 +253,46 @@ def convert_to_pdf(manga_dir, downloaded_files):
         pdf_name = os.path.basename(manga_dir) + '.pdf'
         pdf_path = os.path.join(manga_dir, pdf_name)
         
-        # Convert images to PDF
-        with open(pdf_path, "wb") as f:
-            f.write(img2pdf.convert(image_files))
+        # Convert images to PDF one page at a time
+        write_pdf(pdf_path, image_files)
             
         print(f"Successfully created PDF: {pdf_path}")
         
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"Error creating PDF: {str(e)}")
         traceback.print_exc()
 
-async def download_manga(url):
+async def download_manga(url, cache=None, fused=False, pdf_stage=None, rate_limiter=None, metadata=None):
+    """
+    Download a manga and convert it to PDF
+    
+    :param url: Full URL of the manga on nhentai.xxx
+    :param cache: Optional ResolvedUrlCache shared between downloads
+    :param fused: Download pages while probing (GET only) instead of HEAD probing and then downloading
+    :param pdf_stage: Optional PdfStage building the PDF while the next gallery downloads
+    :param rate_limiter: Optional RateLimiter shared between downloads; every request waits on it
+    :param metadata: GalleryMetadata already fetched for this URL (e.g. by estimate_page_counts)
+    :return: Tuple of (manga directory, list of failed pages)
+    """
     manga_id = extract_manga_id(url)
+    rate_limiter = rate_limiter or RateLimiter()
     
     # Base directory for downloads
     base_dir = os.path.join(os.getcwd(), 'downloads')
     os.makedirs(base_dir, exist_ok=True)
     
-    async with httpx.AsyncClient(verify=False) as client:
-        # Get the manga title
-        response = await client.get(url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # Print the HTML structure for debugging
-        print("Debug - HTML Content:")
-        print(soup.prettify()[:1000])  # Print first 1000 chars of HTML
+    async with httpx.AsyncClient(transport=rate_limited_transport(rate_limiter, verify=False)) as client:
+        # Fetch and parse the gallery page once, for the title and the thumbnails
+        if metadata is None:
+            metadata = await fetch_gallery(client, url)
         
-        # Try different selectors with debug output
-        title_element = None
-        selectors = [
-            'div#info > h1',
-            'div#info h1',
-            'h1',
-            'div.title',
-            'h2.title'
-        ]
-        
-        for selector in selectors:
-            element = soup.select_one(selector)
-            if element:
-                print(f"Found element with selector '{selector}': {element.text.strip()}")
-                if not title_element:
-                    title_element = element
-        
-        manga_name = ''
-        if title_element:
-            manga_name = safe_format_filename(title_element.text.strip())
+        manga_name = safe_format_filename(metadata.title)
+        if manga_name:
             print(f"Using manga title: {manga_name}")
         else:
             print("Warning: Could not find manga title")
-            # As fallback, try to get any text content from #info div
-            info_div = soup.select_one('#info')
-            if info_div:
-                first_text = info_div.get_text(strip=True).split('\n')[0]
-                manga_name = safe_format_filename(first_text)
-                print(f"Using fallback title from #info: {manga_name}")
         
         # Create directory with ID_NAME format
         manga_dir = os.path.join(base_dir, f"{manga_id}_{manga_name}")
@@ -285,7 +300,13 @@ async def download_manga(url):
         os.makedirs(manga_dir, exist_ok=True)
         
         print(f"Starting download for manga {manga_id}...")
-        image_urls, failed_pages = await fetch_manga_images(manga_id)
+        fused_stats = {'requests': 0, 'files': {}}
+        image_urls, failed_pages = await fetch_manga_images(
+            manga_id, cache, manga_dir if fused else None, fused_stats, metadata, rate_limiter
+        )
+        if fused_stats['requests']:
+            print(f"Fused mode: {fused_stats['requests']} requests downloaded {len(fused_stats['files'])} pages "
+                  f"({len(fused_stats['files'])} requests saved)")
         
         if not image_urls:
             print("No images found to download")
@@ -309,21 +330,21 @@ async def download_manga(url):
         
         downloaded_files = []
         async with httpx.AsyncClient(
+            transport=rate_limited_transport(rate_limiter, verify=False, http2=True),
             timeout=30.0,
-            follow_redirects=True,
-            verify=False,
-            http2=True
+            follow_redirects=True
         ) as client:
             for page_num, img_url in sorted(image_urls.items()):  # Sort by page number
+                if page_num in fused_stats['files']:
+                    # Already downloaded while probing
+                    downloaded_files.append(fused_stats['files'][page_num])
+                    continue
+                
                 try:
                     # Update headers with correct host
                     img_headers = headers.copy()
                     img_headers['Host'] = img_url.split('/')[2]
                     
-                    # Download image
-                    response = await client.get(img_url, headers=img_headers)
-                    response.raise_for_status()
-                    
                     # Get file extension from URL
                     ext = os.path.splitext(img_url)[1]
                     if not ext:
@@ -333,8 +354,10 @@ async def download_manga(url):
                     filename = f"{page_num:03d}{ext}"
                     filepath = os.path.join(manga_dir, filename)
                     
-                    with open(filepath, 'wb') as f:
-                        f.write(response.content)
+                    # Stream the image to disk
+                    async with client.stream('GET', img_url, headers=img_headers) as response:
+                        response.raise_for_status()
+                        await stream_to_file(response, filepath)
                     
                     downloaded_files.append(filepath)
                     print(f"Downloaded page {page_num}/{max(image_urls.keys())}")
@@ -343,11 +366,17 @@ async def download_manga(url):
                     print(f"Failed to download page {page_num}: {e}")
                     if page_num not in failed_pages:
                         failed_pages.append(page_num)
+                    # Drop stale cached URLs so the next run re-verifies this page
+                    if cache and isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404:
+                        cache.invalidate_page(manga_id, page_num)
         
         if downloaded_files:
             print(f"\nDownload completed! Files saved in: {manga_dir}")
             # Convert images to PDF after successful download
-            convert_to_pdf(manga_dir, downloaded_files)
+            if pdf_stage:
+                await pdf_stage.submit(manga_dir, downloaded_files)
+            else:
+                convert_to_pdf(manga_dir, downloaded_files)
             if failed_pages:
                 print(f"Failed to download pages: {failed_pages}")
         else:
@@ -363,7 +392,25 @@ def is_valid_nhentai_xxx_url(url):
         url = 'https://' + url
     return 'nhentai.xxx/g/' in url
 
-async def main():
+def parse_args(argv=None):
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="Download manga listed in constants.txt from nhentai.xxx")
+    parser.add_argument('--fused', action='store_true',
+                        help="download pages while probing (GET only) instead of HEAD probing first")
+    parser.add_argument('--galleries', type=int, default=1,
+                        help="number of galleries downloaded concurrently (default: %(default)s)")
+    parser.add_argument('--shortest-first', action='store_true',
+                        help="start the galleries with the fewest pages first")
+    parser.add_argument('--pdf-workers', type=int, default=default_pdf_workers(),
+                        help="processes building PDFs while downloads continue (default: %(default)s)")
+    add_rate_limit_args(parser)
+    return parser.parse_args(argv)
+
+async def main(args=None):
+    if args is None:
+        args = parse_args([])
+    
+    rate_limiter = None
     try:
         # Read manga URLs from constants.txt
         with open('constants.txt', 'r') as f:
@@ -373,6 +420,10 @@ async def main():
             print("No URLs found in constants.txt")
             return
         
+        cache = ResolvedUrlCache()
+        rate_limiter = rate_limiter_from_args(args)
+        
+        valid_urls = []
         for url in urls:
             # Skip if URL doesn't contain actual link
             if 'https://' not in url and 'http://' not in url:
@@ -382,15 +433,28 @@ async def main():
                 print(f"Skipping invalid URL (not from nhentai.xxx): {url}")
                 continue
             
-            try:
-                await download_manga(url)
-                print(f"Successfully downloaded manga from: {url}")
-            except Exception as e:
-                print(f"Error downloading manga from {url}: {str(e)}")
-                traceback.print_exc()
+            valid_urls.append(url)
+        
+        # Galleries are downloaded one at a time unless --galleries is raised
+        sizes = None
+        galleries = {}  # Gallery pages fetched for the estimates, handed to their downloads
+        if args.shortest_first:
+            async with HttpSession(rate_limiter=rate_limiter) as session:
+                sizes = await estimate_page_counts(valid_urls, session, cache, galleries=galleries)
+        async with PdfStage(partial(convert_to_pdf, raise_errors=True), args.pdf_workers) as pdf_stage:
+            results = await run_batch(
+                valid_urls,
+                lambda url: download_manga(url, cache, args.fused, pdf_stage, rate_limiter, galleries.pop(url, None)),
+                args.galleries,
+                sizes
+            )
+        pdf_stage.report(results)
     except Exception as e:
         print(f"Error reading constants.txt: {str(e)}")
         traceback.print_exc()
+    finally:
+        if rate_limiter:
+            rate_limiter.close()
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main(parse_args()))
\ No newline at end of file
@@ -17,21 +17,85 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import re
 import os
+import io
+import time
 import asyncio
+import argparse
 import traceback
 import httpx
-import img2pdf
-from bs4 import BeautifulSoup
-from typing import Dict, List, Tuple, Set, Optional
+from typing import Awaitable, Callable, Dict, Iterator, List, Tuple, Set, Optional, Union
 from dataclasses import dataclass
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from collections import deque
+from functools import partial
+from concurrent.futures import Executor, ThreadPoolExecutor
 from PIL import Image
+from url_cache import ResolvedUrlCache, CachedPage
+from probe_order import ProbeOrderModel, ProbeCandidate
+from gallery import ImagePattern, GalleryMetadata, fetch_gallery
+from http_session import HttpSession, use_session, IMAGE_HEADERS, DEFAULT_MAX_PER_HOST
+from adaptive_limit import is_overload
+from mirror_pool import gallery_key, mirror_server, mirror_url
+from hedging import HedgePolicy, hedged
+from rate_limiter import add_rate_limit_args, rate_limiter_from_args
+from retry_policy import RetryPolicy, is_transient, is_missing, DEFAULT_MAX_RETRIES
+from page_writer import stream_to_file, part_path, partial_size, expected_size, resumed_from, remove_quietly
+from manifest import GalleryManifest
+from image_store import ImageStore
+from image_header import sniff_image
+from pdf_writer import write_pdf
+from pdf_stage import PdfStage, default_pdf_workers, threads_per_worker
+from batch_scheduler import run_batch, estimate_page_counts, BatchResult, DEFAULT_MAX_GALLERIES, DEFAULT_PAGE_BUDGET
+
+IMAGE_SERVERS = ['i1', 'i2', 'i3', 'i4', 'i5', 'i6']
+
+# Quality used when transparent pages are flattened to JPEG and no --jpeg-quality is given
+FLATTEN_JPEG_QUALITY = 95
+
+# HEAD probes only need headers back, so they fail faster than downloads
+VERIFY_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+
+# Mirrors a page is tried on before it counts as failed (the gallery's own server is always one of them)
+MAX_MIRROR_ATTEMPTS = 2
+
+# A hedged download is written here until it wins the race
+HEDGE_SUFFIX = '.hedge'
+
+# Pages probed per galloping round, and missing pages tolerated before the gallery ends
+GALLOP_WIDTH = 4
+GAP_TOLERANCE = 4
 
 @dataclass
-class ImagePattern:
-    """Data class to store image pattern information"""
-    pattern: str
-    base_dir: str
+class FusedDownloadStats:
+    """Data class to store request counts for a fused resolve-and-download run"""
+    requests: int = 0
+    pages: int = 0
+    known_pages: int = 0
+    
+    @property
+    def requests_saved(self) -> int:
+        """Requests saved compared to verifying with HEAD and then downloading with GET"""
+        # The probes are the same either way; fused mode saves the separate GET for every page
+        # whose URL wasn't already known from the cache or thumbnails
+        return self.pages - self.known_pages
+
+@dataclass(frozen=True)
+class TranscodeOptions:
+    """Data class to store the optional page transcoding settings used when building PDFs"""
+    max_width: Optional[int] = None
+    jpeg_quality: Optional[int] = None
+    webp_to_jpeg: bool = False
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_width or self.jpeg_quality is not None or self.webp_to_jpeg)
+
+@dataclass
+class PreparedPage:
+    """Data class to store a page ready for the PDF and its size before and after preparation"""
+    source: Union[str, io.BytesIO]
+    original_size: int
+    size: int
 
 @dataclass
 class VerificationResult:
@@ -40,6 +104,8 @@ class VerificationResult:
     url: Optional[str]
     server: Optional[str]
     extension: Optional[str]
+    # Timeout, connection error, 429 or 5xx seen on the way to a failed result; worth another try
+    error: Optional[BaseException] = None
 
 def extract_manga_id(url: str) -> str:
     """Extract manga ID from nhentai.xxx URL"""
@@ -62,187 +128,342 @@ def safe_format_filename(name: str) -> str:
     sanitized_name = re.sub(r'[<>:"/\\|?*]', '', name).strip()
     return sanitized_name[:255]
 
-def calculate_optimal_concurrency(total_pages: int) -> int:
-    """
-    Calculate optimal number of concurrent downloads based on manga characteristics
+def build_candidate_urls(page_num: int, pattern: ImagePattern, server: str) -> List[ProbeCandidate]:
+    """Build every candidate URL for a page in the default probe order, without duplicates"""
+    layouts = [
+        ('pattern', pattern.pattern),
+        ('base_dir', f"{pattern.base_dir}/{pattern.pattern.split('/')[-1]}")
+    ]
     
-    Rules:
-    - Minimum concurrency: 3
-    - Maximum concurrency: 10
-    - For manga with <= 25 pages: 3 concurrent downloads
-    - For manga with > 25 pages: Scales up to max 10 based on page count
-    - Takes into account system limitations
-    
-    :param total_pages: Total number of pages in the manga
-    :return: Optimal number of concurrent downloads
-    """
-    if total_pages <= 25:
-        return 3
-        
-    # Scale concurrency based on page count
-    # More pages = more concurrent downloads, up to a maximum
-    cpu_count = os.cpu_count() or 4  # Fallback to 4 if cpu_count is None
-    base_concurrency = min(cpu_count * 2, 10)  # Don't exceed 10 even on many-core systems
-    
-    if total_pages <= 50:
-        return min(5, base_concurrency)
-    elif total_pages <= 100:
-        return min(7, base_concurrency)
-    else:
-        return base_concurrency  # Use maximum allowed concurrency for large manga
-
-def calculate_optimal_concurrency_verification(total_urls: int) -> int:
+    candidates = []
+    seen = set()
+    for ext in ['.jpg', '.png', '.webp']:
+        for layout, path in layouts:
+            for scheme in ['http', 'https']:
+                url = f"{scheme}://{server}.nhentaimg.com/{path}/{page_num}{ext}"
+                if url not in seen:
+                    seen.add(url)
+                    candidates.append(ProbeCandidate(url, server, scheme, layout, ext))
+    return candidates
+
+async def verify_image_url(
+    client: HttpSession,
+    page_num: int,
+    pattern: ImagePattern,
+    server: str,
+    headers: Dict[str, str],
+    manga_id: Optional[str] = None,
+    probe_order: Optional[ProbeOrderModel] = None
+) -> VerificationResult:
     """
-    Calculate optimal number of concurrent verifications
-    
-    Rules for verification:
-    - Minimum concurrency: 5 (verification is less resource-intensive than downloading)
-    - Maximum concurrency: 20 (higher than download as it's just HEAD requests)
-    - For <= 50 URLs: 5 concurrent verifications
-    - For > 50 URLs: Scales up to max 20 based on URL count
-    - Takes into account system limitations
+    Verify a single image URL with all possible combinations, most likely first, under the server's limit
     
-    :param total_urls: Total number of URLs to verify
-    :return: Optimal number of concurrent verifications
+    A 429, 5xx, timeout or connection error stops the probes; the result carries it as
+    its error, since the page may still exist.
     """
-    if total_urls <= 50:
-        return 5
+    limit = client.verify_limits.get(server)
+    error = None
+    async with limit:
+        img_headers = headers.copy()
+        img_headers['Host'] = f'{server}.nhentaimg.com'
         
-    cpu_count = os.cpu_count() or 4
-    base_concurrency = min(cpu_count * 4, 20)  # More aggressive than download concurrency
+        candidates = build_candidate_urls(page_num, pattern, server)
+        if probe_order and manga_id:
+            candidates = probe_order.order_candidates(manga_id, candidates)
+        
+        for candidate in candidates:
+            started = time.monotonic()
+            try:
+                with client.mirrors.busy(server):
+                    response = await client.head(candidate.url, headers=img_headers, timeout=VERIFY_TIMEOUT)
+                limit.observe(started, response.status_code)
+                client.mirrors.observe(server, started, response.status_code)
+                if response.status_code == 200:
+                    if probe_order and manga_id:
+                        probe_order.record_success(manga_id, candidate)
+                    return VerificationResult(page_num, candidate.url, server, candidate.extension)
+                if is_overload(response.status_code):
+                    response.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                # Already observed above
+                error = e
+                break
+            except Exception as e:
+                limit.observe(started, error=e)
+                client.mirrors.observe(server, started, error=e)
+                if is_transient(e):
+                    error = e
+                    break
     
-    if total_urls <= 100:
-        return min(10, base_concurrency)
-    elif total_urls <= 200:
-        return min(15, base_concurrency)
-    else:
-        return base_concurrency
+    return VerificationResult(page_num, None, None, None, error)
 
-async def verify_image_url(
-    client: httpx.AsyncClient,
+def mirror_attempts(client: HttpSession, servers: List[str], own_server: str) -> List[str]:
+    """Mirrors to try a page on: the best ones in rotation, with the gallery's own server as the last resort"""
+    attempts = client.mirrors.rotation(servers)[:MAX_MIRROR_ATTEMPTS]
+    if own_server not in attempts:
+        attempts.append(own_server)
+    return attempts
+
+async def verify_on_mirrors(
+    client: HttpSession,
     page_num: int,
     pattern: ImagePattern,
-    server: str,
+    servers: List[str],
+    own_server: str,
     headers: Dict[str, str],
-    semaphore: asyncio.Semaphore
+    manga_id: Optional[str] = None,
+    probe_order: Optional[ProbeOrderModel] = None
 ) -> VerificationResult:
-    """Verify a single image URL with all possible combinations"""
-    async with semaphore:
-        img_headers = headers.copy()
-        img_headers['Host'] = f'{server}.nhentaimg.com'
+    """
+    Verify a page that should exist on the gallery's best mirror, moving on to the next if it isn't there
+    
+    The page only counts as missing if one of the mirrors says so; if every one of them
+    failed on a transient error, the result carries the first of those errors.
+    """
+    error = None
+    for server in mirror_attempts(client, servers, own_server):
+        result = await verify_image_url(client, page_num, pattern, server, headers, manga_id, probe_order)
+        if result.url or not result.error:
+            return result
+        error = error or result.error
+    return VerificationResult(page_num, None, None, None, error)
+
+async def retry_transient(
+    retry_policy: RetryPolicy,
+    page_num: int,
+    attempt: Callable[[], Awaitable[VerificationResult]]
+) -> VerificationResult:
+    """Repeat attempt for a page after a backoff while it fails on transient errors, up to the policy's retries"""
+    # A page that is simply missing isn't retried, only one that failed on a transient error
+    result = await attempt()
+    for retry in range(retry_policy.max_retries):
+        if result.url or not is_transient(result.error):
+            break
+        await retry_policy.wait(page_num, retry, result.error)
+        result = await attempt()
+    return result
+
+async def find_last_page(
+    verify: Callable[[int], Awaitable[VerificationResult]],
+    known: Optional[Dict[int, VerificationResult]] = None,
+    start: int = 0,
+    gallop_width: int = GALLOP_WIDTH,
+    gap_tolerance: int = GAP_TOLERANCE
+) -> Tuple[int, Dict[int, VerificationResult]]:
+    """
+    Find the last page of a gallery with a galloping search
+    
+    Pages base+1, base+2, base+4, ... are probed concurrently in rounds of
+    gallop_width until a missing page is found, then the boundary is narrowed
+    with concurrent k-ary search. The gap_tolerance pages after the boundary
+    are checked linearly so short gaps don't end the gallery early.
+    
+    A probe that failed on a transient error leaves its page unknown rather than
+    missing: it can stop the gallop, but never the narrowing or the gallery. If the
+    search ends below an unknown page, that result tells the caller it may go on.
+    
+    :param verify: Coroutine function verifying a single page number
+    :param known: Results that were already probed, keyed by page number
+    :param start: Page already known to exist, the search starts after it
+    :return: Tuple of (last page number or 0, dict of every probed page -> result)
+    """
+    results: Dict[int, VerificationResult] = dict(known or {})
+    
+    async def probe(pages) -> None:
+        pending = sorted(set(p for p in pages if p >= 1 and p not in results))
+        for result in await asyncio.gather(*[verify(p) for p in pending]):
+            results[result.page_num] = result
+    
+    def exists(page: int) -> bool:
+        return results[page].url is not None
+    
+    def absent(page: int) -> bool:
+        return results[page].url is None and results[page].error is None
+    
+    base = start  # Highest page known to exist
+    while True:
+        # Gallop until a missing page shows up after base
+        hi = None
+        exponent = 0
+        while hi is None:
+            batch = [base + 2 ** i for i in range(exponent, exponent + gallop_width)]
+            exponent += gallop_width
+            await probe(batch)
+            base = max([p for p in batch if exists(p)] + [base])
+            missing = [p for p in batch if p > base and not exists(p)]
+            if missing:
+                hi = min(missing)
         
-        for ext in ['.jpg', '.png', '.webp']:
-            test_urls = [
-                f"http://{server}.nhentaimg.com/{pattern.pattern}/{page_num}{ext}",
-                f"https://{server}.nhentaimg.com/{pattern.pattern}/{page_num}{ext}",
-                f"http://{server}.nhentaimg.com/{pattern.base_dir}/{pattern.pattern.split('/')[-1]}/{page_num}{ext}",
-                f"https://{server}.nhentaimg.com/{pattern.base_dir}/{pattern.pattern.split('/')[-1]}/{page_num}{ext}"
-            ]
-            
-            for test_url in test_urls:
-                try:
-                    response = await client.head(test_url, headers=img_headers)
-                    if response.status_code == 200:
-                        return VerificationResult(page_num, test_url, server, ext)
-                except Exception:
-                    continue
-    
-    return VerificationResult(page_num, None, None, None)
-
-async def fetch_manga_images(manga_id: str) -> Tuple[Dict[int, str], List[int]]:
-    """Fetch manga image URLs using parallel verification"""
-    headers = {
-        'Accept': 'image/avif,image/webp,image/png,image/svg+xml,image/*;q=0.8,*/*;q=0.5',
-        'Accept-Language': 'en-US,en;q=0.5',
-        'Connection': 'keep-alive',
-        'DNT': '1',
-        'Host': 'i4.nhentaimg.com',
-        'Sec-Fetch-Dest': 'image',
-        'Sec-Fetch-Mode': 'no-cors',
-        'Sec-Fetch-Site': 'cross-site',
-        'Sec-GPC': '1',
-        'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:133.0) Gecko/20100101 Firefox/133',
-        'X-Firefox-Spdy': 'h2'
-    }
-    
-    page_headers = {
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.5',
-        'Connection': 'keep-alive',
-        'DNT': '1',
-        'Host': 'nhentai.xxx',
-        'Sec-Fetch-Dest': 'document',
-        'Sec-Fetch-Mode': 'navigate',
-        'Sec-Fetch-Site': 'none',
-        'Sec-Fetch-User': '?1',
-        'Sec-GPC': '1',
-        'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:133.0) Gecko/20100101 Firefox/133',
-        'Upgrade-Insecure-Requests': '1'
-    }
-    
-    limits = httpx.Limits(max_keepalive_connections=10, max_connections=20)  # Increased for parallel verification
-    timeout = httpx.Timeout(10.0, connect=5.0)
-    transport = httpx.AsyncHTTPTransport(retries=3)
-    
-    async with httpx.AsyncClient(
-        limits=limits,
-        timeout=timeout,
-        transport=transport,
-        follow_redirects=True,
-        verify=False,
-        http2=True
-    ) as client:
+        # Narrow (base, hi) down to adjacent pages
+        while hi - base > 1:
+            span = hi - base
+            points = sorted(set(base + span * i // (gallop_width + 1) for i in range(1, gallop_width + 1)) - {base, hi})
+            await probe(points)
+            if not any(exists(p) or absent(p) for p in points):
+                # Nothing but unknown pages left to narrow with
+                break
+            base = max([p for p in points if exists(p)] + [base])
+            hi = min([p for p in points if p > base and absent(p)] + [hi])
+        
+        # Linear check past the boundary in case hi is just a gap
+        tail = range(hi + 1, hi + 1 + gap_tolerance)
+        await probe(tail)
+        beyond = [p for p in tail if exists(p)]
+        if not beyond:
+            return base, results
+        base = max(beyond)
+
+def store_page_results(
+    manga_id: str,
+    page_results: Dict[int, VerificationResult],
+    last_page: int,
+    cache: Optional[ResolvedUrlCache] = None
+) -> Tuple[Dict[int, str], List[int]]:
+    """
+    Collect verified pages up to last_page and store them in the cache
+    
+    The gallery is only marked complete when no probe failed on a transient error;
+    those pages are unresolved, including any past last_page, where the gallery may go on.
+    
+    :return: Tuple of (dict of page number -> image URL, list of unresolved pages)
+    """
+    resolved = [page_results[p] for p in range(1, last_page + 1) if p in page_results and page_results[p].url]
+    image_urls = {r.page_num: r.url for r in resolved}
+    unsettled = {p for p, r in page_results.items() if not r.url and r.error}
+    missing_pages = sorted(unsettled.union(p for p in range(1, last_page + 1) if p not in image_urls))
+    if missing_pages:
+        print(f"Could not verify pages: {missing_pages}")
+    
+    if cache and resolved:
+        cache.put_pages(manga_id, [CachedPage(r.page_num, r.url, r.server, r.extension) for r in resolved])
+        if not unsettled:
+            cache.mark_complete(manga_id, last_page)
+    
+    return image_urls, missing_pages
+
+async def fetch_manga_images(
+    manga_id: str,
+    cache: Optional[ResolvedUrlCache] = None,
+    probe_order: Optional[ProbeOrderModel] = None,
+    session: Optional[HttpSession] = None,
+    metadata: Optional[GalleryMetadata] = None,
+    retry_policy: Optional[RetryPolicy] = None
+) -> Tuple[Dict[int, str], List[int]]:
+    """
+    Fetch manga image URLs using parallel verification
+
+    :param manga_id: Manga ID
+    :param cache: Optional resolved-URL cache; fully cached galleries skip verification entirely
+    :param probe_order: Optional probe-order model used to try the most likely URL first
+    :param session: Shared HTTP session, a temporary one is opened if not given
+    :param metadata: Already fetched gallery page; it is fetched here if not given
+    :param retry_policy: How probes failing with transient errors are retried, RetryPolicy() if not given
+    :return: Tuple of (dict of page number -> image URL, list of failed pages)
+    """
+    retry_policy = retry_policy or RetryPolicy()
+    complete = cache.get_complete_gallery(manga_id) if cache else None
+    if complete:
+        print(f"Using {len(complete)} cached image URLs for manga {manga_id}")
+        return {page: cached.url for page, cached in complete.items()}, []
+    cached_count, cached_pages = cache.get_gallery(manga_id) if cache else (None, {})
+    
+    headers = IMAGE_HEADERS
+    
+    async with use_session(session) as client:
         try:
-            gallery_url = f"https://nhentai.xxx/g/{manga_id}/"
-            print(f"Fetching gallery page: {gallery_url}")
-            
-            response = await client.get(gallery_url, headers=page_headers)
-            response.raise_for_status()
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            print("\nLooking for thumbnails...")
-            thumbs = soup.find_all('img', class_='lazyload')
+            if metadata is None:
+                metadata = await fetch_gallery(client, f"https://nhentai.xxx/g/{manga_id}/")
+            gallery = metadata.images
+            pattern = gallery.pattern
             
-            patterns = []
-            base_dirs = set()
-            
-            for thumb in thumbs:
-                if 'data-src' in thumb.attrs:
-                    src = thumb['data-src']
-                    print(f"Found thumbnail: {src}")
-                    
-                    match = re.search(r'i\d\.nhentaimg\.com/(\d+/[a-zA-Z0-9]+)/', src)
-                    if match:
-                        pattern = match.group(1)
-                        base_dir = pattern.split('/')[0]
-                        base_dirs.add(base_dir)
-                        patterns.append(pattern)
-                        print(f"Found pattern: {pattern}")
-            
-            if patterns:
-                pattern = ImagePattern(patterns[0], list(base_dirs)[0])
+            if pattern:
                 print(f"\nUsing pattern: {pattern.pattern}")
                 print(f"Base directory: {pattern.base_dir}")
                 
+                if gallery.pages:
+                    # Resolve straight from the thumbnails, probing only the pages without one
+                    working_server = next(iter(gallery.pages.values())).server
+                    page_results = {
+                        num: VerificationResult(num, thumb.url, thumb.server, thumb.extension)
+                        for num, thumb in gallery.pages.items()
+                    }
+                    
+                    def verify(page_num: int) -> Awaitable[VerificationResult]:
+                        return retry_transient(retry_policy, page_num, lambda: verify_image_url(
+                            client, page_num, pattern, working_server, headers, manga_id, probe_order
+                        ))
+                    
+                    last_page = gallery.last_page
+                    if not gallery.page_count:
+                        # No page-count metadata: make sure the thumbnail list wasn't truncated
+                        page_results[last_page + 1] = await verify(last_page + 1)
+                        if page_results[last_page + 1].url:
+                            last_page, page_results = await find_last_page(verify, page_results, last_page + 1)
+                    
+                    remaining = [p for p in range(1, last_page + 1) if p not in page_results]
+                    print(f"Resolved {len(gallery.pages)} pages from thumbnails, probing {len(remaining)} more")
+                    if remaining:
+                        sample = next(iter(gallery.pages.values())).url
+                        servers = await client.mirrors.gallery_servers(
+                            client, sample, IMAGE_SERVERS, headers, VERIFY_TIMEOUT
+                        )
+                        for result in await asyncio.gather(*[
+                            retry_transient(retry_policy, p, partial(
+                                verify_on_mirrors, client, p, pattern, servers, working_server, headers,
+                                manga_id, probe_order
+                            ))
+                            for p in remaining
+                        ]):
+                            page_results[result.page_num] = result
+                    
+                    return store_page_results(manga_id, page_results, last_page, cache)
+                
+                if cached_count and cached_pages:
+                    # Partially cached gallery: only re-verify the pages that were invalidated
+                    working_server = next(iter(cached_pages.values())).server
+                    missing_pages = [p for p in range(1, cached_count + 1) if p not in cached_pages]
+                    print(f"Re-verifying {len(missing_pages)} uncached pages on {working_server}...")
+                    results = await asyncio.gather(*[
+                        retry_transient(retry_policy, page_num, partial(
+                            verify_image_url, client, page_num, pattern, working_server, headers, manga_id,
+                            probe_order
+                        ))
+                        for page_num in missing_pages
+                    ])
+                    
+                    image_urls = {page: cached.url for page, cached in cached_pages.items() if page <= cached_count}
+                    resolved = [r for r in results if r.url]
+                    for result in resolved:
+                        image_urls[result.page_num] = result.url
+                    cache.put_pages(manga_id, [
+                        CachedPage(r.page_num, r.url, r.server, r.extension) for r in resolved
+                    ])
+                    
+                    failed = sorted(set(missing_pages) - set(image_urls))
+                    return image_urls, failed
+                
                 # Start with a small batch to estimate total pages
                 test_pages = list(range(1, 6))
-                max_concurrent = calculate_optimal_concurrency_verification(len(test_pages))
-                semaphore = asyncio.Semaphore(max_concurrent)
+                
+                servers = IMAGE_SERVERS
+                if probe_order:
+                    servers = probe_order.order_servers(manga_id, servers)
                 
                 verification_tasks = []
                 for page_num in test_pages:
-                    for server in ['i1', 'i2', 'i3', 'i4', 'i5', 'i6']:
+                    for server in servers:
                         task = verify_image_url(
                             client,
                             page_num,
                             pattern,
                             server,
                             headers,
-                            semaphore
+                            manga_id,
+                            probe_order
                         )
                         verification_tasks.append(task)
                 
-                print(f"Initial verification with {max_concurrent} concurrent tasks...")
+                print(f"Initial verification of {len(test_pages)} pages on {len(servers)} servers...")
                 results = await asyncio.gather(*verification_tasks)
                 
                 # Find working server and estimate total pages
@@ -257,49 +478,141 @@ async def fetch_manga_images(manga_id: str) -> Tuple[Dict[int, str], List[int]]:
                 
                 print(f"Found working server: {working_server}")
                 
-                # Now verify all pages with the working server
-                image_urls = {}
-                page = 1
-                consecutive_failures = 0
-                verification_tasks = []
+                # Locate the last page with a galloping search, reusing the initial probes
+                known = {r.page_num: r for r in results if r.server == working_server}
+                if gallery.page_count:
+                    last_page, page_results = gallery.page_count, known
+                else:
+                    last_page, page_results = await find_last_page(
+                        lambda page_num: retry_transient(retry_policy, page_num, lambda: verify_image_url(
+                            client,
+                            page_num,
+                            pattern,
+                            working_server,
+                            headers,
+                            manga_id,
+                            probe_order
+                        )),
+                        known
+                    )
+                print(f"Last page: {last_page} ({len(page_results)} probes)")
                 
-                while consecutive_failures < 5:
-                    result = await verify_image_url(
-                        client,
-                        page,
-                        pattern,
-                        working_server,
-                        headers,
-                        semaphore
+                # Verify every remaining page concurrently now that the page count is known
+                remaining = [p for p in range(1, last_page + 1) if p not in page_results]
+                if remaining:
+                    sample = next(r.url for r in page_results.values() if r.url)
+                    servers = await client.mirrors.gallery_servers(
+                        client, sample, IMAGE_SERVERS, headers, VERIFY_TIMEOUT
                     )
-                    
-                    if result.url:
-                        image_urls[page] = result.url
-                        print(f"Verified page {page}")
-                        consecutive_failures = 0
-                    else:
-                        consecutive_failures += 1
-                        print(f"Could not verify page {page} (Consecutive failures: {consecutive_failures})")
-                        if consecutive_failures >= 5:
-                            break
-                    
-                    page += 1
+                    for result in await asyncio.gather(*[
+                        retry_transient(retry_policy, page_num, partial(
+                            verify_on_mirrors, client, page_num, pattern, servers, working_server, headers,
+                            manga_id, probe_order
+                        ))
+                        for page_num in remaining
+                    ]):
+                        page_results[result.page_num] = result
                 
+                image_urls, missing_pages = store_page_results(manga_id, page_results, last_page, cache)
                 if image_urls:
                     print(f"\nVerified {len(image_urls)} images")
-                    return image_urls, []
+                    return image_urls, missing_pages
             
-            print("\nDebug: Page source")
-            print(response.text[:2000])
-            raise ValueError("Could not find image pattern")
+            raise ValueError(f"Could not find image pattern on {metadata.url}")
             
         except Exception as e:
             print(f"Error: {e}")
             traceback.print_exc()
             return {}, []
 
-def convert_to_pdf(manga_dir: str, downloaded_files: List[str]) -> None:
-    """Convert downloaded manga images to PDF"""
+def needs_flattening(img: Image.Image) -> bool:
+    """Whether an image has an alpha channel or transparency that the PDF page should not keep"""
+    return img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+
+def format_size(num_bytes: int) -> str:
+    """Format a byte count as KB or MB"""
+    if abs(num_bytes) >= 1e6:
+        return f"{num_bytes / 1e6:.1f} MB"
+    return f"{num_bytes / 1e3:.1f} KB"
+
+def wants_jpeg(image_format: Optional[str], transcode: TranscodeOptions) -> bool:
+    """Whether the transcode options ask for a page of this format to be re-encoded as JPEG"""
+    return transcode.jpeg_quality is not None or (transcode.webp_to_jpeg and image_format == 'WEBP')
+
+def prepare_page(img_path: str, transcode: Optional[TranscodeOptions] = None) -> PreparedPage:
+    """
+    Flatten, downscale and re-encode a page for the PDF, decoding it at most once
+    
+    Transparent pages are always flattened into an in-memory JPEG. With transcode
+    options, pages wider than max_width are downscaled, and pages are re-encoded
+    as JPEG as requested; a re-encode that comes out larger than the original is
+    dropped unless the page also had to be flattened or downscaled.
+    
+    :return: PreparedPage whose source is img_path unchanged or an in-memory JPEG
+    """
+    transcode = transcode or TranscodeOptions()
+    original_size = os.path.getsize(img_path)
+    unchanged = PreparedPage(img_path, original_size, original_size)
+    
+    # Most pages are JPEG or opaque PNG/WebP; their header is enough to tell
+    header = sniff_image(img_path)
+    if header and not (
+        header.has_alpha
+        or (transcode.max_width and header.width > transcode.max_width)
+        or wants_jpeg(header.format, transcode)
+    ):
+        return unchanged
+    
+    with Image.open(img_path) as img:
+        flatten = needs_flattening(img)
+        downscale = bool(transcode.max_width and img.width > transcode.max_width)
+        if not (flatten or downscale or wants_jpeg(img.format, transcode)):
+            return unchanged
+        
+        if flatten or img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        if downscale:
+            height = max(1, round(img.height * transcode.max_width / img.width))
+            img = img.resize((transcode.max_width, height), Image.LANCZOS)
+        
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=transcode.jpeg_quality or FLATTEN_JPEG_QUALITY)
+        if not (flatten or downscale) and buffer.tell() >= original_size:
+            return unchanged
+        
+        size = buffer.tell()
+        buffer.seek(0)
+        return PreparedPage(buffer, original_size, size)
+
+def ordered_map(executor: Executor, fn: Callable, items: List, window: int) -> Iterator:
+    """Like executor.map, but with at most window results computed ahead of the consumer"""
+    pending = deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+def convert_to_pdf(
+    manga_dir: str,
+    downloaded_files: List[str],
+    transcode: Optional[TranscodeOptions] = None,
+    threads: Optional[int] = None,
+    raise_errors: bool = False
+) -> None:
+    """
+    Convert downloaded manga images to PDF
+    
+    Pages are prepared in memory (see prepare_page) on a thread pool (PIL
+    releases the GIL while decoding and encoding) and streamed into the PDF in
+    page order as they finish.
+    
+    :param transcode: Optional downscale/re-encode settings; bytes saved are reported per gallery
+    :param threads: Size of the thread pool, the CPU count if not given; see threads_per_worker
+                    for PDFs built by several processes at once
+    :param raise_errors: Raise a failed build instead of printing it, so a PdfStage records the failure
+    """
     try:
         image_files = sorted(downloaded_files)
         
@@ -310,60 +623,159 @@ def convert_to_pdf(manga_dir: str, downloaded_files: List[str]) -> None:
         pdf_name = os.path.basename(manga_dir) + '.pdf'
         pdf_path = os.path.join(manga_dir, pdf_name)
         
-        # Create temporary files for RGB images
-        rgb_images = []
-        temp_files = []
-        
-        for img_path in image_files:
-            with Image.open(img_path) as img:
-                # Convert to RGB if image has alpha channel
-                if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
-                    img = img.convert('RGB')
-                    # Save to temporary file
-                    temp_path = img_path + '_temp.jpg'
-                    img.save(temp_path, 'JPEG', quality=95)
-                    temp_files.append(temp_path)
-                    rgb_images.append(temp_path)
-                else:
-                    rgb_images.append(img_path)
-        
-        # Convert to PDF
-        with open(pdf_path, "wb") as f:
-            f.write(img2pdf.convert(rgb_images))
+        workers = threads or os.cpu_count() or 4
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Only a couple of flattened pages per worker are held in memory at once
+            prepared = ordered_map(executor, lambda path: prepare_page(path, transcode), image_files, workers * 2)
+            before = after = changed = 0
             
-        # Clean up temporary files
-        for temp_file in temp_files:
-            try:
-                os.remove(temp_file)
-            except:
-                pass
+            def sources() -> Iterator[Union[str, io.BytesIO]]:
+                # Only totals are kept, so each buffer is freed once its page is written
+                nonlocal before, after, changed
+                for page in prepared:
+                    before += page.original_size
+                    after += page.size
+                    changed += not isinstance(page.source, str)
+                    yield page.source
+            
+            write_pdf(pdf_path, sources())
             
         print(f"Successfully created PDF: {pdf_path}")
+        if transcode and transcode.enabled:
+            print(f"Transcoded {changed}/{len(image_files)} pages: {format_size(before)} -> {format_size(after)} "
+                  f"({format_size(before - after)} saved)")
         
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"Error creating PDF: {str(e)}")
         traceback.print_exc()
 
+async def save_image(
+    client: HttpSession,
+    page_num: int,
+    img_url: str,
+    filepath: str,
+    headers: Dict[str, str],
+    manifest: Optional[GalleryManifest] = None,
+    store: Optional[ImageStore] = None
+) -> int:
+    """
+    GET an image into filepath, continuing a partial file from an earlier run with a Range request
+    
+    The server's download limit is told how the request went; latency is measured to the response headers.
+    
+    :param store: Content-addressed store the page is linked in from
+    :return: Size of the saved file in bytes
+    """
+    offset = partial_size(filepath) if manifest and manifest.can_resume(page_num, img_url) else 0
+    request_headers = dict(headers, Range=f'bytes={offset}-') if offset else headers
+    server = mirror_server(img_url)
+    limit = client.download_limits.get(server)
+    
+    started = time.monotonic()
+    try:
+        with client.mirrors.busy(server):
+            async with client.stream('GET', img_url, headers=request_headers) as response:
+                limit.observe(started, response.status_code)
+                client.mirrors.observe(server, started, response.status_code)
+                if response.status_code != 416 or not offset:
+                    response.raise_for_status()
+                    
+                    size = expected_size(response)
+                    if manifest:
+                        manifest.mark_partial(page_num, img_url, os.path.basename(filepath), size)
+                    return await stream_to_file(
+                        response,
+                        filepath,
+                        append=resumed_from(response, offset),
+                        keep_partial=manifest is not None,
+                        size=size,
+                        store=store
+                    )
+    except httpx.TransportError as e:
+        # Covers a stalled body as well as a response that never came
+        limit.observe(started, error=e)
+        client.mirrors.observe(server, started, error=e)
+        raise
+    
+    # The partial file doesn't fit the image any more. Start over from the beginning, once the
+    # 416 has given back its connection; with no partial file left there is no second restart.
+    remove_quietly(part_path(filepath))
+    return await save_image(client, page_num, img_url, filepath, headers, manifest, store)
+
+def scheme_variant(url: str) -> str:
+    """The same image over the other scheme; the image servers answer both"""
+    if url.startswith('https://'):
+        return 'http://' + url[len('https://'):]
+    return 'https://' + url[len('http://'):]
+
+async def save_image_hedged(
+    client: HttpSession,
+    page_num: int,
+    img_url: str,
+    alternate_url: str,
+    filepath: str,
+    headers: Dict[str, str],
+    hedge: HedgePolicy,
+    manifest: Optional[GalleryManifest] = None,
+    store: Optional[ImageStore] = None
+) -> int:
+    """
+    save_image, racing a second GET of alternate_url against it once it runs longer than usual
+    
+    The hedge downloads to its own file and is moved into place only if it wins,
+    so the two requests never write to the same file.
+    """
+    hedge_path = filepath + HEDGE_SUFFIX
+    
+    async def save_alternate() -> int:
+        alternate_headers = dict(headers, Host=alternate_url.split('/')[2])
+        # A hedge is one more download from its server, so it waits for a slot like any other
+        async with client.download_limits.get(mirror_server(alternate_url)):
+            size = await save_image(client, page_num, alternate_url, hedge_path, alternate_headers, None, store)
+        await asyncio.to_thread(os.replace, hedge_path, filepath)
+        return size
+    
+    try:
+        size = await hedged(
+            hedge,
+            lambda: save_image(client, page_num, img_url, filepath, headers, manifest, store),
+            save_alternate
+        )
+    finally:
+        remove_quietly(hedge_path)
+    # The losing request may have left a partial file behind for a resume that isn't needed any more
+    remove_quietly(part_path(filepath))
+    return size
+
 async def download_image(
-    client: httpx.AsyncClient,
+    client: HttpSession,
     page_num: int,
     img_url: str,
     manga_dir: str,
     headers: Dict[str, str],
-    semaphore: asyncio.Semaphore,
     downloaded_files: Set[str],
-    failed_pages: Set[int],
-    total_pages: int
-) -> None:
-    """Download a single image with semaphore control"""
-    async with semaphore:
+    total_pages: int,
+    manga_id: Optional[str] = None,
+    cache: Optional[ResolvedUrlCache] = None,
+    page_budget: Optional[asyncio.Semaphore] = None,
+    manifest: Optional[GalleryManifest] = None,
+    mirrors: Optional[List[str]] = None,
+    hedge: Optional[HedgePolicy] = None,
+    store: Optional[ImageStore] = None
+) -> Optional[Exception]:
+    """
+    Download a single image under its server's adaptive download limit and an optional batch-wide page budget
+    
+    :param mirrors: Image servers that have the gallery; the page goes to the best one and
+                    falls back to the next, and to img_url's own server last
+    :param hedge: Hedging policy; a slow GET gets a duplicate on the next mirror (or the other scheme)
+    :param store: Content-addressed store the page is linked in from
+    :return: The error the download failed with, None once the page is saved
+    """
+    async with page_budget or nullcontext():
         try:
-            img_headers = headers.copy()
-            img_headers['Host'] = img_url.split('/')[2]
-            
-            response = await client.get(img_url, headers=img_headers)
-            response.raise_for_status()
-            
             ext = os.path.splitext(img_url)[1]
             if not ext:
                 ext = '.webp'
@@ -371,115 +783,437 @@ async def download_image(
             filename = f"{page_num:03d}{ext}"
             filepath = os.path.join(manga_dir, filename)
             
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
+            own_server = mirror_server(img_url)
+            if mirrors and not (manifest and manifest.can_resume(page_num, img_url)):
+                urls = [mirror_url(img_url, server) for server in mirror_attempts(client, mirrors, own_server)]
+            else:
+                # A partial file is only resumed from the server it was started on
+                urls = [img_url]
+            
+            for attempt, url in enumerate(urls, 1):
+                img_headers = headers.copy()
+                img_headers['Host'] = url.split('/')[2]
+                try:
+                    async with client.download_limits.get(mirror_server(url)):
+                        if hedge:
+                            alternate_url = urls[attempt] if attempt < len(urls) else scheme_variant(url)
+                            size = await save_image_hedged(client, page_num, url, alternate_url, filepath,
+                                                           img_headers, hedge, manifest, store)
+                        else:
+                            size = await save_image(client, page_num, url, filepath, img_headers, manifest, store)
+                    break
+                except Exception as e:
+                    if attempt == len(urls):
+                        raise
+                    print(f"Page {page_num} failed on {mirror_server(url)} ({e}), trying another mirror")
+            if manifest:
+                manifest.mark_complete(page_num, size)
             
             downloaded_files.add(filepath)
             print(f"Downloaded page {page_num}/{total_pages}")
             
         except Exception as e:
             print(f"Failed to download page {page_num}: {e}")
-            failed_pages.add(page_num)
+            if is_missing(e):
+                if cache and manga_id:
+                    cache.invalidate_page(manga_id, page_num)
+                if manifest:
+                    manifest.forget(page_num)
+            return e
+    return None
 
-async def download_manga(url: str) -> Tuple[str, List[int]]:
-    """Download manga with parallel verification and downloading"""
-    manga_id = extract_manga_id(url)
-    base_dir = os.path.join(os.getcwd(), 'downloads')
-    os.makedirs(base_dir, exist_ok=True)
+async def resolve_page_again(
+    client: HttpSession,
+    page_num: int,
+    img_url: str,
+    pattern: Optional[ImagePattern],
+    headers: Dict[str, str],
+    mirrors: Optional[List[str]] = None,
+    manga_id: Optional[str] = None,
+    cache: Optional[ResolvedUrlCache] = None,
+    probe_order: Optional[ProbeOrderModel] = None,
+    manifest: Optional[GalleryManifest] = None,
+    retry_policy: Optional[RetryPolicy] = None
+) -> Optional[str]:
+    """
+    Verify a page again after its URL 404ed, recording the new URL in the cache and manifest
+    
+    :param retry_policy: How probes failing with transient errors are retried, RetryPolicy() if not given
+    :return: The page's URL, or None if no candidate exists any more or the probes kept failing
+    """
+    if not pattern:
+        return None
+    own_server = mirror_server(img_url)
+    result = await retry_transient(retry_policy or RetryPolicy(), page_num, partial(
+        verify_on_mirrors, client, page_num, pattern, mirrors or [own_server], own_server, headers,
+        manga_id, probe_order
+    ))
+    if not result.url:
+        return None
+    if cache and manga_id:
+        cache.put_pages(manga_id, [CachedPage(page_num, result.url, result.server, result.extension)])
+    if manifest:
+        manifest.set_urls({page_num: result.url})
+    return result.url
+
+async def fetch_and_save_page(
+    client: HttpSession,
+    page_num: int,
+    pattern: ImagePattern,
+    server: str,
+    manga_dir: str,
+    headers: Dict[str, str],
+    downloaded_files: Set[str],
+    stats: FusedDownloadStats,
+    manga_id: Optional[str] = None,
+    probe_order: Optional[ProbeOrderModel] = None,
+    known_url: Optional[str] = None,
+    page_budget: Optional[asyncio.Semaphore] = None,
+    manifest: Optional[GalleryManifest] = None,
+    mirrors: Optional[List[str]] = None,
+    store: Optional[ImageStore] = None
+) -> VerificationResult:
+    """
+    Resolve and download a page with GETs against the candidate URLs, streaming the body only on a 200
+    
+    :param known_url: URL expected to work, tried first (on whichever mirror the page goes to)
+    :param mirrors: Image servers that have the gallery; the page goes to the best one once a
+                    download slot is free, falling back to the next and to server last
+    """
+    error = None
+    async with page_budget or nullcontext():
+        servers = mirror_attempts(client, mirrors, server) if mirrors else [server]
+        for server in servers:
+            img_headers = headers.copy()
+            img_headers['Host'] = f'{server}.nhentaimg.com'
+            server_known_url = mirror_url(known_url, server) if known_url else None
+            
+            candidates = build_candidate_urls(page_num, pattern, server)
+            if probe_order and manga_id:
+                candidates = probe_order.order_candidates(manga_id, candidates)
+            if server_known_url:
+                # Try the cached/thumbnail URL first; it is normally one of the built candidates
+                candidates.sort(key=lambda c: c.url != server_known_url)
+            
+            async with client.download_limits.get(server):
+                for candidate in candidates:
+                    filepath = os.path.join(manga_dir, f"{page_num:03d}{candidate.extension}")
+                    try:
+                        stats.requests += 1
+                        size = await save_image(client, page_num, candidate.url, filepath, img_headers, manifest,
+                                                store)
+                    except Exception as e:
+                        if is_transient(e):
+                            error = e
+                        continue
+                    
+                    if manifest:
+                        manifest.mark_complete(page_num, size)
+                    if probe_order and manga_id:
+                        probe_order.record_success(manga_id, candidate)
+                    downloaded_files.add(filepath)
+                    stats.pages += 1
+                    if candidate.url == server_known_url:
+                        stats.known_pages += 1
+                    print(f"Downloaded page {page_num}")
+                    return VerificationResult(page_num, candidate.url, server, candidate.extension)
     
-    async with httpx.AsyncClient(verify=False) as client:
-        response = await client.get(url)
-        soup = BeautifulSoup(response.text, 'html.parser')
+    return VerificationResult(page_num, None, None, None, error)
+
+async def resolve_and_download_images(
+    manga_id: str,
+    manga_dir: str,
+    cache: Optional[ResolvedUrlCache] = None,
+    probe_order: Optional[ProbeOrderModel] = None,
+    session: Optional[HttpSession] = None,
+    page_budget: Optional[asyncio.Semaphore] = None,
+    manifest: Optional[GalleryManifest] = None,
+    metadata: Optional[GalleryMetadata] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    store: Optional[ImageStore] = None
+) -> Tuple[Set[str], Set[int], FusedDownloadStats]:
+    """
+    Resolve and download every page in a single pass, without HEAD verification
+    
+    :param manifest: Download manifest; pages it lists as complete are not fetched again
+    :param metadata: Already fetched gallery page; it is fetched here if not given
+    :param retry_policy: How pages failing with transient errors are retried, RetryPolicy() if not given
+    :param store: Content-addressed store pages are linked in from
+    :return: Tuple of (downloaded file paths, failed pages, request statistics)
+    """
+    retry_policy = retry_policy or RetryPolicy()
+    cached_count, cached_pages = cache.get_gallery(manga_id) if cache else (None, {})
+    downloaded_files: Set[str] = set()
+    
+    # Pages already on disk from an earlier run count as resolved
+    page_results: Dict[int, VerificationResult] = {}
+    if manifest:
+        for page_num in manifest.pages:
+            if manifest.is_complete(page_num):
+                entry = manifest.pages[page_num]
+                page_results[page_num] = VerificationResult(
+                    page_num, entry.url, mirror_server(entry.url), os.path.splitext(entry.filename)[1]
+                )
+                downloaded_files.add(manifest.filepath(page_num))
+    stats = FusedDownloadStats()
+    
+    async with use_session(session) as client:
+        if metadata is None:
+            metadata = await fetch_gallery(client, f"https://nhentai.xxx/g/{manga_id}/")
+            stats.requests += 1
+        gallery = metadata.images
+        pattern = gallery.pattern
+        if not pattern:
+            raise ValueError("Could not find image pattern")
+        
+        # URLs expected to work without probing: thumbnails first, then the cache
+        known_urls = {page: (cached.server, cached.url) for page, cached in cached_pages.items()}
+        known_urls.update({page: (thumb.server, thumb.url) for page, thumb in gallery.pages.items()})
+        if manifest:
+            # A partial file can only be resumed from the URL it was started with
+            known_urls.update({
+                page: (mirror_server(entry.url), entry.url)
+                for page, entry in manifest.pages.items()
+            })
+        pinned = {
+            page: mirror_server(entry.url) for page, entry in manifest.pages.items()
+            if manifest.can_resume(page, entry.url)
+        } if manifest else {}
+        
+        def fetch(page_num: int, server: str, mirrors: Optional[List[str]] = None) -> Awaitable[VerificationResult]:
+            known = known_urls.get(page_num)
+            return fetch_and_save_page(
+                client,
+                page_num,
+                pattern,
+                server,
+                manga_dir,
+                IMAGE_HEADERS,
+                downloaded_files,
+                stats,
+                manga_id,
+                probe_order,
+                known[1] if known else None,
+                page_budget,
+                manifest,
+                mirrors,
+                store
+            )
+        
+        def fetch_with_retries(page_num: int, server: str,
+                               mirrors: Optional[List[str]] = None) -> Awaitable[VerificationResult]:
+            return retry_transient(retry_policy, page_num, partial(fetch, page_num, server, mirrors))
         
-        print("Debug - HTML Content:")
-        print(soup.prettify()[:1000])
+        async def gallery_mirrors() -> List[str]:
+            sample = next((r.url for r in page_results.values() if r.url), None) or next(
+                (url for server, url in known_urls.values() if server == working_server), None
+            )
+            if not sample:
+                return [working_server]
+            if gallery_key(sample) not in client.mirrors.galleries:
+                stats.requests += len(IMAGE_SERVERS) - 1
+            return await client.mirrors.gallery_servers(
+                client, sample, IMAGE_SERVERS, IMAGE_HEADERS, VERIFY_TIMEOUT
+            )
+        
+        async def fill(last_page: int) -> None:
+            remaining = [p for p in range(1, last_page + 1) if p not in page_results]
+            if remaining:
+                servers = await gallery_mirrors()
+                for result in await asyncio.gather(*[
+                    fetch_with_retries(p, pinned[p]) if p in pinned else fetch_with_retries(p, working_server, servers)
+                    for p in remaining
+                ]):
+                    page_results[result.page_num] = result
+        
+        if gallery.pages:
+            working_server = next(iter(gallery.pages.values())).server
+        elif cached_pages:
+            working_server = next(iter(cached_pages.values())).server
+        else:
+            # Page 1 doubles as the server probe
+            servers = probe_order.order_servers(manga_id, IMAGE_SERVERS) if probe_order else IMAGE_SERVERS
+            working_server = None
+            for server in servers:
+                first = await fetch(1, server)
+                if first.url:
+                    working_server = server
+                    break
+            if not working_server:
+                raise ValueError("Could not find working image server")
+            page_results[1] = first
         
-        title_element = None
-        selectors = [
-            'div#info > h1',
-            'div#info h1',
-            'h1',
-            'div.title',
-            'h2.title'
-        ]
+        print(f"Using server: {working_server}")
         
-        for selector in selectors:
-            element = soup.select_one(selector)
-            if element:
-                print(f"Found element with selector '{selector}': {element.text.strip()}")
-                if not title_element:
-                    title_element = element
+        page_count = gallery.page_count or cached_count
+        last_page = page_count or gallery.last_page
+        await fill(last_page)
         
-        manga_name = ''
-        if title_element:
-            manga_name = safe_format_filename(title_element.text.strip())
+        if not page_count:
+            # Page count unknown: search past the pages we already have
+            def verify(page_num: int) -> Awaitable[VerificationResult]:
+                return fetch_with_retries(page_num, working_server)
+            
+            if last_page:
+                page_results[last_page + 1] = await verify(last_page + 1)
+                if page_results[last_page + 1].url:
+                    last_page, page_results = await find_last_page(verify, page_results, last_page + 1)
+            else:
+                last_page, page_results = await find_last_page(verify, page_results)
+            await fill(last_page)
+    
+    image_urls, failed_pages = store_page_results(manga_id, page_results, last_page, cache)
+    if manifest:
+        manifest.set_urls(image_urls, None if failed_pages else last_page)
+    return downloaded_files, set(failed_pages), stats
+
+async def download_manga(
+    url: str,
+    cache: Optional[ResolvedUrlCache] = None,
+    probe_order: Optional[ProbeOrderModel] = None,
+    fused: bool = False,
+    session: Optional[HttpSession] = None,
+    download_dir: Optional[str] = None,
+    page_budget: Optional[asyncio.Semaphore] = None,
+    pdf_stage: Optional[PdfStage] = None,
+    hedge: Optional[HedgePolicy] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    store: Optional[ImageStore] = None,
+    metadata: Optional[GalleryMetadata] = None,
+    transcode: Optional[TranscodeOptions] = None
+) -> Tuple[str, List[int]]:
+    """
+    Download manga with parallel verification and downloading
+    
+    :param fused: Resolve and download each page with GETs only, skipping HEAD verification
+    :param session: Shared HTTP session, a temporary one is opened if not given
+    :param download_dir: Base download directory, defaults to ./downloads
+    :param page_budget: Semaphore shared by every gallery in a batch to cap concurrent page downloads
+    :param pdf_stage: Batch PDF stage to hand the finished gallery to, instead of building the PDF here
+    :param hedge: Optional hedging policy for page downloads, shared by the batch
+    :param retry_policy: How failed pages are retried before the PDF is built, RetryPolicy() if not given
+    :param store: Content-addressed store; pages are hardlinked from it instead of stored per gallery
+    :param metadata: Gallery page already fetched for this URL (e.g. by estimate_page_counts)
+    :param transcode: Downscale/re-encode settings for the PDF's pages, applied with or without a pdf_stage
+    """
+    retry_policy = retry_policy or RetryPolicy()
+    manga_id = extract_manga_id(url)
+    base_dir = download_dir or os.path.join(os.getcwd(), 'downloads')
+    os.makedirs(base_dir, exist_ok=True)
+    
+    async with use_session(session) as client:
+        # The gallery page is fetched and parsed once, for the title and the thumbnails
+        if metadata is None:
+            metadata = await fetch_gallery(client, url)
+        
+        manga_name = safe_format_filename(metadata.title)
+        if manga_name:
             print(f"Using manga title: {manga_name}")
         else:
             print("Warning: Could not find manga title")
-            info_div = soup.select_one('#info')
-            if info_div:
-                first_text = info_div.get_text(strip=True).split('\n')[0]
-                manga_name = safe_format_filename(first_text)
-                print(f"Using fallback title from #info: {manga_name}")
         
         manga_dir = os.path.join(base_dir, f"{manga_id}_{manga_name}")
         print(f"Creating directory: {manga_dir}")
         os.makedirs(manga_dir, exist_ok=True)
         
-        print(f"Starting verification and download for manga {manga_id}...")
-        image_urls, _ = await fetch_manga_images(manga_id)
-        
-        if not image_urls:
-            print("No images found to download")
-            return None, []
-        
-        total_pages = len(image_urls)
-        max_concurrent = calculate_optimal_concurrency(total_pages)
-        print(f"\nDownloading {total_pages} images with {max_concurrent} concurrent downloads...")
-        
-        headers = {
-            'Accept': 'image/avif,image/webp,image/png,image/svg+xml,image/*;q=0.8,*/*;q=0.5',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Connection': 'keep-alive',
-            'DNT': '1',
-            'Sec-Fetch-Dest': 'image',
-            'Sec-Fetch-Mode': 'no-cors',
-            'Sec-Fetch-Site': 'cross-site',
-            'Sec-GPC': '1',
-            'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:133.0) Gecko/20100101 Firefox/133',
-            'X-Firefox-Spdy': 'h2'
-        }
-        
-        downloaded_files: Set[str] = set()
-        failed_pages: Set[int] = set()
-        semaphore = asyncio.Semaphore(max_concurrent)
+        manifest = GalleryManifest.load(manga_dir, manga_id)
+        resolved_urls = manifest.resolved_urls()
         
-        async with httpx.AsyncClient(
-            timeout=30.0,
-            follow_redirects=True,
-            verify=False,
-            http2=True
-        ) as client:
-            tasks = []
-            for page_num, img_url in sorted(image_urls.items()):
-                task = download_image(
-                    client,
-                    page_num,
-                    img_url,
-                    manga_dir,
-                    headers,
-                    semaphore,
-                    downloaded_files,
-                    failed_pages,
-                    total_pages
-                )
-                tasks.append(task)
+        if fused and not resolved_urls and not (cache and cache.get_complete_gallery(manga_id)):
+            print(f"Starting fused resolve-and-download for manga {manga_id}...")
+            downloaded_files, failed_pages, stats = await resolve_and_download_images(
+                manga_id, manga_dir, cache, probe_order, client, page_budget, manifest, metadata, retry_policy,
+                store
+            )
+            print(f"Fused mode: {stats.requests} requests for {stats.pages} pages "
+                  f"({stats.requests_saved} requests saved)")
+        else:
+            if resolved_urls:
+                print(f"Resuming manga {manga_id} from {manifest.path}")
+                image_urls = resolved_urls
+            else:
+                print(f"Starting verification and download for manga {manga_id}...")
+                image_urls, missing_pages = await fetch_manga_images(manga_id, cache, probe_order, client, metadata,
+                                                                     retry_policy)
+                if image_urls:
+                    manifest.set_urls(image_urls, None if missing_pages else max(image_urls))
+            
+            if not image_urls:
+                print("No images found to download")
+                if probe_order:
+                    probe_order.flush()
+                return None, []
+            
+            total_pages = len(image_urls)
+            downloaded_files: Set[str] = set(manifest.completed_files())
+            failed_pages: Set[int] = set()
+            remaining = {page: url for page, url in image_urls.items() if not manifest.is_complete(page)}
+            if downloaded_files:
+                print(f"{len(downloaded_files)} pages already downloaded")
+            
+            limits = client.download_limits
+            print(f"\nDownloading {len(remaining)} images with {limits.initial} concurrent downloads per mirror "
+                  f"(adapts up to {limits.max_limit})...")
+            
+            headers = IMAGE_HEADERS
+            
+            # Spread the pages over every mirror that has the gallery
+            mirrors = None
+            if remaining:
+                sample = remaining[min(remaining)]
+                mirrors = await client.mirrors.gallery_servers(client, sample, IMAGE_SERVERS, headers, VERIFY_TIMEOUT)
             
-            await asyncio.gather(*tasks)
+            async def download(page_num: int, img_url: str) -> None:
+                # Transient errors are retried after a backoff, a 404 as soon as the page is resolved again
+                for retry in range(retry_policy.max_retries + 1):
+                    error = await download_image(
+                        client,
+                        page_num,
+                        img_url,
+                        manga_dir,
+                        headers,
+                        downloaded_files,
+                        total_pages,
+                        manga_id,
+                        cache,
+                        page_budget,
+                        manifest,
+                        mirrors,
+                        hedge,
+                        store
+                    )
+                    if error is None:
+                        return
+                    if retry == retry_policy.max_retries:
+                        break
+                    if is_missing(error):
+                        img_url = await resolve_page_again(client, page_num, img_url, metadata.images.pattern,
+                                                           headers, mirrors, manga_id, cache, probe_order, manifest,
+                                                           retry_policy)
+                        if not img_url:
+                            break
+                        print(f"Page {page_num} moved to {img_url}, retrying")
+                    elif is_transient(error):
+                        await retry_policy.wait(page_num, retry, error)
+                    else:
+                        break
+                failed_pages.add(page_num)
+            
+            # The gallery goes on to the PDF only once every page is saved or out of retries
+            await asyncio.gather(*[download(page_num, img_url) for page_num, img_url in sorted(remaining.items())])
+        
+        # The gallery's probe statistics and download progress are written in one go rather than per page
+        if probe_order:
+            probe_order.flush()
+        await manifest.flush()
         
         if downloaded_files:
             print(f"\nDownload completed! Files saved in: {manga_dir}")
-            convert_to_pdf(manga_dir, list(sorted(downloaded_files)))  # Sort files before PDF conversion
+            # Sort files before PDF conversion
+            if pdf_stage:
+                await pdf_stage.submit(manga_dir, sorted(downloaded_files), transcode=transcode)
+            else:
+                await asyncio.to_thread(convert_to_pdf, manga_dir, sorted(downloaded_files), transcode)
             if failed_pages:
                 print(f"Failed to download pages: {sorted(failed_pages)}")  # Sort failed pages for cleaner output
         else:
@@ -493,7 +1227,53 @@ def is_valid_nhentai_xxx_url(url: str) -> bool:
         url = 'https://' + url
     return 'nhentai.xxx/g/' in url
 
-async def main():
+def add_transcode_args(parser: argparse.ArgumentParser) -> None:
+    """Command line options for TranscodeOptions, shared by every script building PDFs"""
+    parser.add_argument('--max-width', type=int,
+                        help="downscale pages wider than this many pixels before building the PDF")
+    parser.add_argument('--jpeg-quality', type=int, choices=range(1, 96), metavar='1-95',
+                        help="re-encode pages as JPEG at this quality when that makes them smaller")
+    parser.add_argument('--webp-to-jpeg', action='store_true',
+                        help="convert WebP pages to JPEG instead of embedding them losslessly")
+
+def transcode_from_args(args: argparse.Namespace) -> Optional[TranscodeOptions]:
+    """TranscodeOptions from the command line, None if none were asked for"""
+    transcode = TranscodeOptions(args.max_width, args.jpeg_quality, args.webp_to_jpeg)
+    return transcode if transcode.enabled else None
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="Download manga listed in constants.txt from nhentai.xxx")
+    parser.add_argument('--fused', action='store_true',
+                        help="resolve and download each page with GETs only, skipping HEAD verification")
+    parser.add_argument('--galleries', type=int, default=DEFAULT_MAX_GALLERIES,
+                        help="number of galleries downloaded concurrently (default: %(default)s)")
+    parser.add_argument('--page-budget', type=int, default=DEFAULT_PAGE_BUDGET,
+                        help="maximum concurrent page downloads across all galleries (default: %(default)s)")
+    parser.add_argument('--max-per-host', type=int, default=DEFAULT_MAX_PER_HOST,
+                        help="most concurrent requests to one server; verification and download "
+                             "concurrency adapt up to this (default: %(default)s)")
+    parser.add_argument('--hedge', action='store_true',
+                        help="send a duplicate request to another mirror for page downloads slower than "
+                             "95%% of recent ones, for at most 5%% extra requests")
+    parser.add_argument('--retries', type=int, default=DEFAULT_MAX_RETRIES,
+                        help="times a failed page is tried again before the PDF is built without it "
+                             "(default: %(default)s)")
+    parser.add_argument('--dedupe', action='store_true',
+                        help="keep each distinct page image once in downloads/.store and hardlink it into "
+                             "every gallery that uses it")
+    parser.add_argument('--shortest-first', action='store_true',
+                        help="start the galleries with the fewest pages first")
+    parser.add_argument('--pdf-workers', type=int, default=default_pdf_workers(),
+                        help="processes building PDFs while downloads continue (default: %(default)s)")
+    add_transcode_args(parser)
+    add_rate_limit_args(parser)
+    return parser.parse_args(argv)
+
+async def main(args: Optional[argparse.Namespace] = None):
+    if args is None:
+        args = parse_args([])
+    
     try:
         with open('constants.txt', 'r') as f:
             urls = [line.strip() for line in f if line.strip()]
@@ -502,6 +1282,10 @@ async def main():
             print("No URLs found in constants.txt")
             return
         
+        cache = ResolvedUrlCache()
+        probe_order = ProbeOrderModel()
+        
+        valid_urls = []
         for url in urls:
             if 'https://' not in url and 'http://' not in url:
                 continue
@@ -510,15 +1294,66 @@ async def main():
                 print(f"Skipping invalid URL (not from nhentai.xxx): {url}")
                 continue
             
-            try:
-                await download_manga(url)
-                print(f"Successfully downloaded manga from: {url}")
-            except Exception as e:
-                print(f"Error downloading manga from {url}: {str(e)}")
-                traceback.print_exc()
+            valid_urls.append(url)
+        
+        transcode = transcode_from_args(args)
+        # Each PDF process gets its share of the cores rather than a thread per core
+        convert = partial(convert_to_pdf, threads=threads_per_worker(args.pdf_workers), raise_errors=True)
+        
+        pdf_stage = None
+        results: List[BatchResult] = []
+        try:
+            session = HttpSession(max_per_host=args.max_per_host, rate_limiter=rate_limiter_from_args(args))
+            async with session, PdfStage(convert, args.pdf_workers) as pdf_stage:
+                page_budget = asyncio.Semaphore(args.page_budget)
+                hedge = HedgePolicy() if args.hedge else None
+                retry_policy = RetryPolicy(max_retries=args.retries)
+                store = ImageStore.in_download_dir(os.path.join(os.getcwd(), 'downloads')) if args.dedupe else None
+                # Gallery pages fetched for the estimates are handed to their downloads
+                galleries: Dict[str, GalleryMetadata] = {}
+                sizes = None
+                if args.shortest_first:
+                    sizes = await estimate_page_counts(valid_urls, session, cache, galleries=galleries)
+            
+                results = await run_batch(
+                    valid_urls,
+                    lambda url: download_manga(
+                        url,
+                        cache,
+                        probe_order,
+                        fused=args.fused,
+                        session=session,
+                        page_budget=page_budget,
+                        pdf_stage=pdf_stage,
+                        hedge=hedge,
+                        retry_policy=retry_policy,
+                        store=store,
+                        metadata=galleries.pop(url, None),
+                        transcode=transcode
+                    ),
+                    args.galleries,
+                    sizes
+                )
+                print(f"\nVerification concurrency settled at {session.verify_limits.summary()}")
+                print(f"Download concurrency settled at {session.download_limits.summary()}")
+                if hedge:
+                    print(hedge.summary())
+                if store:
+                    # Walking the whole store would stall the event loop the hedges and PDF stage run on
+                    library_savings = await asyncio.to_thread(store.library_savings)
+                    print(f"Image store: {store.deduplicated} duplicate pages linked this run, saving "
+                          f"{format_size(store.saved_bytes)}; {format_size(library_savings)} saved across "
+                          f"the library")
+                if session.rate_limiter.waited:
+                    print(f"Rate limits held requests back for {session.rate_limiter.waited:.1f}s in total")
+        finally:
+            # Also on errors and Ctrl-C, so the batched probe statistics are saved and the PDFs still reported
+            probe_order.close()
+            if pdf_stage:
+                pdf_stage.report(results)
     except Exception as e:
         print(f"Error reading constants.txt: {str(e)}")
         traceback.print_exc()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    asyncio.run(main(parse_args()))
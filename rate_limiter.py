@@ -0,0 +1,224 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import asyncio
+import sqlite3
+import argparse
+import httpx
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+# Requests per second to the site itself, and to each image server (i1, i2, ... separately)
+DEFAULT_PAGE_RATE = 5.0
+DEFAULT_IMAGE_RATE = 50.0
+
+# Seconds' worth of requests a host may get at once after being idle
+DEFAULT_BURST = 1.0
+
+DEFAULT_STATE_PATH = os.path.join('.cache', 'rate_limits.sqlite3')
+
+def default_rates(page_rate: float = DEFAULT_PAGE_RATE, image_rate: float = DEFAULT_IMAGE_RATE) -> Dict[str, float]:
+    """Rates keyed by the domain their hosts end with"""
+    return {'nhentai.xxx': page_rate, 'nhentaimg.com': image_rate}
+
+class TokenBucket:
+    """
+    Token bucket for one host, in this process only
+
+    Refills at rate tokens per second up to capacity, and each request takes
+    one. A request that finds it empty takes the next token anyway and sleeps
+    until it is due, so queued requests go out in order at exactly `rate`.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Take a token, returning the seconds to wait before using it"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate) - 1
+        self.updated = now
+        return max(0.0, -self.tokens / self.rate)
+
+    async def take(self) -> float:
+        """reserve() from the event loop"""
+        return self.reserve()
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket for one host kept in a SQLite file, shared by every process that opens it
+
+    Each reservation is a short write transaction, so processes take tokens
+    one at a time and together never go over the rate. It may have to wait for
+    another process's transaction, so take() runs it on the limiter's own
+    thread rather than on the event loop.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, host: str, rate: float, capacity: float,
+                 executor: ThreadPoolExecutor):
+        super().__init__(rate, capacity)
+        self.conn = conn
+        self.host = host
+        self.executor = executor
+
+    async def take(self) -> float:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.reserve)
+
+    def reserve(self) -> float:
+        # Wall-clock time, since the other processes read the same row
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')  # Waits for any other process holding the file
+        try:
+            row = self.conn.execute('SELECT tokens, updated FROM buckets WHERE host = ?', (self.host,)).fetchone()
+            tokens = self.capacity if row is None else min(
+                self.capacity, row[0] + max(0.0, now - row[1]) * self.rate
+            )
+            tokens -= 1
+            self.conn.execute(
+                'INSERT OR REPLACE INTO buckets (host, tokens, updated) VALUES (?, ?, ?)',
+                (self.host, tokens, now)
+            )
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return max(0.0, -tokens / self.rate)
+
+class RateLimiter:
+    """
+    Per-host token buckets that every request waits on before it is sent
+
+    Each host gets its own bucket, with the rate of the longest domain in
+    `rates` it ends with; hosts matching none aren't limited. With a
+    shared_path, the buckets live in that SQLite file and every downloader
+    process using it shares one rate per host. close() releases the file and
+    its thread; they are opened again if the limiter is used after that.
+    """
+
+    def __init__(
+        self,
+        rates: Optional[Dict[str, float]] = None,
+        burst: float = DEFAULT_BURST,
+        shared_path: Optional[str] = None
+    ):
+        """
+        :param rates: Requests per second, keyed by host or by the domain its hosts end with
+        :param burst: Seconds' worth of requests a host may get at once after being idle
+        :param shared_path: SQLite file to share the buckets through, None to keep them in this process
+        """
+        self.rates = default_rates() if rates is None else rates
+        self.burst = burst
+        self.buckets: Dict[str, Optional[TokenBucket]] = {}
+        self.waited = 0.0
+        self.shared_path = shared_path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        if shared_path:
+            os.makedirs(os.path.dirname(os.path.abspath(shared_path)), exist_ok=True)
+            self.open_shared()
+
+    def open_shared(self) -> None:
+        # Autocommit, so each reservation is exactly the transaction reserve() opens.
+        # Reservations all run on the one executor thread, which keeps them in order.
+        self.conn = sqlite3.connect(self.shared_path, timeout=30.0, isolation_level=None, check_same_thread=False)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rate-limit')
+        # The buckets are worthless after a crash, so commits needn't wait for the disk
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                host TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+
+    def rate_for(self, host: str) -> Optional[float]:
+        matches = [domain for domain in self.rates if host == domain or host.endswith('.' + domain)]
+        if not matches:
+            return None
+        return self.rates[max(matches, key=len)] or None
+
+    def bucket(self, host: str) -> Optional[TokenBucket]:
+        if host not in self.buckets:
+            rate = self.rate_for(host)
+            if not rate:
+                self.buckets[host] = None
+            elif self.shared_path:
+                if self.conn is None:
+                    self.open_shared()
+                self.buckets[host] = SharedTokenBucket(self.conn, host, rate, rate * self.burst, self.executor)
+            else:
+                self.buckets[host] = TokenBucket(rate, rate * self.burst)
+        return self.buckets[host]
+
+    async def acquire(self, host: str) -> None:
+        """Wait until a request to host is within its rate"""
+        bucket = self.bucket(host)
+        if bucket is None:
+            return
+        delay = await bucket.take()
+        if delay > 0:
+            self.waited += delay
+            await asyncio.sleep(delay)
+
+    def close(self) -> None:
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+            # Their state is in the file; new buckets pick it up on the next connection
+            self.buckets = {host: bucket for host, bucket in self.buckets.items()
+                            if not isinstance(bucket, SharedTokenBucket)}
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    """Transport that waits on a RateLimiter before every request, redirects included"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, limiter: RateLimiter):
+        self.transport = transport
+        self.limiter = limiter
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await self.limiter.acquire(request.url.host)
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+def rate_limited_transport(limiter: RateLimiter, **kwargs) -> RateLimitedTransport:
+    """httpx.AsyncHTTPTransport(**kwargs) behind the limiter"""
+    return RateLimitedTransport(httpx.AsyncHTTPTransport(**kwargs), limiter)
+
+def add_rate_limit_args(parser: argparse.ArgumentParser) -> None:
+    """Command line options for the rate limits, shared by every script"""
+    parser.add_argument('--page-rate', type=float, default=DEFAULT_PAGE_RATE,
+                        help="most requests per second to nhentai.xxx, 0 for no limit (default: %(default)s)")
+    parser.add_argument('--image-rate', type=float, default=DEFAULT_IMAGE_RATE,
+                        help="most requests per second to each image server, 0 for no limit (default: %(default)s)")
+    parser.add_argument('--shared-rate-limit', nargs='?', const=DEFAULT_STATE_PATH, metavar='PATH',
+                        help="share the rate limits with other downloader processes through this SQLite file "
+                             f"(default: {DEFAULT_STATE_PATH})")
+
+def rate_limiter_from_args(args: argparse.Namespace) -> RateLimiter:
+    return RateLimiter(default_rates(args.page_rate, args.image_rate), shared_path=args.shared_rate_limit)
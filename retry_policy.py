@@ -0,0 +1,92 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import random
+import asyncio
+import httpx
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from adaptive_limit import is_overload
+
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+
+# Statuses whose Retry-After header is followed
+RETRY_AFTER_STATUSES = (429, 503)
+
+def retry_after(error: Optional[BaseException]) -> Optional[float]:
+    """Seconds a 429 or 503 asked us to wait in its Retry-After header, if it sent one"""
+    if not isinstance(error, httpx.HTTPStatusError) or error.response.status_code not in RETRY_AFTER_STATUSES:
+        return None
+    value = error.response.headers.get('Retry-After', '').strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+def is_transient(error: Optional[BaseException]) -> bool:
+    """Whether a failed request is worth repeating as it is: timeouts, connection errors, 429 and 5xx"""
+    return isinstance(error, httpx.TransportError) or is_overload(error=error)
+
+def describe(error: Optional[BaseException]) -> str:
+    """Short form of an error for the log; httpx status errors otherwise come with a paragraph"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return f"HTTP {error.response.status_code}"
+    return str(error) or type(error).__name__
+
+def is_missing(error: Optional[BaseException]) -> bool:
+    """Whether a request failed because the URL is gone, so the page has to be resolved again"""
+    return isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 404
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    Data class to store how often, and how long after, failed pages are tried again
+
+    Retries wait a random time up to base_delay * 2 ** retry (full jitter, so
+    pages that failed together don't come back together), or what the server
+    asked for in Retry-After. Both are capped at max_delay.
+    """
+    max_retries: int = DEFAULT_MAX_RETRIES
+    base_delay: float = DEFAULT_BASE_DELAY
+    max_delay: float = DEFAULT_MAX_DELAY
+
+    def delay(self, retry: int, error: Optional[BaseException] = None) -> float:
+        """
+        Seconds to wait before a retry
+
+        :param retry: Retries already made for the page, 0 before the first one
+        :param error: Error of the failed attempt
+        """
+        asked = retry_after(error)
+        if asked is not None:
+            return min(asked, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+    async def wait(self, page_num: int, retry: int, error: Optional[BaseException] = None) -> None:
+        delay = self.delay(retry, error)
+        print(f"Retrying page {page_num} in {delay:.1f}s ({retry + 1}/{self.max_retries}, {describe(error)})")
+        await asyncio.sleep(delay)
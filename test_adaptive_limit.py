@@ -0,0 +1,72 @@
+import time
+import asyncio
+import unittest
+import httpx
+from adaptive_limit import AdaptiveLimit, HostLimits
+
+class TestAdaptiveLimit(unittest.TestCase):
+    def test_grows_while_healthy_up_to_max(self):
+        limit = AdaptiveLimit('test', initial=2, max_limit=6)
+        # About one more slot per round of `limit` responses: 2 -> 2.5 -> 2.9 -> ... -> 4.09
+        for _ in range(6):
+            limit.observe(time.monotonic(), 200)
+        self.assertEqual(limit.current, 4)
+        for _ in range(100):
+            limit.observe(time.monotonic(), 404)
+        self.assertEqual(limit.current, 6)
+
+    def test_halves_once_per_congestion_event(self):
+        limit = AdaptiveLimit('test', initial=8)
+        started = time.monotonic()
+        limit.observe(started, 429)
+        limit.observe(started, 503)  # Sent before the cut, so it saw the old limit
+        self.assertEqual(limit.current, 4)
+        limit.observe(time.monotonic(), error=httpx.ReadTimeout('slow'))
+        self.assertEqual(limit.current, 2)
+        for _ in range(3):
+            limit.observe(time.monotonic(), 500)
+        self.assertEqual(limit.current, 1)
+
+    def test_slow_responses_and_other_errors_hold_the_limit(self):
+        limit = AdaptiveLimit('test', initial=4)
+        limit.observe(time.monotonic(), 200)
+        grown = limit.limit
+        limit.observe(time.monotonic() - 10, 200)
+        limit.observe(time.monotonic(), error=httpx.ConnectError('refused'))
+        self.assertEqual(limit.limit, grown)
+
+    def test_waiters_start_when_the_limit_grows(self):
+        async def run():
+            limit = AdaptiveLimit('test', initial=1, max_limit=4)
+            started = []
+
+            async def request(n):
+                async with limit:
+                    started.append(n)
+                    await asyncio.sleep(0.05)
+
+            tasks = [asyncio.create_task(request(n)) for n in range(3)]
+            await asyncio.sleep(0.01)
+            self.assertEqual(started, [0])
+            limit.observe(time.monotonic(), 200)  # 1 -> 2
+            limit.observe(time.monotonic(), 200)  # 2 -> 2.5
+            await asyncio.sleep(0.01)
+            self.assertEqual(started, [0, 1])
+            await asyncio.gather(*tasks)
+            self.assertEqual(limit.in_flight, 0)
+
+        asyncio.run(run())
+
+class TestHostLimits(unittest.TestCase):
+    def test_congestion_on_one_host_leaves_the_others_alone(self):
+        limits = HostLimits('download', initial=8, max_limit=16)
+        self.assertIs(limits.get('i2'), limits.get('i2'))
+        limits.get('i2').observe(time.monotonic(), 503)
+        limits.get('i3').observe(time.monotonic(), 200)
+        self.assertEqual(limits.get('i2').current, 4)
+        self.assertEqual(limits.get('i3').current, 8)
+        self.assertEqual(limits.get('i3').max_limit, 16)
+        self.assertEqual(limits.summary(), 'i2: 4, i3: 8')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import asyncio
+import unittest
+import httpx
+from bs4 import BeautifulSoup
+from http_session import HttpSession
+from batch_scheduler import run_batch
+from author_download import parse_args, parse_last_page, search_author
+from project_asynchronous_verification_download import TranscodeOptions, transcode_from_args
+
+def search_page(page, last_page, galleries):
+    items = ''.join(f'<div class="gallery_item"><a href="/g/{g}/">{g}</a></div>' for g in galleries)
+    links = ''.join(f'<a class="page" href="/search/?key=x&page={p}">{p}</a>' for p in range(1, min(last_page, 3) + 1))
+    links += f'<a class="last" href="/search/?key=x&page={last_page}">&raquo;</a>'
+    return f'<html>{items}<div class="pagination">{links}</div></html>'
+
+def fake_session(handler):
+    session = HttpSession()
+    session.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return session
+
+class TestSearchAuthor(unittest.TestCase):
+    def test_parse_last_page(self):
+        soup = BeautifulSoup(search_page(1, 40, []), 'html.parser')
+        self.assertEqual(parse_last_page(soup), 40)
+        self.assertEqual(parse_last_page(BeautifulSoup('<html></html>', 'html.parser')), 1)
+
+    def test_fetches_every_result_page(self):
+        requested = []
+
+        def handler(request):
+            page = int(request.url.params.get('page', 1))
+            requested.append((request.method, page))
+            galleries = [page * 10 + i for i in range(3)] + [1]  # Gallery 1 shows up on every page
+            return httpx.Response(200, text=search_page(page, 5, galleries))
+
+        async def run():
+            async with fake_session(handler) as session:
+                return [result async for result in search_author('x', session, concurrency=2)]
+
+        results = asyncio.run(run())
+        self.assertEqual(sorted(requested), [('GET', page) for page in range(1, 6)])
+        # Page 1 comes first; later pages arrive in any order and duplicates are dropped
+        self.assertEqual(results[:4], [(f'https://nhentai.xxx/g/{g}/', 1) for g in (10, 11, 12, 1)])
+        self.assertEqual(len(results), 16)
+        self.assertIn(('https://nhentai.xxx/g/52/', 5), results)
+
+    def test_links_without_a_gallery_id_are_skipped(self):
+        def handler(request):
+            page = int(request.url.params.get('page', 1))
+            odd_link = '<div class="gallery_item"><a href="/tag/x/">x</a></div>'
+            html = search_page(page, 2, [page * 10]).replace('<html>', '<html>' + odd_link)
+            return httpx.Response(200, text=html)
+
+        async def run():
+            async with fake_session(handler) as session:
+                return [result async for result in search_author('x', session)]
+
+        self.assertEqual(asyncio.run(run()), [('https://nhentai.xxx/g/10/', 1), ('https://nhentai.xxx/g/20/', 2)])
+
+    def test_downloads_start_before_search_finishes(self):
+        release_later_pages = asyncio.Event()
+        events = []
+
+        async def handler(request):
+            page = int(request.url.params.get('page', 1))
+            if page > 1:
+                await release_later_pages.wait()
+            return httpx.Response(200, text=search_page(page, 3, [page * 10]))
+
+        async def download(url):
+            events.append(url)
+            release_later_pages.set()
+
+        async def run():
+            async with fake_session(handler) as session:
+                urls = (url async for url, _ in search_author('x', session))
+                return await run_batch(urls, download, max_galleries=1)
+
+        results = asyncio.run(run())
+        self.assertEqual(events[0], 'https://nhentai.xxx/g/10/')
+        self.assertEqual(len(results), 3)
+
+class TestParseArgs(unittest.TestCase):
+    def test_transcode_options(self):
+        self.assertIsNone(transcode_from_args(parse_args([])))
+        args = parse_args(['--max-width', '1200', '--jpeg-quality', '80', '--webp-to-jpeg'])
+        self.assertEqual(transcode_from_args(args), TranscodeOptions(1200, 80, True))
+
+if __name__ == '__main__':
+    unittest.main()
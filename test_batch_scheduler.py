@@ -0,0 +1,78 @@
+import math
+import asyncio
+import unittest
+import httpx
+from http_session import HttpSession
+from batch_scheduler import run_batch, estimate_page_counts
+
+class TestRunBatch(unittest.TestCase):
+    def test_limits_concurrent_galleries(self):
+        running = []
+        peak = []
+
+        async def download(url):
+            running.append(url)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(url)
+            return url
+
+        urls = [f"https://nhentai.xxx/g/{i}/" for i in range(10)]
+        results = asyncio.run(run_batch(urls, download, max_galleries=3))
+        self.assertEqual(sorted(r.result for r in results), sorted(urls))
+        self.assertEqual(max(peak), 3)
+
+    def test_shortest_first(self):
+        started = []
+
+        async def download(url):
+            started.append(url)
+
+        sizes = {'a': 500, 'b': 10, 'c': 40}
+        asyncio.run(run_batch(['a', 'b', 'c'], download, max_galleries=1, sizes=sizes))
+        self.assertEqual(started, ['b', 'c', 'a'])
+
+    def test_errors_do_not_stop_batch(self):
+        async def download(url):
+            if url == 'bad':
+                raise ValueError("boom")
+            return url
+
+        results = asyncio.run(run_batch(['bad', 'good'], download, max_galleries=1))
+        self.assertEqual({r.url: r.error is None for r in results}, {'bad': False, 'good': True})
+
+    def test_consumes_async_iterable(self):
+        async def urls():
+            for i in range(5):
+                await asyncio.sleep(0)
+                yield f"https://nhentai.xxx/g/{i}/"
+
+        async def download(url):
+            return url
+
+        results = asyncio.run(run_batch(urls(), download, max_galleries=2))
+        self.assertEqual(sorted(r.url for r in results), [f"https://nhentai.xxx/g/{i}/" for i in range(5)])
+
+class TestEstimatePageCounts(unittest.TestCase):
+    def test_keeps_fetched_gallery_pages(self):
+        def handler(request):
+            if request.url.path == '/g/2/':
+                return httpx.Response(404)
+            return httpx.Response(200, text='<div id="info"><h1>Title</h1><span class="tag_name pages">12</span>'
+                                             '</div><img class="lazyload" data-src="https://i1.nhentaimg.com/016/abc/cover.jpg">')
+
+        async def run():
+            async with HttpSession() as session:
+                session.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+                return await estimate_page_counts(urls, session, galleries=galleries)
+
+        urls = ['https://nhentai.xxx/g/1/', 'https://nhentai.xxx/g/2/']
+        galleries = {}
+        sizes = asyncio.run(run())
+        self.assertEqual(sizes, {urls[0]: 12, urls[1]: math.inf})
+        self.assertEqual(list(galleries), [urls[0]])
+        self.assertEqual(galleries[urls[0]].title, 'Title')
+        self.assertEqual(galleries[urls[0]].images.pattern.pattern, '016/abc')
+
+if __name__ == '__main__':
+    unittest.main()
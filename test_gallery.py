@@ -0,0 +1,48 @@
+import unittest
+from gallery import parse_gallery, parse_gallery_images
+
+GALLERY_HTML = """
+<div id="info">
+    <h1>Some Title</h1>
+    <li class="tags"><span class="tags_text">Pages:</span><a class="tag_btn"><span class="tag_name pages">4</span></a></li>
+</div>
+<img class="lazyload" data-src="https://i4.nhentaimg.com/016/abc123/cover.jpg">
+<img class="lazyload" data-src="https://i4.nhentaimg.com/016/abc123/1t.jpg">
+<img class="lazyload" data-src="https://i4.nhentaimg.com/016/abc123/2t.png">
+<img class="lazyload" data-src="https://i4.nhentaimg.com/016/abc123/4t.webp">
+<img class="lazyload" data-src="https://i2.nhentaimg.com/010/other/1t.jpg">
+"""
+
+class TestParseGalleryImages(unittest.TestCase):
+    def test_pages_from_thumbnails(self):
+        gallery = parse_gallery_images(GALLERY_HTML)
+        self.assertEqual(gallery.pattern.pattern, '016/abc123')
+        self.assertEqual(gallery.page_count, 4)
+        self.assertEqual(sorted(gallery.pages), [1, 2, 4])
+        self.assertEqual(gallery.pages[2].url, 'https://i4.nhentaimg.com/016/abc123/2.png')
+        self.assertEqual(gallery.pages[4].extension, '.webp')
+        self.assertEqual(gallery.missing_pages, [3])
+
+    def test_page_count_falls_back_to_thumbnails(self):
+        gallery = parse_gallery_images(GALLERY_HTML.replace('Pages:', '').replace('>4<', '><'))
+        self.assertIsNone(gallery.page_count)
+        self.assertEqual(gallery.last_page, 4)
+
+    def test_no_thumbnails(self):
+        gallery = parse_gallery_images("<html><body>Nothing here</body></html>")
+        self.assertIsNone(gallery.pattern)
+        self.assertEqual(gallery.last_page, 0)
+
+class TestParseGallery(unittest.TestCase):
+    def test_title_and_images_from_one_parse(self):
+        metadata = parse_gallery('https://nhentai.xxx/g/1/', GALLERY_HTML, verbose=False)
+        self.assertEqual(metadata.title, 'Some Title')
+        self.assertEqual(sorted(metadata.images.pages), [1, 2, 4])
+
+    def test_title_fallbacks(self):
+        html = '<div id="info"><span>Plain title</span></div>'
+        self.assertEqual(parse_gallery('', html, verbose=False).title, 'Plain title')
+        self.assertEqual(parse_gallery('', '<html></html>', verbose=False).title, '')
+
+if __name__ == '__main__':
+    unittest.main()
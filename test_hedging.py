@@ -0,0 +1,66 @@
+import asyncio
+import unittest
+from hedging import HedgePolicy, hedged
+
+def warmed_up(seconds=0.01, **kwargs):
+    policy = HedgePolicy(min_samples=5, **kwargs)
+    for _ in range(5):
+        policy.record(seconds)
+    return policy
+
+class TestHedging(unittest.TestCase):
+    def test_no_hedge_before_enough_samples(self):
+        calls = []
+
+        async def request(name):
+            calls.append(name)
+            await asyncio.sleep(0.02)
+            return name
+
+        policy = HedgePolicy(min_samples=5, budget=1.0)
+        result = asyncio.run(hedged(policy, lambda: request('primary'), lambda: request('hedge')))
+        self.assertEqual(result, 'primary')
+        self.assertEqual(calls, ['primary'])
+        self.assertIsNone(HedgePolicy(min_samples=5).delay())
+
+    def test_slow_primary_loses_to_hedge(self):
+        cancelled = []
+
+        async def primary():
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append('primary')
+                raise
+            return 'primary'
+
+        async def hedge():
+            return 'hedge'
+
+        policy = warmed_up(budget=1.0)
+        self.assertEqual(asyncio.run(hedged(policy, primary, hedge)), 'hedge')
+        self.assertEqual(cancelled, ['primary'])
+        self.assertEqual((policy.hedges, policy.hedge_wins), (1, 1))
+
+    def test_budget_limits_hedges(self):
+        policy = HedgePolicy(budget=0.05)
+        for _ in range(100):
+            policy.start_request()
+            policy.try_hedge()  # Every request would like a hedge
+        self.assertEqual(policy.requests, 100)
+        self.assertEqual(policy.hedges, 5)
+
+    def test_primary_error_when_both_fail(self):
+        async def primary():
+            await asyncio.sleep(0.05)
+            raise ValueError('primary')
+
+        async def hedge():
+            raise KeyError('hedge')
+
+        policy = warmed_up(budget=1.0)
+        with self.assertRaisesRegex(ValueError, 'primary'):
+            asyncio.run(hedged(policy, primary, hedge))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import io
+import unittest
+from PIL import Image
+from image_header import sniff_image
+
+def encode(img, fmt, **kwargs):
+    buffer = io.BytesIO()
+    img.save(buffer, fmt, **kwargs)
+    buffer.seek(0)
+    return buffer
+
+class TestSniffImage(unittest.TestCase):
+    def setUp(self):
+        self.rgb = Image.new('RGB', (37, 53), (10, 200, 30))
+        self.rgba = self.rgb.convert('RGBA')
+        self.rgba.putalpha(100)
+
+    def assertHeader(self, buffer, fmt, has_alpha):
+        header = sniff_image(buffer)
+        self.assertEqual((header.format, header.width, header.height), (fmt, 37, 53))
+        self.assertEqual(header.has_alpha, has_alpha)
+        return header
+
+    def test_jpeg(self):
+        header = self.assertHeader(encode(self.rgb, 'JPEG', progressive=True, dpi=(300, 300)), 'JPEG', False)
+        self.assertEqual(header.components, 3)
+        self.assertEqual(header.dpi, (300.0, 300.0))
+        self.assertEqual(sniff_image(encode(self.rgb.convert('CMYK'), 'JPEG')).components, 4)
+
+    def test_png_colour_type_and_trns(self):
+        self.assertHeader(encode(self.rgb, 'PNG'), 'PNG', False)
+        self.assertHeader(encode(self.rgba, 'PNG'), 'PNG', True)
+        self.assertHeader(encode(self.rgb.convert('LA'), 'PNG'), 'PNG', True)
+        self.assertHeader(encode(self.rgb.convert('P'), 'PNG'), 'PNG', False)
+        self.assertHeader(encode(self.rgb.convert('P'), 'PNG', transparency=0), 'PNG', True)
+
+    def test_webp_alpha_flags(self):
+        self.assertHeader(encode(self.rgb, 'WEBP'), 'WEBP', False)
+        self.assertHeader(encode(self.rgb, 'WEBP', lossless=True), 'WEBP', False)
+        self.assertHeader(encode(self.rgba, 'WEBP'), 'WEBP', True)
+        self.assertHeader(encode(self.rgba, 'WEBP', lossless=True), 'WEBP', True)
+
+    def test_unknown_or_truncated(self):
+        self.assertIsNone(sniff_image(encode(self.rgb, 'GIF')))
+        self.assertIsNone(sniff_image(io.BytesIO(encode(self.rgb, 'JPEG').read(20))))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import asyncio
+import hashlib
+import tempfile
+import unittest
+from unittest import mock
+import httpx
+from image_store import ImageStore
+from page_writer import stream_to_file, part_path
+
+class TestImageStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = ImageStore.in_download_dir(self.tmpdir.name)
+        self.body = os.urandom(300 * 1024)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def page(self, gallery, name='001.jpg'):
+        manga_dir = os.path.join(self.tmpdir.name, gallery)
+        os.makedirs(manga_dir, exist_ok=True)
+        return os.path.join(manga_dir, name)
+
+    def save(self, filepath, body, **kwargs):
+        return asyncio.run(stream_to_file(httpx.Response(200, content=body), filepath, store=self.store, **kwargs))
+
+    def test_same_page_in_two_galleries_is_stored_once(self):
+        first, second = self.page('1_original'), self.page('2_translation', '005.jpg')
+        self.save(first, self.body)
+        self.save(second, self.body)
+
+        blob = self.store.blob_path(hashlib.sha256(self.body).hexdigest())
+        self.assertEqual(os.stat(first).st_ino, os.stat(blob).st_ino)
+        self.assertEqual(os.stat(second).st_ino, os.stat(blob).st_ino)
+        self.assertEqual(os.stat(blob).st_nlink, 3)
+        with open(second, 'rb') as f:
+            self.assertEqual(f.read(), self.body)
+        self.assertFalse(os.path.exists(part_path(second)))
+        self.assertEqual((self.store.stored, self.store.deduplicated), (1, 1))
+        self.assertEqual(self.store.saved_bytes, len(self.body))
+        self.assertEqual(self.store.library_savings(), len(self.body))
+
+    def test_resumed_page_is_hashed_whole(self):
+        filepath = self.page('1_original')
+        with open(part_path(filepath), 'wb') as f:
+            f.write(self.body[:1000])
+        response = httpx.Response(206, content=self.body[1000:])
+        asyncio.run(stream_to_file(response, filepath, append=True, store=self.store))
+        self.assertTrue(os.path.exists(self.store.blob_path(hashlib.sha256(self.body).hexdigest())))
+
+    def test_keeps_a_copy_without_hardlinks(self):
+        filepath = self.page('1_original')
+        with mock.patch('os.link', side_effect=OSError('not supported')):
+            self.save(filepath, self.body)
+        with open(filepath, 'rb') as f:
+            self.assertEqual(f.read(), self.body)
+        self.assertEqual(os.stat(filepath).st_nlink, 1)
+        self.assertEqual(self.store.stored, 0)
+
+if __name__ == '__main__':
+    unittest.main()
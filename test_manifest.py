@@ -0,0 +1,83 @@
+import os
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+from manifest import GalleryManifest, COMPLETE, PARTIAL
+
+class TestGalleryManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.manga_dir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_page(self, filename, data=b'abcd'):
+        with open(os.path.join(self.manga_dir, filename), 'wb') as f:
+            f.write(data)
+
+    def test_round_trip(self):
+        manifest = GalleryManifest(self.manga_dir, '123')
+        manifest.set_urls({
+            1: 'https://i4.nhentaimg.com/016/abc/1.jpg',
+            2: 'https://i4.nhentaimg.com/016/abc/2.png'
+        }, page_count=2)
+        self.write_page('001.jpg')
+        manifest.mark_partial(1, 'https://i4.nhentaimg.com/016/abc/1.jpg', '001.jpg', 4)
+        manifest.mark_complete(1, 4)
+
+        loaded = GalleryManifest.load(self.manga_dir, '123')
+        self.assertEqual(loaded.page_count, 2)
+        self.assertEqual(loaded.pages[1].status, COMPLETE)
+        self.assertEqual(loaded.pages[2].filename, '002.png')
+        self.assertEqual(loaded.resolved_urls()[2], 'https://i4.nhentaimg.com/016/abc/2.png')
+        self.assertEqual(loaded.completed_files(), [os.path.join(self.manga_dir, '001.jpg')])
+
+    def test_size_mismatch_is_incomplete(self):
+        manifest = GalleryManifest(self.manga_dir, '123')
+        manifest.mark_partial(1, 'https://i4.nhentaimg.com/016/abc/1.jpg', '001.jpg', 10)
+        self.assertTrue(manifest.can_resume(1, 'https://i4.nhentaimg.com/016/abc/1.jpg'))
+        self.assertFalse(manifest.can_resume(1, 'https://i4.nhentaimg.com/016/abc/1.png'))
+
+        self.write_page('001.jpg')
+        manifest.mark_complete(1, 10)
+        self.assertFalse(manifest.is_complete(1))
+
+    def test_changed_url_resets_page(self):
+        manifest = GalleryManifest(self.manga_dir, '123')
+        manifest.mark_partial(1, 'https://i4.nhentaimg.com/016/abc/1.jpg', '001.jpg', None)
+        manifest.set_urls({1: 'https://i4.nhentaimg.com/016/abc/1.webp'})
+        self.assertEqual(manifest.pages[1].filename, '001.webp')
+        self.assertNotEqual(manifest.pages[1].status, PARTIAL)
+
+        # Incomplete galleries are resolved again
+        self.assertIsNone(manifest.resolved_urls())
+        manifest.forget(1)
+        self.assertNotIn(1, GalleryManifest.load(self.manga_dir).pages)
+
+    def test_other_gallery_ignored(self):
+        GalleryManifest(self.manga_dir, '123').set_urls({1: 'https://i4.nhentaimg.com/016/abc/1.jpg'}, 1)
+        self.assertEqual(GalleryManifest.load(self.manga_dir, '456').pages, {})
+
+    def test_saves_are_batched_in_an_event_loop(self):
+        manifest = GalleryManifest(self.manga_dir, '123', save_delay=60)
+        urls = {page: f'https://i4.nhentaimg.com/016/abc/{page}.jpg' for page in range(1, 101)}
+
+        async def download():
+            manifest.set_urls(urls, page_count=100)
+            for page, url in urls.items():
+                manifest.mark_partial(page, url, f'{page:03d}.jpg', 4)
+                self.write_page(f'{page:03d}.jpg')
+                manifest.mark_complete(page, 4)
+            self.assertFalse(os.path.exists(manifest.path))
+            await manifest.flush()
+
+        with mock.patch.object(manifest, 'write', wraps=manifest.write) as write:
+            asyncio.run(download())
+        self.assertEqual(write.call_count, 1)
+        loaded = GalleryManifest.load(self.manga_dir, '123')
+        self.assertEqual(len(loaded.completed_files()), 100)
+
+if __name__ == '__main__':
+    unittest.main()
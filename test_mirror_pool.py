@@ -0,0 +1,64 @@
+import time
+import asyncio
+import unittest
+import httpx
+from mirror_pool import MirrorPool, gallery_key, mirror_server, mirror_url
+
+URL = 'https://i3.nhentaimg.com/016/abc123/7.jpg'
+
+class TestMirrorPool(unittest.TestCase):
+    def test_url_helpers(self):
+        self.assertEqual(mirror_url(URL, 'i5'), 'https://i5.nhentaimg.com/016/abc123/7.jpg')
+        self.assertEqual(mirror_server(URL), 'i3')
+        self.assertEqual(gallery_key(URL), '/016/abc123')
+
+    def test_rotation_prefers_shortest_expected_wait(self):
+        pool = MirrorPool()
+        pool.observe('i1', time.monotonic() - 0.05, 200)
+        pool.observe('i2', time.monotonic() - 0.03, 200)
+        self.assertEqual(pool.rotation(['i1', 'i2']), ['i2', 'i1'])
+        pool.get('i2').in_flight = 3
+        self.assertEqual(pool.rotation(['i1', 'i2']), ['i1', 'i2'])
+
+    def test_failing_mirror_leaves_rotation(self):
+        pool = MirrorPool(failure_limit=3)
+        for _ in range(5):
+            pool.observe('i1', time.monotonic(), 404)  # Missing file, not an unhealthy mirror
+        pool.observe('i1', time.monotonic(), 503)
+        pool.observe('i1', time.monotonic(), error=httpx.ConnectError('refused'))
+        self.assertFalse(pool.is_benched('i1'))
+        pool.observe('i1', time.monotonic(), error=httpx.ReadTimeout('slow'))
+        self.assertTrue(pool.is_benched('i1'))
+        # Benched mirrors stay available as a last resort
+        self.assertEqual(pool.rotation(['i1', 'i2']), ['i2', 'i1'])
+
+    def test_slow_mirror_leaves_rotation(self):
+        pool = MirrorPool(slow_factor=3.0)
+        pool.observe('i1', time.monotonic() - 0.01, 200)
+        pool.observe('i2', time.monotonic() - 0.02, 200)
+        self.assertFalse(pool.is_benched('i2'))
+        pool.observe('i3', time.monotonic() - 0.5, 200)
+        self.assertTrue(pool.is_benched('i3'))
+        self.assertIsNone(pool.get('i3').latency)
+
+    def test_gallery_servers_checks_each_mirror_once(self):
+        requested = []
+
+        def handler(request):
+            requested.append(request.url.host)
+            return httpx.Response(200 if request.url.host.startswith(('i1.', 'i4.')) else 404)
+
+        async def run():
+            pool = MirrorPool()
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                first = await pool.gallery_servers(client, URL, ['i1', 'i2', 'i3', 'i4'], {})
+                again = await pool.gallery_servers(client, mirror_url(URL, 'i1'), ['i1', 'i2', 'i3', 'i4'], {})
+            return first, again
+
+        first, again = asyncio.run(run())
+        self.assertEqual(first, ['i3', 'i1', 'i4'])
+        self.assertEqual(again, first)
+        self.assertEqual(sorted(requested), ['i1.nhentaimg.com', 'i2.nhentaimg.com', 'i4.nhentaimg.com'])
+
+if __name__ == '__main__':
+    unittest.main()
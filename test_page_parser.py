@@ -0,0 +1,49 @@
+import unittest
+from bs4 import BeautifulSoup
+from gallery import find_gallery_images, find_title
+from author_download import parse_last_page, parse_search_results
+from page_parser import DEFAULT_BACKEND, GALLERY_LINKS, GALLERY_TAGS, LISTING_TAGS, parse_html
+from test_gallery import GALLERY_HTML
+
+PAGE = """
+<html><head><title>ignored</title><script>var x = '<div id="info">';</script></head>
+<body>
+<nav><a href="/">Home</a><img src="/logo.svg"></nav>
+""" + GALLERY_HTML + """
+<div class="gallery_item"><a href="/g/111/">One</a></div>
+<div class="gallery_item"><a href="/g/222/">Two</a></div>
+<div class="pagination"><a href="?page=1">1</a><a class="last" href="?page=9">&raquo;</a></div>
+</body></html>
+"""
+
+BACKENDS = ['html.parser'] + (['lxml'] if DEFAULT_BACKEND == 'lxml' else [])
+
+class TestParseHtml(unittest.TestCase):
+    def setUp(self):
+        self.whole = BeautifulSoup(PAGE, 'html.parser')
+
+    def test_filtered_gallery_reads_the_same(self):
+        expected = find_gallery_images(self.whole, verbose=False)
+        for backend in BACKENDS:
+            soup = parse_html(PAGE, GALLERY_TAGS, backend)
+            images = find_gallery_images(soup, verbose=False)
+            self.assertEqual(find_title(soup, verbose=False), 'Some Title')
+            self.assertEqual((images.pattern, images.pages, images.page_count),
+                             (expected.pattern, expected.pages, expected.page_count))
+            self.assertIsNone(soup.find('nav'))
+            self.assertIsNone(soup.find('div', class_='gallery_item'))
+
+    def test_filtered_listing_reads_the_same(self):
+        for backend in BACKENDS:
+            soup = parse_html(PAGE, LISTING_TAGS, backend)
+            self.assertEqual(parse_search_results(soup), parse_search_results(self.whole))
+            self.assertEqual(parse_last_page(soup), 9)
+            self.assertIsNone(soup.find('h1'))
+
+    def test_gallery_links(self):
+        for backend in BACKENDS:
+            soup = parse_html(PAGE, GALLERY_LINKS, backend)
+            self.assertEqual([a['href'] for a in soup.find_all('a')], ['/g/111/', '/g/222/'])
+
+if __name__ == '__main__':
+    unittest.main()
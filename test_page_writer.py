@@ -0,0 +1,74 @@
+import os
+import asyncio
+import tempfile
+import unittest
+import httpx
+from page_writer import stream_to_file, part_path, expected_size, resumed_from, WRITE_BUFFER_SIZE
+
+class FailingStream(httpx.AsyncByteStream):
+    async def __aiter__(self):
+        yield b'x' * 1024
+        raise httpx.ReadError('connection dropped')
+
+class CancelledDuringWrite(httpx.AsyncByteStream):
+    """Cancels the download while its first full buffer is being written by the worker thread"""
+
+    async def __aiter__(self):
+        # Runs once the task is waiting on the write, before the thread is done
+        asyncio.get_running_loop().call_soon(asyncio.current_task().cancel)
+        yield b'x' * WRITE_BUFFER_SIZE
+        yield b'y' * 1024
+
+class TestStreamToFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filepath = os.path.join(self.tmpdir.name, '001.jpg')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_writes_whole_body(self):
+        body = os.urandom(600 * 1024)
+        response = httpx.Response(200, content=body)
+        written = asyncio.run(stream_to_file(response, self.filepath))
+
+        self.assertEqual(written, len(body))
+        with open(self.filepath, 'rb') as f:
+            self.assertEqual(f.read(), body)
+        self.assertFalse(os.path.exists(part_path(self.filepath)))
+
+    def test_failed_stream_leaves_nothing(self):
+        response = httpx.Response(200, stream=FailingStream())
+        with self.assertRaises(httpx.ReadError):
+            asyncio.run(stream_to_file(response, self.filepath))
+
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_resume_partial_file(self):
+        body = os.urandom(1000)
+        with open(part_path(self.filepath), 'wb') as f:
+            f.write(body[:400])
+        response = httpx.Response(206, content=body[400:], headers={'Content-Range': 'bytes 400-999/1000'})
+        self.assertTrue(resumed_from(response, 400))
+        self.assertEqual(expected_size(response), 1000)
+
+        size = asyncio.run(stream_to_file(response, self.filepath, append=True, size=1000))
+        self.assertEqual(size, 1000)
+        with open(self.filepath, 'rb') as f:
+            self.assertEqual(f.read(), body)
+
+    def test_keep_partial_on_failure(self):
+        response = httpx.Response(200, stream=FailingStream())
+        with self.assertRaises(httpx.ReadError):
+            asyncio.run(stream_to_file(response, self.filepath, keep_partial=True))
+        self.assertEqual(os.path.getsize(part_path(self.filepath)), 1024)
+
+    def test_cancelled_write_is_kept_once(self):
+        response = httpx.Response(200, stream=CancelledDuringWrite())
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(stream_to_file(response, self.filepath, keep_partial=True))
+        # The buffer the thread was writing is in the temp file exactly once, ready for a Range resume
+        self.assertEqual(os.path.getsize(part_path(self.filepath)), WRITE_BUFFER_SIZE)
+
+if __name__ == '__main__':
+    unittest.main()
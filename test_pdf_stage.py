@@ -0,0 +1,102 @@
+import io
+import os
+import asyncio
+import tempfile
+import unittest
+from functools import partial
+from contextlib import redirect_stdout
+from batch_scheduler import BatchResult
+from unittest import mock
+from pdf_stage import PdfJob, PdfStage, busy_time, overlap_time, threads_per_worker
+from project_asynchronous_verification_download import convert_to_pdf
+
+def write_page_list(manga_dir, downloaded_files, name='pages.txt'):
+    with open(os.path.join(manga_dir, name), 'w') as f:
+        f.write('\n'.join(downloaded_files))
+
+class TestIntervals(unittest.TestCase):
+    def test_busy_time_merges_overlaps(self):
+        self.assertEqual(busy_time([(0, 2), (1, 3), (5, 6)]), 4)
+        self.assertEqual(busy_time([]), 0)
+
+    def test_overlap_time(self):
+        downloads = [(0, 4), (6, 10)]
+        pdfs = [(3, 7), (9, 12)]
+        self.assertEqual(overlap_time(downloads, pdfs), 3)
+        self.assertEqual(overlap_time(downloads, [(4, 6)]), 0)
+
+class TestThreadsPerWorker(unittest.TestCase):
+    def test_workers_share_the_cores(self):
+        with mock.patch('os.cpu_count', return_value=8):
+            self.assertEqual(threads_per_worker(7), 1)
+            self.assertEqual(threads_per_worker(2), 4)
+            self.assertEqual(threads_per_worker(1), 8)
+        with mock.patch('os.cpu_count', return_value=None):
+            self.assertEqual(threads_per_worker(1), 2)
+
+class TestPdfStage(unittest.TestCase):
+    def test_builds_every_submitted_gallery(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dirs = [os.path.join(tmpdir, str(i)) for i in range(3)]
+            for manga_dir in dirs:
+                os.makedirs(manga_dir)
+
+            async def run():
+                async with PdfStage(write_page_list, workers=2, max_pending=1) as stage:
+                    for manga_dir in dirs:
+                        await stage.submit(manga_dir, ['001.jpg', '002.jpg'])
+                return stage
+
+            stage = asyncio.run(run())
+            self.assertEqual(len(stage.jobs), 3)
+            self.assertTrue(all(job.error is None for job in stage.jobs))
+            self.assertTrue(all(0 < job.submitted <= job.started for job in stage.jobs))
+            for manga_dir in dirs:
+                with open(os.path.join(manga_dir, 'pages.txt')) as f:
+                    self.assertEqual(f.read(), '001.jpg\n002.jpg')
+
+            # Report works from plain batch results
+            stage.report([BatchResult('url', started=stage.jobs[0].started, elapsed=1.0)])
+
+    def test_submit_options_reach_convert(self):
+        with tempfile.TemporaryDirectory() as manga_dir:
+            async def run():
+                async with PdfStage(write_page_list, workers=1) as stage:
+                    await stage.submit(manga_dir, ['001.jpg'], name='other.txt')
+
+            asyncio.run(run())
+            self.assertEqual(os.listdir(manga_dir), ['other.txt'])
+
+    def test_download_ends_when_the_gallery_is_submitted(self):
+        stage = PdfStage(write_page_list, workers=1)
+        stage.jobs = [PdfJob('manga/1', 2, started=8.0, submitted=3.0)]
+        # Waiting for room in the queue until 7.0 isn't download time
+        blocked = BatchResult('url1', ('manga/1', []), started=1.0, elapsed=6.0)
+        self.assertEqual(stage.download_span(blocked), (1.0, 3.0))
+        unrelated = BatchResult('url2', ('manga/2', []), started=1.0, elapsed=6.0)
+        self.assertEqual(stage.download_span(unrelated), (1.0, 7.0))
+        failed = BatchResult('url3', error=ValueError('no gallery'), started=1.0, elapsed=2.0)
+        self.assertEqual(stage.download_span(failed), (1.0, 3.0))
+
+class TestFailedPdf(unittest.TestCase):
+    def test_failed_build_is_reported(self):
+        with tempfile.TemporaryDirectory() as manga_dir:
+            page = os.path.join(manga_dir, '001.jpg')
+            with open(page, 'wb') as f:
+                f.write(b'not an image')
+
+            async def run():
+                async with PdfStage(partial(convert_to_pdf, raise_errors=True), workers=1) as stage:
+                    await stage.submit(manga_dir, [page])
+                return stage
+
+            output = io.StringIO()
+            with redirect_stdout(output):
+                stage = asyncio.run(run())
+                stage.report([BatchResult('url', started=stage.jobs[0].started, elapsed=1.0)])
+
+        self.assertIsNotNone(stage.jobs[0].error)
+        self.assertIn('0/1 PDFs built', output.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import re
+import tempfile
+import unittest
+from PIL import Image
+from pdf_writer import write_pdf, load_image
+
+class TestStreamingPdfWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def save(self, name, img, fmt):
+        path = os.path.join(self.tmpdir.name, name)
+        img.save(path, fmt)
+        return path
+
+    def test_xref_points_at_objects(self):
+        files = [
+            self.save('001.jpg', Image.new('RGB', (40, 60), 'red'), 'JPEG'),
+            self.save('002.png', Image.new('RGB', (40, 60), 'blue'), 'PNG'),
+            self.save('003.png', Image.new('RGBA', (40, 60), (0, 0, 255, 128)), 'PNG'),
+            self.save('004.webp', Image.new('RGB', (40, 60), 'green'), 'WEBP')
+        ]
+        pdf_path = os.path.join(self.tmpdir.name, 'out.pdf')
+        self.assertEqual(write_pdf(pdf_path, files), 4)
+
+        with open(pdf_path, 'rb') as f:
+            pdf = f.read()
+        self.assertTrue(pdf.startswith(b'%PDF-1.5'))
+        self.assertTrue(pdf.endswith(b'%%EOF\n'))
+        self.assertIn(b'/Count 4', pdf)
+        self.assertIn(b'/SMask', pdf)
+
+        startxref = int(re.search(rb'startxref\n(\d+)', pdf).group(1))
+        entries = re.findall(rb'(\d{10}) 00000 n ', pdf[startxref:])
+        for obj_id, offset in enumerate(entries, 1):
+            self.assertTrue(pdf[int(offset):].startswith(f'{obj_id} 0 obj'.encode()))
+
+        # JPEG data is embedded verbatim
+        with open(files[0], 'rb') as f:
+            self.assertIn(f.read(), pdf)
+
+    def test_passthrough_only_when_lossless(self):
+        opaque = self.save('001.png', Image.new('RGB', (10, 10), 'red'), 'PNG')
+        alpha = self.save('002.png', Image.new('RGBA', (10, 10), (255, 0, 0, 0)), 'PNG')
+        self.assertTrue(load_image(opaque).segments)
+        self.assertFalse(load_image(alpha).segments)
+        self.assertIsNotNone(load_image(alpha).smask)
+
+    def test_failed_page_removes_pdf(self):
+        broken = os.path.join(self.tmpdir.name, '001.jpg')
+        with open(broken, 'wb') as f:
+            f.write(b'not an image')
+        pdf_path = os.path.join(self.tmpdir.name, 'out.pdf')
+        with self.assertRaises(Exception):
+            write_pdf(pdf_path, [broken])
+        self.assertFalse(os.path.exists(pdf_path))
+
+if __name__ == '__main__':
+    unittest.main()
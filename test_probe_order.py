@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+from probe_order import ProbeOrderModel
+from project_asynchronous_verification_download import ImagePattern, build_candidate_urls
+
+class TestProbeOrderModel(unittest.TestCase):
+    def setUp(self):
+        self.model = ProbeOrderModel(':memory:')
+        self.pattern = ImagePattern('016/abc', '016')
+
+    def tearDown(self):
+        self.model.close()
+
+    def test_candidates_are_unique(self):
+        candidates = build_candidate_urls(1, self.pattern, 'i4')
+        self.assertEqual(len(candidates), len({c.url for c in candidates}))
+        self.assertEqual(candidates[0].url, 'http://i4.nhentaimg.com/016/abc/1.jpg')
+
+    def test_gallery_statistics_reorder_candidates(self):
+        png = [c for c in build_candidate_urls(1, self.pattern, 'i4') if c.extension == '.png' and c.scheme == 'https'][0]
+        self.model.record_success('123456', png)
+
+        ordered = self.model.order_candidates('123456', build_candidate_urls(2, self.pattern, 'i4'))
+        self.assertEqual(ordered[0].url, 'https://i4.nhentaimg.com/016/abc/2.png')
+
+    def test_gallery_statistics_beat_global(self):
+        candidates = build_candidate_urls(1, self.pattern, 'i4')
+        jpg, webp = candidates[0], [c for c in candidates if c.extension == '.webp'][0]
+        for _ in range(3):
+            self.model.record_success('111', jpg)
+        self.model.record_success('222', webp)
+
+        self.assertEqual(self.model.order_candidates('222', candidates)[0], webp)
+        self.assertEqual(self.model.order_candidates('333', candidates)[0], jpg)
+
+    def test_order_servers(self):
+        candidate = build_candidate_urls(1, self.pattern, 'i3')[0]
+        self.model.record_success('123456', candidate)
+        self.assertEqual(self.model.order_servers('999', ['i1', 'i2', 'i3'])[0], 'i3')
+
+    def test_successes_are_written_on_flush(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'probe_stats.sqlite3')
+            model = ProbeOrderModel(path)
+            candidate = build_candidate_urls(1, self.pattern, 'i3')[0]
+            model.record_success('123456', candidate)
+            model.record_success('123456', candidate)
+            count = "SELECT COUNT(*) FROM probe_stats"
+            self.assertEqual(model.conn.execute(count).fetchone()[0], 0)
+
+            model.flush()
+            model.record_success('123456', candidate)
+            model.close()
+
+            reopened = ProbeOrderModel(path)
+            # Only the global scope is read up front; the gallery's counts come in when it is asked about
+            self.assertEqual(list(reopened.counts), [''])
+            self.assertEqual(reopened.scope_counts('123456')[candidate.key], 3)
+            self.assertEqual(reopened.scope_counts('')[candidate.key], 3)
+            reopened.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,12 @@
+import os
+import asyncio
+import tempfile
 import unittest
-from project import extract_manga_id, safe_format_filename, is_valid_nhentai_xxx_url
+from unittest import mock
+import httpx
+import project
+from gallery import parse_gallery
+from project import extract_manga_id, safe_format_filename, is_valid_nhentai_xxx_url, download_if_found
 
 class TestNhentaiDownloader(unittest.TestCase):
     def test_extract_manga_id(self):
@@ -44,5 +51,55 @@ class TestNhentaiDownloader(unittest.TestCase):
         self.assertFalse(is_valid_nhentai_xxx_url("invalid-url"))
         self.assertFalse(is_valid_nhentai_xxx_url(""))
 
+class TestFusedMode(unittest.TestCase):
+    def site(self, pages, requested):
+        def handler(request):
+            requested.append(str(request.url))
+            if str(request.url) in pages:
+                return httpx.Response(200, content=b'image ' + str(request.url).encode())
+            return httpx.Response(404, content=b'<html>Not Found</html>')
+        return handler
+
+    def test_download_if_found(self):
+        requested = []
+        found_url = 'https://i1.nhentaimg.com/016/abc/1.jpg'
+
+        async def run(manga_dir):
+            async with httpx.AsyncClient(transport=httpx.MockTransport(self.site({found_url}, requested))) as client:
+                missing = await download_if_found(client, 'https://i1.nhentaimg.com/016/abc/1.png', {},
+                                                  os.path.join(manga_dir, '001.png'))
+                found = await download_if_found(client, found_url, {}, os.path.join(manga_dir, '001.jpg'))
+            return missing, found
+
+        with tempfile.TemporaryDirectory() as manga_dir:
+            self.assertEqual(asyncio.run(run(manga_dir)), (False, True))
+            # Only the 200's body is written
+            self.assertEqual(os.listdir(manga_dir), ['001.jpg'])
+            with open(os.path.join(manga_dir, '001.jpg'), 'rb') as f:
+                self.assertEqual(f.read(), b'image ' + found_url.encode())
+
+    def test_fused_probes_download_pages(self):
+        html = '<div id="info"><h1>Title</h1><span class="tag_name pages">3</span></div>' \
+               '<img class="lazyload" data-src="http://i1.nhentaimg.com/016/abc/cover.jpg">'
+        metadata = parse_gallery('https://nhentai.xxx/g/123/', html, verbose=False)
+        pages = {1: 'http://i1.nhentaimg.com/016/abc/1.jpg', 2: 'http://i1.nhentaimg.com/016/abc/2.png',
+                 3: 'http://i1.nhentaimg.com/016/abc/3.jpg'}
+        requested = []
+        transport = httpx.MockTransport(self.site(set(pages.values()), requested))
+
+        with tempfile.TemporaryDirectory() as manga_dir, \
+                mock.patch.object(project, 'rate_limited_transport', lambda limiter, **kwargs: transport):
+            stats = {'requests': 0, 'files': {}}
+            image_urls, failed = asyncio.run(project.fetch_manga_images('123', None, manga_dir, stats, metadata))
+
+            self.assertEqual(image_urls, pages)
+            self.assertEqual(failed, [])
+            self.assertEqual(sorted(os.listdir(manga_dir)), ['001.jpg', '002.png', '003.jpg'])
+            self.assertEqual(stats['files'], {page: os.path.join(manga_dir, f"{page:03d}{os.path.splitext(url)[1]}")
+                                              for page, url in pages.items()})
+        # Page 2 is a PNG, so its four JPEG candidates 404 first; every probe is counted
+        self.assertEqual(stats['requests'], 7)
+        self.assertEqual(stats['requests'], len(requested))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,377 @@
+import os
+import io
+import asyncio
+import tempfile
+import unittest
+import httpx
+from PIL import Image
+from gallery import ImagePattern, parse_gallery
+from http_session import HttpSession, IMAGE_HEADERS
+from hedging import HedgePolicy
+from manifest import GalleryManifest, MANIFEST_NAME
+from retry_policy import RetryPolicy
+from url_cache import ResolvedUrlCache
+from project_asynchronous_verification_download import (
+    VerificationResult, FusedDownloadStats, find_last_page, prepare_page, convert_to_pdf, TranscodeOptions,
+    fetch_and_save_page, resolve_and_download_images, download_image, verify_image_url, store_page_results,
+    download_manga, save_image
+)
+from page_writer import part_path
+
+PATTERN = ImagePattern('016/abc', '016')
+
+def image_bytes(fmt, color='red'):
+    buffer = io.BytesIO()
+    Image.new('RGB', (20, 30), color).save(buffer, fmt)
+    return buffer.getvalue()
+
+JPEG = image_bytes('JPEG')
+PNG = image_bytes('PNG')
+BLUE_JPEG = image_bytes('JPEG', 'blue')
+
+def page_url(page_num, ext='.jpg', server='i3', scheme='http'):
+    return f"{scheme}://{server}.nhentaimg.com/016/abc/{page_num}{ext}"
+
+def image_site(pages, requested):
+    """MockTransport handler serving {page_num: url} on their URLs and a 404 with a body everywhere else"""
+    bodies = {url: PNG if url.endswith('.png') else JPEG for url in pages.values()}
+
+    def handler(request):
+        requested.append((request.method, str(request.url)))
+        body = bodies.get(str(request.url))
+        if body is None:
+            return httpx.Response(404, content=b'<html>Not Found</html>')
+        return httpx.Response(200, content=body)
+    return handler
+
+def fake_session(handler):
+    session = HttpSession()
+    session.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return session
+
+def make_verifier(existing_pages, probed, failing_pages=()):
+    async def verify(page_num):
+        probed.append(page_num)
+        if page_num in failing_pages:
+            return VerificationResult(page_num, None, None, None, httpx.ReadTimeout('slow'))
+        if page_num in existing_pages:
+            return VerificationResult(page_num, f"https://i4.nhentaimg.com/016/abc/{page_num}.jpg", 'i4', '.jpg')
+        return VerificationResult(page_num, None, None, None)
+    return verify
+
+class TestFindLastPage(unittest.TestCase):
+    def test_finds_last_page(self):
+        for page_count in [0, 1, 2, 7, 8, 9, 25, 128, 257]:
+            probed = []
+            last_page, _ = asyncio.run(find_last_page(make_verifier(set(range(1, page_count + 1)), probed)))
+            self.assertEqual(last_page, page_count)
+            self.assertEqual(len(probed), len(set(probed)))  # Never probes a page twice
+
+    def test_large_gallery_uses_few_probes(self):
+        probed = []
+        last_page, _ = asyncio.run(find_last_page(make_verifier(set(range(1, 241)), probed)))
+        self.assertEqual(last_page, 240)
+        self.assertLess(len(probed), 40)
+
+    def test_skips_short_gaps(self):
+        existing = set(range(1, 31)) - {16, 17, 18}
+        last_page, results = asyncio.run(find_last_page(make_verifier(existing, [])))
+        self.assertEqual(last_page, 30)
+
+    def test_reuses_known_results(self):
+        probed = []
+        known = {1: VerificationResult(1, "https://i4.nhentaimg.com/016/abc/1.jpg", 'i4', '.jpg')}
+        asyncio.run(find_last_page(make_verifier({1, 2, 3}, probed), known))
+        self.assertNotIn(1, probed)
+
+    def test_transient_failures_are_not_the_end(self):
+        # Taken as missing, the failed probes would end the gallery at page 4
+        last_page, results = asyncio.run(find_last_page(make_verifier(set(range(1, 11)), [], {3, 5, 6, 7, 8, 9})))
+        self.assertEqual(last_page, 10)
+
+        # With every probe past page 4 failing, the search stops there, but leaves the failures in the results
+        last_page, results = asyncio.run(find_last_page(make_verifier(set(range(1, 31)), [], range(5, 1000))))
+        self.assertEqual(last_page, 4)
+        self.assertTrue(any(r.error for p, r in results.items() if p > last_page))
+
+class TestVerification(unittest.TestCase):
+    def test_overloaded_server_is_an_error_not_a_missing_page(self):
+        requested = []
+
+        def handler(request):
+            requested.append(str(request.url))
+            return httpx.Response(503, headers={'Retry-After': '0'})
+
+        async def run():
+            async with fake_session(handler) as session:
+                return await verify_image_url(session, 1, PATTERN, 'i3', IMAGE_HEADERS)
+
+        result = asyncio.run(run())
+        self.assertIsNone(result.url)
+        self.assertEqual(result.error.response.status_code, 503)
+        # The server is left alone after the first 503 instead of getting every candidate
+        self.assertEqual(len(requested), 1)
+
+    def test_gallery_with_failed_probes_is_not_complete(self):
+        cache = ResolvedUrlCache(':memory:')
+        found = {p: VerificationResult(p, page_url(p), 'i3', '.jpg') for p in (1, 2)}
+
+        failed = {**found, 3: VerificationResult(3, None, None, None, httpx.ReadTimeout('slow'))}
+        image_urls, missing = store_page_results('123', failed, 2, cache)
+        self.assertEqual(list(image_urls), [1, 2])
+        self.assertEqual(missing, [3])
+        self.assertIsNone(cache.get_complete_gallery('123'))
+
+        store_page_results('123', {**found, 3: VerificationResult(3, None, None, None)}, 2, cache)
+        self.assertEqual(len(cache.get_complete_gallery('123')), 2)
+        cache.close()
+
+class TestConvertToPdf(unittest.TestCase):
+    def test_flattens_transparent_pages_in_memory(self):
+        with tempfile.TemporaryDirectory() as manga_dir:
+            opaque = os.path.join(manga_dir, '001.jpg')
+            transparent = os.path.join(manga_dir, '002.png')
+            Image.new('RGB', (20, 30), 'red').save(opaque)
+            Image.new('RGBA', (20, 30), (0, 0, 255, 128)).save(transparent)
+
+            self.assertEqual(prepare_page(opaque).source, opaque)
+            flattened = prepare_page(transparent).source
+            self.assertIsInstance(flattened, io.BytesIO)
+            self.assertEqual(Image.open(flattened).format, 'JPEG')
+
+            convert_to_pdf(manga_dir, [transparent, opaque])
+            self.assertEqual(
+                sorted(os.listdir(manga_dir)),
+                ['001.jpg', '002.png', os.path.basename(manga_dir) + '.pdf']
+            )
+
+    def test_transcode_downscales_and_converts(self):
+        with tempfile.TemporaryDirectory() as manga_dir:
+            wide = os.path.join(manga_dir, '001.jpg')
+            webp = os.path.join(manga_dir, '002.webp')
+            Image.radial_gradient('L').resize((400, 600)).convert('RGB').save(wide, quality=95)
+            Image.radial_gradient('L').resize((200, 300)).convert('RGB').save(webp, lossless=True)
+
+            page = prepare_page(wide, TranscodeOptions(max_width=100))
+            self.assertEqual(Image.open(page.source).size, (100, 150))
+            self.assertLess(page.size, page.original_size)
+
+            self.assertEqual(prepare_page(webp).source, webp)
+            converted = prepare_page(webp, TranscodeOptions(webp_to_jpeg=True)).source
+            self.assertEqual(Image.open(converted).format, 'JPEG')
+
+            # Narrow pages aren't touched by max_width alone
+            self.assertEqual(prepare_page(webp, TranscodeOptions(max_width=1000)).source, webp)
+
+class TestFusedDownload(unittest.TestCase):
+    def fetch_page(self, pages, known_url=None):
+        requested = []
+        stats = FusedDownloadStats()
+        downloaded = set()
+
+        async def run():
+            async with fake_session(image_site(pages, requested)) as session:
+                return await fetch_and_save_page(session, 1, PATTERN, 'i3', self.manga_dir, IMAGE_HEADERS,
+                                                 downloaded, stats, known_url=known_url)
+
+        with tempfile.TemporaryDirectory() as self.manga_dir:
+            result = asyncio.run(run())
+            files = sorted(os.listdir(self.manga_dir))
+            contents = {name: open(os.path.join(self.manga_dir, name), 'rb').read() for name in files}
+        return result, stats, requested, contents
+
+    def test_missing_candidates_fall_through(self):
+        png = page_url(1, '.png', scheme='https')
+        result, stats, requested, contents = self.fetch_page({1: png})
+
+        self.assertEqual(result.url, png)
+        self.assertEqual([url for _, url in requested], [page_url(1), page_url(1, scheme='https'), page_url(1, '.png'), png])
+        # The 404 bodies never reach the disk, only the 200's does
+        self.assertEqual(contents, {'001.png': PNG})
+        self.assertEqual((stats.requests, stats.pages, stats.known_pages), (4, 1, 0))
+
+    def test_known_url_is_tried_first(self):
+        png = page_url(1, '.png', scheme='https')
+        result, stats, requested, contents = self.fetch_page({1: png}, known_url=png)
+
+        self.assertEqual(requested, [('GET', png)])
+        self.assertEqual(list(contents), ['001.png'])
+        self.assertEqual((stats.requests, stats.pages, stats.known_pages), (1, 1, 1))
+        self.assertEqual(stats.requests_saved, 0)
+
+    def test_missing_page_is_not_an_error(self):
+        result, stats, requested, contents = self.fetch_page({})
+        self.assertIsNone(result.url)
+        self.assertIsNone(result.error)
+        self.assertEqual(stats.requests, 6)
+        self.assertEqual(contents, {})
+
+    def test_gallery_request_counts(self):
+        # Pages 1 and 2 come with thumbnails; 3 and 4 have to be found with GETs
+        html = ('<div id="info"><h1>Title</h1><span class="tag_name pages">4</span></div>'
+                '<img class="lazyload" data-src="http://i3.nhentaimg.com/016/abc/1t.jpg">'
+                '<img class="lazyload" data-src="http://i3.nhentaimg.com/016/abc/2t.png">')
+        metadata = parse_gallery('https://nhentai.xxx/g/123/', html, verbose=False)
+        pages = {1: page_url(1), 2: page_url(2, '.png'), 3: page_url(3), 4: page_url(4, '.png')}
+        requested = []
+
+        async def run(manga_dir):
+            async with fake_session(image_site(pages, requested)) as session:
+                return await resolve_and_download_images('123', manga_dir, session=session, metadata=metadata)
+
+        with tempfile.TemporaryDirectory() as manga_dir:
+            downloaded, failed, stats = asyncio.run(run(manga_dir))
+            self.assertEqual(sorted(os.listdir(manga_dir)), ['001.jpg', '002.png', '003.jpg', '004.png'])
+
+        self.assertEqual(failed, set())
+        self.assertEqual(len(downloaded), 4)
+        # Known pages take one GET each, page 3 one and page 4 three; the mirror check HEADs the other 5 servers
+        self.assertEqual([method for method, _ in requested].count('GET'), 6)
+        self.assertEqual(stats.requests, len(requested))
+        self.assertEqual(stats.requests, 11)
+        self.assertEqual((stats.pages, stats.known_pages, stats.requests_saved), (4, 2, 2))
+
+class TestSaveImage(unittest.TestCase):
+    def test_stale_partial_file_starts_over_after_the_416_is_closed(self):
+        url = page_url(1)
+        seen = []
+
+        class RangeNotSatisfiable(httpx.AsyncByteStream):
+            closed = False
+
+            async def __aiter__(self):
+                yield b''
+
+            async def aclose(self):
+                RangeNotSatisfiable.closed = True
+
+        async def run(manga_dir):
+            filepath = os.path.join(manga_dir, '001.jpg')
+            with open(part_path(filepath), 'wb') as f:
+                f.write(b'x' * 5000)  # Longer than the image, left by an earlier run
+            manifest = GalleryManifest(manga_dir, '123')
+            manifest.mark_partial(1, url, '001.jpg', None)
+
+            def handler(request):
+                if 'Range' in request.headers:
+                    return httpx.Response(416, stream=RangeNotSatisfiable())
+                # The restart only comes once the 416 is closed and off the mirror's in-flight count
+                seen.append((RangeNotSatisfiable.closed, session.mirrors.get('i3').in_flight))
+                return httpx.Response(200, content=JPEG)
+
+            async with fake_session(handler) as session:
+                size = await save_image(session, 1, url, filepath, IMAGE_HEADERS, manifest)
+            with open(filepath, 'rb') as f:
+                return size, f.read()
+
+        with tempfile.TemporaryDirectory() as manga_dir:
+            size, content = asyncio.run(run(manga_dir))
+        self.assertEqual(content, JPEG)
+        self.assertEqual(size, len(JPEG))
+        self.assertEqual(seen, [(True, 1)])
+
+class RecordingPdfStage:
+    """Stands in for PdfStage, noting what was submitted and how many requests had been made by then"""
+
+    def __init__(self, requested):
+        self.requested = requested
+        self.submitted = []
+
+    async def submit(self, manga_dir, downloaded_files, **options):
+        self.submitted.append((sorted(os.path.basename(f) for f in downloaded_files), len(self.requested)))
+
+class TestDownloadRetries(unittest.TestCase):
+    def test_pages_are_resolved_again_and_retried_before_the_pdf(self):
+        # Page 1 moved to .png (and its first probe hits a 503), page 2 is throttled once, page 3 never recovers
+        html = ('<div id="info"><h1>Title</h1><span class="tag_name pages">3</span></div>' + ''.join(
+            f'<img class="lazyload" data-src="http://i3.nhentaimg.com/016/abc/{p}t.jpg">' for p in (1, 2, 3)
+        ))
+        url = 'https://nhentai.xxx/g/123/'
+        metadata = parse_gallery(url, html, verbose=False)
+        moved = page_url(1, '.png')
+        requested = []
+
+        def handler(request):
+            requested.append((request.method, str(request.url)))
+            calls = requested.count((request.method, str(request.url)))
+            throttled = httpx.Response(503, headers={'Retry-After': '0'})
+            if str(request.url) == moved:
+                if request.method == 'HEAD' and calls == 1:
+                    return throttled
+                return httpx.Response(200, content=PNG)
+            if str(request.url) == page_url(2):
+                return throttled if calls == 1 else httpx.Response(200, content=JPEG)
+            if str(request.url) == page_url(3):
+                return throttled
+            return httpx.Response(404)
+
+        pdf_stage = RecordingPdfStage(requested)
+
+        async def run(download_dir):
+            async with fake_session(handler) as session:
+                return await download_manga(url, session=session, download_dir=download_dir, pdf_stage=pdf_stage,
+                                            retry_policy=RetryPolicy(max_retries=2), metadata=metadata)
+
+        with tempfile.TemporaryDirectory() as download_dir:
+            manga_dir, failed = asyncio.run(run(download_dir))
+            manifest = GalleryManifest.load(manga_dir, '123')
+            self.assertEqual(manifest.pages[1].url, moved)
+            self.assertTrue(manifest.is_complete(1))
+            self.assertTrue(manifest.is_complete(2))
+
+        self.assertEqual(failed, [3])
+        self.assertEqual(requested.count(('HEAD', moved)), 2)
+        self.assertEqual(requested.count(('GET', page_url(2))), 2)
+        # Page 3 gets its two retries, and only then does the gallery go on to the PDF without it
+        self.assertEqual(requested.count(('GET', page_url(3))), 3)
+        self.assertEqual(pdf_stage.submitted, [(['001.png', '002.jpg'], len(requested))])
+
+class TestHedgedDownload(unittest.TestCase):
+    def test_hedge_replaces_a_stalled_primary(self):
+        primary = page_url(1)
+        stalled = asyncio.Event()
+
+        async def stall():
+            yield JPEG[:100]
+            stalled.set()
+            await asyncio.Event().wait()
+
+        in_flight = []
+
+        def handler(request):
+            if str(request.url) == primary:
+                return httpx.Response(200, content=stall(), headers={'Content-Length': str(len(JPEG))})
+            # The other scheme answers straight away, with bytes the primary would never write
+            in_flight.append(session.download_limits.get('i3').in_flight)
+            return httpx.Response(200, content=BLUE_JPEG)
+
+        hedge = HedgePolicy(budget=1.0, min_samples=1)
+        hedge.record(0.05)
+        downloaded = set()
+        session = None
+
+        async def run(manga_dir):
+            manifest = GalleryManifest(manga_dir, '123')
+            manifest.set_urls({1: primary}, 1)
+            nonlocal session
+            async with fake_session(handler) as session:
+                error = await download_image(session, 1, primary, manga_dir, IMAGE_HEADERS, downloaded, 1,
+                                             manifest=manifest, hedge=hedge)
+            await manifest.flush()
+            return error
+
+        with tempfile.TemporaryDirectory() as manga_dir:
+            self.assertIsNone(asyncio.run(run(manga_dir)))
+            self.assertTrue(stalled.is_set())
+            self.assertEqual((hedge.hedges, hedge.hedge_wins), (1, 1))
+            # The hedge holds a download slot on its server next to the primary's
+            self.assertEqual(in_flight, [2])
+            # Neither the hedge's file nor the primary's partial one is left behind
+            self.assertEqual(sorted(os.listdir(manga_dir)), ['001.jpg', MANIFEST_NAME])
+            with open(os.path.join(manga_dir, '001.jpg'), 'rb') as f:
+                self.assertEqual(f.read(), BLUE_JPEG)
+            self.assertEqual(downloaded, {os.path.join(manga_dir, '001.jpg')})
+            self.assertTrue(GalleryManifest.load(manga_dir, '123').is_complete(1))
+
+if __name__ == '__main__':
+    unittest.main()
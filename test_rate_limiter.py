@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import unittest
+import threading
+import subprocess
+import httpx
+from rate_limiter import RateLimiter, RateLimitedTransport, TokenBucket
+from http_session import HttpSession
+
+class TestRateLimiter(unittest.TestCase):
+    def test_bucket_paces_requests_after_the_burst(self):
+        bucket = TokenBucket(rate=10.0, capacity=2.0)
+        delays = [bucket.reserve() for _ in range(4)]
+        self.assertEqual(delays[:2], [0.0, 0.0])
+        self.assertAlmostEqual(delays[2], 0.1, places=2)
+        self.assertAlmostEqual(delays[3], 0.2, places=2)
+
+    def test_each_host_gets_the_rate_of_its_domain(self):
+        limiter = RateLimiter({'nhentai.xxx': 5.0, 'nhentaimg.com': 50.0, 'i6.nhentaimg.com': 0})
+        self.assertEqual(limiter.rate_for('nhentai.xxx'), 5.0)
+        self.assertEqual(limiter.rate_for('i3.nhentaimg.com'), 50.0)
+        self.assertIsNone(limiter.rate_for('i6.nhentaimg.com'))
+        self.assertIsNone(limiter.rate_for('example.com'))
+        self.assertIsNot(limiter.bucket('i1.nhentaimg.com'), limiter.bucket('i2.nhentaimg.com'))
+
+    def test_shared_file_gives_one_rate_to_every_limiter(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'rate_limits.sqlite3')
+            first = RateLimiter({'nhentai.xxx': 10.0}, burst=0, shared_path=path)
+            second = RateLimiter({'nhentai.xxx': 10.0}, burst=0, shared_path=path)
+            self.assertEqual(first.bucket('nhentai.xxx').reserve(), 0.0)
+            self.assertAlmostEqual(second.bucket('nhentai.xxx').reserve(), 0.1, places=2)
+            self.assertAlmostEqual(first.bucket('nhentai.xxx').reserve(), 0.2, places=2)
+            first.close()
+            second.close()
+
+    def test_waiting_for_another_process_leaves_the_event_loop_free(self):
+        # The other process takes the write lock and keeps it for half a second
+        holder = ("import sqlite3, sys, time\n"
+                  "conn = sqlite3.connect(sys.argv[1], isolation_level=None)\n"
+                  "conn.execute('BEGIN IMMEDIATE')\n"
+                  "print('locked', flush=True)\n"
+                  "time.sleep(0.5)\n"
+                  "conn.execute('COMMIT')\n")
+
+        async def run(limiter):
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            ticker = asyncio.create_task(tick())
+            started = time.monotonic()
+            await limiter.acquire('nhentai.xxx')
+            waited = time.monotonic() - started
+            ticker.cancel()
+            return waited, ticks
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'rate_limits.sqlite3')
+            limiter = RateLimiter({'nhentai.xxx': 10.0}, shared_path=path)
+            with subprocess.Popen([sys.executable, '-c', holder, path], stdout=subprocess.PIPE, text=True) as other:
+                self.assertEqual(other.stdout.readline().strip(), 'locked')
+                waited, ticks = asyncio.run(run(limiter))
+            limiter.close()
+
+        self.assertGreater(waited, 0.3)
+        # The loop kept running while the reservation waited for the lock
+        self.assertGreater(ticks, 10)
+
+    def test_transport_waits_before_each_request(self):
+        limiter = RateLimiter({'nhentai.xxx': 20.0}, burst=0)
+        transport = RateLimitedTransport(httpx.MockTransport(lambda request: httpx.Response(200)), limiter)
+
+        async def run():
+            async with httpx.AsyncClient(transport=transport) as client:
+                started = time.monotonic()
+                await asyncio.gather(*[client.get('https://nhentai.xxx/g/1/') for _ in range(5)])
+                await client.get('https://example.com/')  # Not limited
+                return time.monotonic() - started
+
+        self.assertGreaterEqual(asyncio.run(run()), 0.19)
+        self.assertAlmostEqual(limiter.waited, 0.5, places=1)
+
+    def test_closing_the_session_closes_the_limiter(self):
+        def limiter_threads():
+            return [t for t in threading.enumerate() if t.name.startswith('rate-limit')]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            limiter = RateLimiter({'nhentai.xxx': 10.0}, shared_path=os.path.join(tmp, 'rate_limits.sqlite3'))
+
+            async def run():
+                async with HttpSession(rate_limiter=limiter):
+                    await limiter.acquire('nhentai.xxx')
+                    self.assertTrue(limiter_threads())
+
+            asyncio.run(run())
+            self.assertIsNone(limiter.conn)
+            self.assertEqual(limiter_threads(), [])
+
+            # A closed limiter opens the file again if another session uses it
+            asyncio.run(run())
+            self.assertIsNone(limiter.conn)
+
+if __name__ == '__main__':
+    unittest.main()
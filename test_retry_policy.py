@@ -0,0 +1,46 @@
+import unittest
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+import httpx
+from retry_policy import RetryPolicy, retry_after, is_transient, is_missing, describe
+
+def status_error(status, headers=None):
+    request = httpx.Request('GET', 'https://i3.nhentaimg.com/016/abc123/1.jpg')
+    response = httpx.Response(status, headers=headers, request=request)
+    return httpx.HTTPStatusError('error', request=request, response=response)
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_retry_after_seconds_and_date(self):
+        self.assertEqual(retry_after(status_error(429, {'Retry-After': '7'})), 7.0)
+        later = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+        self.assertAlmostEqual(retry_after(status_error(503, {'Retry-After': later})), 30, delta=2)
+        self.assertIsNone(retry_after(status_error(503, {'Retry-After': 'soon'})))
+        # Only followed where the spec says it means "come back later"
+        self.assertIsNone(retry_after(status_error(500, {'Retry-After': '7'})))
+        self.assertIsNone(retry_after(httpx.ConnectError('refused')))
+
+    def test_delay_follows_retry_after_up_to_max(self):
+        policy = RetryPolicy(max_delay=10.0)
+        self.assertEqual(policy.delay(0, status_error(429, {'Retry-After': '3'})), 3.0)
+        self.assertEqual(policy.delay(0, status_error(429, {'Retry-After': '3600'})), 10.0)
+
+    def test_backoff_grows_with_jitter(self):
+        policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+        for retry, cap in [(0, 1.0), (1, 2.0), (2, 4.0), (5, 5.0)]:
+            delays = [policy.delay(retry) for _ in range(50)]
+            self.assertTrue(all(0 <= d <= cap for d in delays))
+            self.assertGreater(len(set(delays)), 1)
+
+    def test_classification(self):
+        self.assertTrue(is_transient(httpx.ReadTimeout('slow')))
+        self.assertTrue(is_transient(httpx.ConnectError('refused')))
+        self.assertTrue(is_transient(status_error(503)))
+        self.assertFalse(is_transient(status_error(404)))
+        self.assertFalse(is_transient(status_error(403)))
+        self.assertFalse(is_transient(None))
+        self.assertTrue(is_missing(status_error(404)))
+        self.assertFalse(is_missing(status_error(503)))
+        self.assertEqual(describe(status_error(503)), 'HTTP 503')
+
+if __name__ == '__main__':
+    unittest.main()
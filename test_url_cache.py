@@ -0,0 +1,43 @@
+import unittest
+from url_cache import ResolvedUrlCache, CachedPage
+
+class TestResolvedUrlCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResolvedUrlCache(':memory:')
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_round_trip(self):
+        pages = [
+            CachedPage(1, 'https://i4.nhentaimg.com/016/abc/1.jpg', 'i4', '.jpg'),
+            CachedPage(2, 'https://i4.nhentaimg.com/016/abc/2.png', 'i4', '.png')
+        ]
+        self.cache.put_pages('123456', pages)
+        self.cache.mark_complete('123456', 2)
+
+        page_count, cached = self.cache.get_gallery('123456')
+        self.assertEqual(page_count, 2)
+        self.assertEqual(cached[2], pages[1])
+
+        # Unknown galleries have no page count
+        self.assertEqual(self.cache.get_gallery('999'), (None, {}))
+
+    def test_invalidate_page(self):
+        self.cache.put_pages('123456', [CachedPage(1, 'https://i4.nhentaimg.com/016/abc/1.jpg', 'i4', '.jpg')])
+        self.cache.mark_complete('123456', 1)
+        self.cache.invalidate_page('123456', 1)
+
+        page_count, cached = self.cache.get_gallery('123456')
+        self.assertEqual(page_count, 1)
+        self.assertEqual(cached, {})
+
+    def test_ttl_expiry(self):
+        cache = ResolvedUrlCache(':memory:', ttl=-1)
+        cache.put_pages('123456', [CachedPage(1, 'https://i4.nhentaimg.com/016/abc/1.jpg', 'i4', '.jpg')])
+        cache.mark_complete('123456', 1)
+        self.assertEqual(cache.get_gallery('123456'), (None, {}))
+        cache.close()
+
+if __name__ == '__main__':
+    unittest.main()
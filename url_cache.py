@@ -0,0 +1,139 @@
+"""
+Copyright (C) 2024  solveditnpc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import sqlite3
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Tuple
+
+DEFAULT_CACHE_DIR = '.cache'
+DEFAULT_TTL = 7 * 24 * 60 * 60  # One week
+
+@dataclass
+class CachedPage:
+    """Data class to store a resolved page URL"""
+    page_num: int
+    url: str
+    server: str
+    extension: str
+
+class ResolvedUrlCache:
+    """
+    On-disk cache of resolved image URLs, keyed by manga ID and page number
+
+    A gallery is only treated as fully resolved once its page count has been
+    stored with mark_complete(). Individual pages can be dropped with
+    invalidate_page() (e.g. after a 404) and will be re-verified on the next run.
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: float = DEFAULT_TTL):
+        """
+        :param path: SQLite database file, defaults to .cache/resolved_urls.sqlite3
+        :param ttl: Seconds before a cached entry is considered stale
+        """
+        if path is None:
+            path = os.path.join(os.getcwd(), DEFAULT_CACHE_DIR, 'resolved_urls.sqlite3')
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.path = path
+        self.ttl = ttl
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                manga_id TEXT NOT NULL,
+                page_num INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                server TEXT NOT NULL,
+                extension TEXT NOT NULL,
+                resolved_at REAL NOT NULL,
+                PRIMARY KEY (manga_id, page_num)
+            );
+            CREATE TABLE IF NOT EXISTS galleries (
+                manga_id TEXT PRIMARY KEY,
+                page_count INTEGER NOT NULL,
+                resolved_at REAL NOT NULL
+            );
+        """)
+        self.conn.commit()
+
+    def get_gallery(self, manga_id: str) -> Tuple[Optional[int], Dict[int, CachedPage]]:
+        """
+        Get cached pages for a gallery
+
+        :return: Tuple of (page count or None if unknown/stale, dict of page number -> CachedPage)
+        """
+        cutoff = time.time() - self.ttl
+
+        row = self.conn.execute(
+            "SELECT page_count FROM galleries WHERE manga_id = ? AND resolved_at >= ?",
+            (manga_id, cutoff)
+        ).fetchone()
+        page_count = row[0] if row else None
+
+        pages = {}
+        for page_num, url, server, extension in self.conn.execute(
+            "SELECT page_num, url, server, extension FROM pages "
+            "WHERE manga_id = ? AND resolved_at >= ?",
+            (manga_id, cutoff)
+        ):
+            pages[page_num] = CachedPage(page_num, url, server, extension)
+
+        return page_count, pages
+
+    def get_complete_gallery(self, manga_id: str) -> Optional[Dict[int, CachedPage]]:
+        """Get cached pages only if every page of the gallery is cached and fresh"""
+        page_count, pages = self.get_gallery(manga_id)
+        if not page_count or any(page not in pages for page in range(1, page_count + 1)):
+            return None
+        return {page: cached for page, cached in pages.items() if page <= page_count}
+
+    def put_pages(self, manga_id: str, pages: Iterable[CachedPage]) -> None:
+        """Store resolved pages for a gallery"""
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO pages (manga_id, page_num, url, server, extension, resolved_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(manga_id, p.page_num, p.url, p.server, p.extension, now) for p in pages]
+        )
+        self.conn.commit()
+
+    def mark_complete(self, manga_id: str, page_count: int) -> None:
+        """Record that every page of a gallery has been resolved"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO galleries (manga_id, page_count, resolved_at) VALUES (?, ?, ?)",
+            (manga_id, page_count, time.time())
+        )
+        self.conn.commit()
+
+    def invalidate_page(self, manga_id: str, page_num: int) -> None:
+        """Drop a single cached page, e.g. after the server returned 404 for it"""
+        self.conn.execute(
+            "DELETE FROM pages WHERE manga_id = ? AND page_num = ?",
+            (manga_id, page_num)
+        )
+        self.conn.commit()
+
+    def invalidate_gallery(self, manga_id: str) -> None:
+        """Drop every cached entry for a gallery"""
+        self.conn.execute("DELETE FROM pages WHERE manga_id = ?", (manga_id,))
+        self.conn.execute("DELETE FROM galleries WHERE manga_id = ?", (manga_id,))
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()